@@ -1,3 +1,5 @@
+import binascii
+import os
 import time
 
 import machine
@@ -16,11 +18,22 @@ from config import (
     WLAN_SSID
 )
 from device import DeviceAuth
+import displaylist
+import layout
+from displaylist import DisplayList
 from images import CALENDAR_40_40
 from inkplate import Inkplate
-from layout import ALIGN_CENTER, ALIGN_RIGHT, Column, Row
+from layout import ALIGN_CENTER, ALIGN_RIGHT, Column, Row, Screen
 from utils import DateTime
 
+# Where what the display shows is kept during deep sleep, see Inkplate.saveSnapshot.
+SNAPSHOT = 'display.snap'
+# Partial refreshes in a row before a full one clears up the ghosting.
+FULL_REFRESH_EVERY = 8
+# Display lists of fixed notifications kept in flash, see App._notify.
+NOTIFY_PREFIX = 'notify_'
+NOTIFY_CACHE = 8
+
 # Shell
 '''
 picocom /dev/ttyUSB0 -b115200
@@ -28,7 +41,7 @@ picocom /dev/ttyUSB0 -b115200
 
 # Copy files.
 '''
-python pyboard.py --device /dev/ttyUSB0 -f cp app.py boot.py config.py calendar_api.py device.py images.py layout.py path.py text.py utils.py :
+python pyboard.py --device /dev/ttyUSB0 -f cp app.py boot.py config.py calendar_api.py device.py displaylist.py images.py layout.py path.py text.py utils.py :
 python pyboard.py --device /dev/ttyUSB0 app.py
 '''
 
@@ -41,8 +54,16 @@ class App:
     def __init__(self):
         self.display = Inkplate(Inkplate.INKPLATE_1BIT)
         self.display.begin()
+        # Draw the layout just before refreshing, without the overdrawn parts.
+        self.display.startRecording()
         self.width = self.display.width()
         self.height = self.display.height()
+        # What's on the display, so redraws only refresh what changed.
+        self.screen = Screen(self.display)
+        # After deep sleep the display still shows the last refresh.
+        partials = self.display.loadSnapshot(SNAPSHOT)
+        if partials is not None and partials < FULL_REFRESH_EVERY:
+            self.screen.resume()
         # Connection state.
         self.connecting = False
         self.connected = False
@@ -60,7 +81,7 @@ class App:
         if notify:
             self._notify('Initializing', messages=[
                 'Connecting to %s' % (WLAN_SSID)
-            ])
+            ], fixed=True)
 
         wlan = network.WLAN(network.STA_IF)
         wlan.active(True)
@@ -83,7 +104,7 @@ class App:
         if notify:
             self._notify('Initializing', messages=[
                 'Sync-ing real time clocks with Network'
-            ])
+            ], fixed=True)
 
         print('Sync-ing network time.')
         delay = 0
@@ -143,9 +164,10 @@ class App:
         if notify:
             self._notify('Syncing', messages=[
                 'Updating calendar events'
-            ])
+            ], fixed=True)
 
         self.build_calendar_ui()
+        self.display.saveSnapshot(SNAPSHOT)
         print('Entering deep sleep.')
         machine.deepsleep(REFRESH_INTERVAL * 60 * 1000)
 
@@ -236,7 +258,22 @@ class App:
         print(message)
         self._notify('Error', messages=messages)
 
-    def _notify(self, title, messages=list()):
+    def _notify(self, title, messages=list(), fixed=False):
+        '''
+        Shows a notification. `fixed` notifications always look the same, so
+        they get compiled into a display list that's kept in flash and after
+        that replayed without building the layout again.
+        '''
+        path = None
+        if fixed:
+            path = self._notify_path(title, messages)
+            try:
+                display_list = DisplayList.load(path)
+                self._draw(display_list, clean='quick')
+                return
+            except (OSError, ValueError):
+                pass
+
         root = Column(
             layout_width=self.width,
             layout_height=self.height,
@@ -267,12 +304,60 @@ class App:
         content_root.add_node(content)
         root.add_node(header)
         root.add_node(content_root)
-        self._draw(root)
+        if path:
+            root = DisplayList.compile(root)
+            try:
+                self._clean_notify_cache(path)
+                root.save(path)
+            except OSError:
+                pass
+        # Notifications are transient, a little ghosting is fine.
+        self._draw(root, clean='quick')
+
+    def _notify_path(self, title, messages):
+        '''
+        The file the display list of a fixed notification is kept in. Its
+        name starts with a stamp of everything besides the text that the
+        notification looks like, so lists compiled by other code or for
+        another display are never replayed.
+        '''
+        stamp = '%d %d %d %d %d' % (
+            displaylist.VERSION,
+            layout.VERSION,
+            self.width,
+            self.height,
+            binascii.crc32(CALENDAR_40_40)
+        )
+        key = '\n'.join([title] + messages)
+        return '%s%08x_%08x.ipdl' % (
+            NOTIFY_PREFIX,
+            binascii.crc32(stamp.encode()) & 0xffffffff,
+            binascii.crc32(key.encode()) & 0xffffffff
+        )
 
-    def _draw(self, node):
-        self.display.clearDisplay()
-        node.draw(self.display, 0, 0)
-        self.display.display()
+    def _clean_notify_cache(self, path):
+        '''
+        Removes the kept notifications of other stamps than path's, and all
+        of them once there are NOTIFY_CACHE, before path gets saved.
+        '''
+        stamp = path[:len(NOTIFY_PREFIX) + 9]
+        files = [
+            f for f in os.listdir()
+            if f.startswith(NOTIFY_PREFIX) and f.endswith('.ipdl')
+        ]
+        current = [f for f in files if f.startswith(stamp)]
+        for f in files:
+            if not f.startswith(stamp) or len(current) >= NOTIFY_CACHE:
+                os.remove(f)
+
+    def _draw(self, node, clean=None):
+        '''
+        Draws the node tree and refreshes the display. Only the boxes that
+        changed since the last draw get redrawn and sent with a partial update,
+        the first draw refreshes the whole display.
+        `clean` picks the display's clean profile ('full', 'quick' or 'none').
+        '''
+        self.screen.update(node, clean=clean)
 
 
 if __name__ == '__main__':
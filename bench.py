@@ -0,0 +1,357 @@
+# Display pipeline benchmarks, run on the host with CPython using the inkplate_sim simulator:
+#
+#   python3 bench.py                        # run all cases and print the counters
+#   python3 bench.py partial clean          # run only some cases
+#   python3 bench.py --save baseline.json   # record the counters
+#   python3 bench.py --compare baseline.json
+#
+# Every case renders something, runs one display operation and reports the register writes,
+# rows latched and phases it took, as well as whether the image rebuilt by the simulated panel
+# matches the framebuffer (for the jpeg case whether the decoded images match their stored
+# checksums). With --compare the run fails if any counter went up compared to the saved
+# baseline, which catches regressions in the row senders and clean sequences without a board
+# at hand. Host run times are shown but never compared.
+import json
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+import inkplate_sim
+
+board = inkplate_sim.install()
+
+from inkplate import (  # noqa: E402
+    D_COLS,
+    D_ROWS,
+    ENCODE_FRAME,
+    ENCODE_ROW,
+    Inkplate,
+    InkplateGS2,
+    InkplateGS3,
+    InkplatePartialGS2,
+)
+
+# counters that are compared against a baseline, in display order
+COUNTERS = (
+    "reg_writes",
+    "w1ts0",
+    "w1tc0",
+    "w1ts1",
+    "w1tc1",
+    "pin_writes",
+    "cl_pulses",
+    "rows_latched",
+    "phases",
+    "mcp_toggles",
+    "tps_transactions",
+    "sleep_us",
+)
+
+
+def _new_display(mode):
+    display = Inkplate(mode)
+    display.begin()
+    display.clearDisplay()
+    return display
+
+
+# _scene draws the same mix of shapes and text for every case
+def _scene(display, c=1):
+    display.drawRect(10, 10, 780, 580, c)
+    display.fillRect(40, 60, 200, 120, c)
+    display.drawLine(0, 0, 799, 599, c)
+    display.fillCircle(600, 300, 80, c)
+    display.setTextSize(3)
+    display.printText(40, 400, "INKPLATE BENCH")
+
+
+def _mono_ok(display):
+    return board.panel.image() == display.ipm._framebuf
+
+
+def _gs2_ok(display, trailing):
+    codes = [[lut[v * 5] & 3 for lut in InkplateGS2._wave] for v in range(4)]
+    return _levels_ok(codes, display.ipg, trailing)
+
+
+def _gs3_ok(display, trailing):
+    codes = [[phase[v] for phase in InkplateGS3._phases] for v in range(8)]
+    return _levels_ok(codes, display.ipg3, trailing)
+
+
+# _partial_gs2_ok checks that every pixel got the codes of its old -> new transition and
+# that the pixels that didn't change got skipped
+def _partial_gs2_ok(display, old, trailing):
+    phases = InkplatePartialGS2._phases
+    codes = [[phase[k] for phase in phases] for k in range(16)]
+    codes.append([3] * len(phases))
+    levels = board.panel.decode(codes, skip=trailing)
+    fb = display.ipg
+    for y in range(0, D_ROWS, 3):
+        for x in range(0, D_COLS, 3):
+            o = old.pixel(x, y)
+            n = fb.pixel(x, y)
+            if levels[y * D_COLS + x] != (16 if o == n else o * 4 + n):
+                return False
+    return True
+
+
+def _levels_ok(codes, fb, trailing):
+    levels = board.panel.decode(codes, skip=trailing)
+    for y in range(0, D_ROWS, 3):
+        for x in range(0, D_COLS, 3):
+            if levels[y * D_COLS + x] != fb.pixel(x, y):
+                return False
+    return True
+
+
+def bench_mono():
+    display = _new_display(Inkplate.INKPLATE_1BIT)
+    _scene(display)
+    board.reset_stats()
+    display.display()
+    return _mono_ok(display)
+
+
+# bench_mono_frame sends the same screen as bench_mono with whole frames encoded once
+def bench_mono_frame():
+    display = _new_display(Inkplate.INKPLATE_1BIT)
+    display.setEncode(ENCODE_FRAME)
+    _scene(display)
+    board.reset_stats()
+    display.display()
+    ok = _mono_ok(display)
+    display.setEncode(ENCODE_ROW)
+    return ok
+
+
+def bench_mono_quick():
+    display = _new_display(Inkplate.INKPLATE_1BIT)
+    _scene(display)
+    board.reset_stats()
+    display.display(clean="quick")
+    return _mono_ok(display)
+
+
+def bench_gs2():
+    display = _new_display(Inkplate.INKPLATE_2BIT)
+    display.fillRect(0, 0, D_COLS, D_ROWS, 3)
+    for v in range(4):
+        display.fillRect(40 + 100 * v, 450, 90, 100, v)
+    _scene(display, 0)
+    board.reset_stats()
+    display.display()
+    return _gs2_ok(display, 2)
+
+
+def bench_gs3():
+    display = _new_display(Inkplate.INKPLATE_3BIT)
+    for v in range(8):
+        display.fillRect(40 + 90 * v, 450, 80, 100, v)
+    _scene(display, 0)
+    board.reset_stats()
+    display.display()
+    return _gs3_ok(display, 2)
+
+
+# bench_partial changes a status line near the bottom of a screen that is already shown
+def bench_partial():
+    display = _new_display(Inkplate.INKPLATE_1BIT)
+    _scene(display)
+    display.display()
+    display.ipp.start()
+    display.fillRect(40, 540, 400, 30, 0)
+    display.setTextSize(2)
+    display.printText(40, 545, "UPDATED 12:34")
+    board.reset_stats()
+    display.partialUpdate()
+    return _mono_ok(display)
+
+
+# bench_partial2 changes a header and a footer line, leaving the middle of the screen alone
+def bench_partial2():
+    display = _new_display(Inkplate.INKPLATE_1BIT)
+    _scene(display)
+    display.display()
+    display.ipp.start()
+    display.setTextSize(2)
+    display.fillRect(40, 20, 400, 20, 0)
+    display.printText(40, 22, "MONDAY 2026-10-19")
+    display.fillRect(40, 550, 400, 20, 0)
+    display.printText(40, 552, "UPDATED 12:34")
+    board.reset_stats()
+    display.partialUpdate()
+    return _mono_ok(display)
+
+
+# bench_partial_gs2 updates a gray value and a status line on a grayscale screen
+def bench_partial_gs2():
+    display = _new_display(Inkplate.INKPLATE_2BIT)
+    for v in range(4):
+        display.fillRect(40 + 100 * v, 450, 90, 100, v)
+    _scene(display, 0)
+    display.display()
+    display.ipp.start()
+    old = InkplateGS2()
+    old._framebuf[:] = display.ipg._framebuf
+    display.fillRect(140, 450, 90, 100, 2)
+    display.fillRect(40, 540, 400, 30, 3)
+    display.setTextSize(2)
+    display.printText(40, 545, "UPDATED 12:34")
+    board.reset_stats()
+    display.partialUpdate()
+    return _partial_gs2_ok(display, old, 3)
+
+
+# bench_displaylist compiles a notification into a display list, saves it, loads it again and
+# replays it like App._notify does, which has to match the layout tree drawn directly
+def bench_displaylist():
+    from displaylist import DisplayList
+    from layout import Column
+
+    display = _new_display(Inkplate.INKPLATE_1BIT)
+    root = Column(None, D_COLS, D_ROWS, wrap_content=False, padding=20)
+    root.add_text_content("Initializing", text_size=4)
+    root.add_spacer(1, outline=True)
+    root.add_wrapped_text("Sync-ing real time clocks with Network", text_size=2)
+    root.add_image(bytes([0xF0, 0x0F] * 16), 16, 16)
+    root.draw(display, 0, 0)
+    drawn = bytes(display.ipm._framebuf)
+    display.clearDisplay()
+    path = os.path.join(tempfile.mkdtemp(), "notify.ipdl")
+    DisplayList.compile(root).save(path)
+    DisplayList.load(path).paint(display)
+    os.remove(path)
+    board.reset_stats()
+    display.display()
+    return bytes(display.ipm._framebuf) == drawn and _mono_ok(display)
+
+
+# CRC-32 of the 3-bit framebuffer after drawing img/hello_world.jpg at (scale, preview)
+JPEG_CHECKSUMS = {
+    (1, False): 0xC610C7EC,
+    (2, False): 0xC4119A40,
+    (4, False): 0x8DD42BC4,
+    (8, False): 0x7687DA03,
+    (2, True): 0xF5A5C292,
+    (4, True): 0x76C7DADA,
+}
+
+
+# bench_jpeg decodes a photo with the JPEG decoder at every scale and as a preview, the
+# framebuffers have to match what the decoder drew when it was checked against Pillow
+def bench_jpeg():
+    display = _new_display(Inkplate.INKPLATE_3BIT)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "img", "hello_world.jpg")
+    board.reset_stats()
+    ok = True
+    for (scale, preview), crc in JPEG_CHECKSUMS.items():
+        display.clearDisplay()
+        if not display.drawImageFile(0, 0, path, scale=scale, preview=preview):
+            return False
+        ok = ok and zlib.crc32(display.ipg3._framebuf) & 0xFFFFFFFF == crc
+    return ok
+
+
+def bench_clean():
+    display = _new_display(Inkplate.INKPLATE_1BIT)
+    board.reset_stats()
+    display.clean()
+    return True
+
+
+CASES = {
+    "mono": bench_mono,
+    "mono_frame": bench_mono_frame,
+    "mono_quick": bench_mono_quick,
+    "gs2": bench_gs2,
+    "gs3": bench_gs3,
+    "partial": bench_partial,
+    "partial2": bench_partial2,
+    "partial_gs2": bench_partial_gs2,
+    "displaylist": bench_displaylist,
+    "jpeg": bench_jpeg,
+    "clean": bench_clean,
+}
+
+
+def run(names):
+    results = {}
+    for name in names:
+        t0 = time.perf_counter()
+        ok = CASES[name]()
+        stats = board.stats()
+        stats["host_ms"] = int((time.perf_counter() - t0) * 1000)
+        stats["image_ok"] = ok
+        results[name] = stats
+    return results
+
+
+def report(results, baseline=None):
+    names = list(results)
+    print("%-18s" % "" + "".join("%14s" % n for n in names))
+    for key in COUNTERS + ("host_ms", "image_ok"):
+        line = "%-18s" % key
+        for n in names:
+            v = results[n].get(key, 0)
+            cell = str(v)
+            if baseline and n in baseline and key in COUNTERS:
+                old = baseline[n].get(key, 0)
+                if v != old:
+                    cell += " (%+d)" % (v - old)
+            line += "%14s" % cell
+        print(line)
+
+
+# regressions lists every counter that went up compared to the baseline
+def regressions(results, baseline):
+    out = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        for key in COUNTERS:
+            old = baseline[name].get(key, 0)
+            if stats.get(key, 0) > old:
+                out.append("%s: %s went from %d to %d" % (name, key, old, stats[key]))
+    return out
+
+
+def main(argv):
+    save = compare = None
+    names = []
+    args = iter(argv)
+    for a in args:
+        if a == "--save":
+            save = next(args)
+        elif a == "--compare":
+            compare = next(args)
+        elif a in CASES:
+            names.append(a)
+        else:
+            print("usage: bench.py [--save FILE] [--compare FILE] [%s ...]" % "|".join(CASES))
+            return 2
+    results = run(names or list(CASES))
+    baseline = None
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    failed = [
+        "%s: image check failed" % n
+        for n, s in results.items()
+        if not s["image_ok"]
+    ]
+    if baseline:
+        failed += regressions(results, baseline)
+    for f in failed:
+        print("FAIL:", f)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
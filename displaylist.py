@@ -0,0 +1,184 @@
+# Display lists: layout trees compiled into a flat list of draw operations with absolute
+# coordinates.
+#
+# A DisplayList gets compiled from an arranged layout tree (see layout.Node.collect) and
+# replays into the framebuffer without any Node objects, measuring or arranging. It can be
+# saved to flash and loaded again, e.g. after deep sleep, so fixed screens only ever get laid
+# out once.
+#
+# The operations are kept in an array of OP_SIZE halfwords each: the operation, x, y and
+# three arguments.
+# - OP_RECT: width, height. An outline.
+# - OP_TEXT: text size, font (0 for the standard font, otherwise 1 + the index of the path
+#   of a fontfile.Font in the strings), index of the text in the strings.
+# - OP_IMAGE: width, height, index of the bitmap in the blobs.
+#
+# A display list file has a 11 byte header (HEADER: MAGIC, version, number of operations,
+# strings and blobs) followed by the operations, the strings (UTF-8) and the blobs, each of
+# those with a 2 byte length in front.
+import struct
+from uarray import array
+
+from gfx_standard_font_01 import text_dict as std_font
+from layout import ImageNode
+from text import measure
+
+MAGIC = b"IPDL"
+VERSION = 1
+HEADER = "<4sBHHH"
+HEADER_SIZE = 11
+
+OP_RECT = 0
+OP_TEXT = 1
+OP_IMAGE = 2
+OP_SIZE = 6
+
+
+# _Op draws operation i of a display list again for layout.Screen
+class _Op:
+    def __init__(self, dl, i):
+        self.dl = dl
+        self.i = i
+
+    def paint(self, display):
+        self.dl._paint(display, self.i)
+
+
+class DisplayList:
+    def __init__(self, ops, strings, blobs):
+        self.ops = ops
+        self.strings = strings
+        self.blobs = blobs
+        self._fonts = {0: std_font}  # font argument -> font, see _font
+
+    # compile returns the display list for layout tree root at x, y
+    @classmethod
+    def compile(cls, root, x=0, y=0):
+        root.arrange(x, y)
+        items = []
+        root.collect(items)
+        ops = array("h")
+        strings = []
+        blobs = []
+        index = {}  # string, or id of a bitmap -> index
+        for box, key, node in items:
+            bx, by, w, h = box
+            if node is None:
+                ops.extend(array("h", (OP_RECT, bx, by, w, h, 0)))
+            elif node.clip_rect():
+                raise ValueError("can't compile nodes in a clipping Column or Row")
+            elif isinstance(node, ImageNode):
+                k = id(node.image)
+                if k not in index:
+                    index[k] = len(blobs)
+                    blobs.append(bytes(node.image))
+                ops.extend(array("h", (OP_IMAGE, bx, by, w, h, index[k])))
+            else:
+                font = node.text.font
+                if font is std_font:
+                    f = 0
+                elif getattr(font, "path", None):
+                    f = 1 + cls._intern(font.path, strings, index)
+                else:
+                    raise ValueError("can't compile a font that isn't in a file")
+                # the key of text starts with the text drawn, a line of it for wrapped text
+                s = cls._intern(key[0], strings, index)
+                ops.extend(array("h", (OP_TEXT, bx, by, node.text_size, f, s)))
+        return cls(ops, strings, blobs)
+
+    @staticmethod
+    def _intern(s, strings, index):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+
+    # load returns the display list saved in the file at path, raising ValueError if the file
+    # isn't a complete display list
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            hdr = f.read(HEADER_SIZE)
+            if len(hdr) < HEADER_SIZE:
+                raise ValueError("not a display list")
+            magic, version, n_ops, n_strings, n_blobs = struct.unpack(HEADER, hdr)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("not a display list")
+            ops = array("h", cls._read_n(f, 2 * OP_SIZE * n_ops))
+            strings = [cls._read(f).decode("utf-8") for _ in range(n_strings)]
+            blobs = [cls._read(f) for _ in range(n_blobs)]
+        return cls(ops, strings, blobs)
+
+    @classmethod
+    def _read(cls, f):
+        n = struct.unpack("<H", cls._read_n(f, 2))[0]
+        return cls._read_n(f, n)
+
+    # _read_n reads exactly n bytes, a display list file that ends early raises ValueError
+    @staticmethod
+    def _read_n(f, n):
+        b = f.read(n)
+        if len(b) != n:
+            raise ValueError("truncated display list")
+        return b
+
+    # save writes the display list to the file at path
+    def save(self, path):
+        with open(path, "wb") as f:
+            hdr = (MAGIC, VERSION, len(self.ops) // OP_SIZE, len(self.strings), len(self.blobs))
+            f.write(struct.pack(HEADER, *hdr))
+            f.write(self.ops)
+            for s in self.strings:
+                s = s.encode("utf-8")
+                f.write(struct.pack("<H", len(s)))
+                f.write(s)
+            for b in self.blobs:
+                f.write(struct.pack("<H", len(b)))
+                f.write(b)
+
+    # _font returns the font for a font argument of OP_TEXT, fontfile only gets imported for
+    # display lists that use font files
+    def _font(self, f):
+        font = self._fonts.get(f)
+        if font is None:
+            from fontfile import Font
+
+            font = self._fonts[f] = Font(self.strings[f - 1])
+        return font
+
+    def _paint(self, display, i):
+        ops = self.ops
+        ix = i * OP_SIZE
+        op, x, y, a, b, c = ops[ix : ix + OP_SIZE]
+        if op == OP_RECT:
+            display.drawRect(x, y, a, b, display.BLACK)
+        elif op == OP_TEXT:
+            display.setTextSize(a)
+            display.setFont(self._font(b))
+            display.printText(x, y, self.strings[c])
+        elif op == OP_IMAGE:
+            display.drawBitmap(x, y, self.blobs[c], a, b)
+
+    # paint draws the display list into the framebuffer
+    def paint(self, display):
+        for i in range(len(self.ops) // OP_SIZE):
+            self._paint(display, i)
+
+    # The rest lets a display list stand in for a layout tree in layout.Screen. Coordinates
+    # are absolute, so arrange has nothing to do.
+    def arrange(self, x, y):
+        pass
+
+    def collect(self, items):
+        ops = self.ops
+        for i in range(len(ops) // OP_SIZE):
+            ix = i * OP_SIZE
+            op, x, y, a, b, c = ops[ix : ix + OP_SIZE]
+            if op == OP_RECT:
+                items.append(((x, y, a, b), "outline", None))
+            elif op == OP_TEXT:
+                font = self._font(b)
+                w, h = measure(self.strings[c], a, font)
+                items.append(((x, y, w, h), (self.strings[c], a, id(font)), _Op(self, i)))
+            elif op == OP_IMAGE:
+                items.append(((x, y, a, b), (self.blobs[c], a, b), _Op(self, i)))
@@ -13,7 +13,7 @@ f = open("sd/text.txt", "r")
 print(f.read())
 f.close()
 
-# Utterly slow, can take minutes :(
+# Streams the file row by row into the framebuffer, see imagefile.py
 display.drawImageFile(0, 0, "sd/32bit.bmp")
 
 display.display()
@@ -0,0 +1,182 @@
+# Converts fonts into the packed format Inkplate.setFont loads (see fontfile.py). Runs on the
+# host with CPython:
+#
+#   python3 fontconv.py helvR14.bdf helv14.ipf
+#   python3 fontconv.py --size 24 DejaVuSans.ttf dejavu24.ipf
+#   python3 fontconv.py --chars " 0123456789:" gfx_standard_font_01.py digits.ipf
+#
+# BDF fonts are read directly, TrueType/OpenType fonts get rasterized at --size pixels with
+# Pillow, and GFX font modules (like gfx_standard_font_01.py) are converted with an advance
+# of one column more than the glyph, the way printText spaces them. By default the printable
+# ASCII and Latin-1 characters the font has are kept.
+import argparse
+import importlib.util
+import os
+import struct
+import sys
+
+from fontfile import HEADER, INDEX, INDEX_SIZE, MAGIC, VERSION
+
+DEFAULT_CHARS = "".join(chr(c) for c in range(32, 127)) + "".join(
+    chr(c) for c in range(160, 256)
+)
+
+
+# Glyph is a character rasterized to a 1-bit bitmap (rows MSB first, padded to a byte) with
+# its metrics, y is the offset of the top of the bitmap from the top of the line
+class Glyph:
+    def __init__(self, cp, data, w, h, x, y, advance):
+        self.cp = cp
+        self.data = bytes(data)
+        self.w = w
+        self.h = h
+        self.x = x
+        self.y = y
+        self.advance = advance
+
+
+# read_bdf returns (line height, ascent, glyphs) of a BDF font
+def read_bdf(path, chars):
+    ascent = descent = None
+    glyphs = []
+    with open(path) as f:
+        lines = iter(f.read().splitlines())
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == "FONT_ASCENT":
+            ascent = int(words[1])
+        elif words[0] == "FONT_DESCENT":
+            descent = int(words[1])
+        elif words[0] == "FONTBOUNDINGBOX" and ascent is None:
+            ascent = int(words[2]) + int(words[4])
+            descent = -int(words[4])
+        elif words[0] == "STARTCHAR":
+            cp = advance = None
+            bbx = (0, 0, 0, 0)
+            for line in lines:
+                words = line.split()
+                if words[0] == "ENCODING":
+                    cp = int(words[1])
+                elif words[0] == "DWIDTH":
+                    advance = int(words[1])
+                elif words[0] == "BBX":
+                    bbx = tuple(int(v) for v in words[1:5])
+                elif words[0] == "BITMAP":
+                    break
+            w, h, bx, by = bbx
+            rows = [bytes.fromhex(next(lines).strip()) for _ in range(h)]
+            stride = (w + 7) // 8
+            if cp is not None and chr(cp) in chars:
+                data = b"".join(r[:stride].ljust(stride, b"\0") for r in rows)
+                top = ascent - by - h
+                glyphs.append(Glyph(cp, data, w, h, bx, top, advance or w))
+    if ascent is None:
+        raise SystemExit("%s: not a BDF font" % path)
+    return ascent + descent, ascent, glyphs
+
+
+# read_ttf returns (line height, ascent, glyphs) of a TrueType or OpenType font rasterized at
+# size pixels
+def read_ttf(path, size, chars):
+    try:
+        from PIL import ImageFont
+    except ImportError:
+        raise SystemExit("%s: converting this format needs Pillow (pip install pillow)" % path)
+    font = ImageFont.truetype(path, size)
+    ascent, descent = font.getmetrics()
+    glyphs = []
+    for ch in chars:
+        cp = ord(ch)
+        if cp > 0xFFFF:
+            continue
+        left, top, right, bottom = font.getbbox(ch, anchor="ls")
+        w = right - left
+        h = bottom - top
+        stride = (w + 7) // 8
+        data = bytearray(stride * h)
+        if w and h:
+            mask = font.getmask(ch, mode="1", anchor="ls")
+            mw, mh = mask.size
+            for j in range(min(h, mh)):
+                for i in range(min(w, mw)):
+                    if mask.getpixel((i, j)):
+                        data[j * stride + (i >> 3)] |= 0x80 >> (i & 7)
+        advance = int(round(font.getlength(ch)))
+        glyphs.append(Glyph(cp, data, w, h, left, ascent + top, advance))
+    return ascent + descent, ascent, glyphs
+
+
+# read_gfx returns (line height, ascent, glyphs) of a GFX font module
+def read_gfx(path, chars):
+    spec = importlib.util.spec_from_file_location("gfx_font", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    glyphs = []
+    height = 0
+    for name, arr in module.text_dict.items():
+        if len(name) != 1 or name not in chars:
+            continue
+        w, h = arr[0], arr[1]
+        stride = (w + 7) // 8
+        data = bytearray(stride * h)
+        for x in range(w):
+            for y in range(h):
+                if arr[2 + x] & (1 << y):
+                    data[(h - 1 - y) * stride + (x >> 3)] |= 0x80 >> (x & 7)
+        glyphs.append(Glyph(ord(name), data, w, h, 0, 0, w + 1))
+        height = max(height, h)
+    return height, height, glyphs
+
+
+# pack returns the font file for the glyphs, default is the character drawn for missing ones
+def pack(height, ascent, glyphs, default="?"):
+    glyphs = sorted(glyphs, key=lambda g: g.cp)
+    for g in glyphs:
+        if not (0 <= g.w < 256 and 0 <= g.h < 256 and 0 <= g.advance < 256):
+            raise SystemExit("U+%04X: glyph too large" % g.cp)
+        if not (-128 <= g.x < 128 and -128 <= g.y < 128):
+            raise SystemExit("U+%04X: glyph offset too large" % g.cp)
+    if not (0 < height < 256 and 0 <= ascent < 256):
+        raise SystemExit("font too large")
+    index = bytearray()
+    bitmaps = bytearray()
+    for g in glyphs:
+        index += struct.pack(INDEX, g.cp, len(bitmaps), g.x, g.y, g.w, g.h, g.advance)
+        bitmaps += g.data
+    assert len(index) == INDEX_SIZE * len(glyphs)
+    hdr = struct.pack(HEADER, MAGIC, VERSION, height, ascent, 0, ord(default), len(glyphs))
+    return hdr + index + bitmaps
+
+
+def convert(src, dst, size=16, chars=DEFAULT_CHARS):
+    ext = os.path.splitext(src)[1].lower()
+    if ext == ".bdf":
+        height, ascent, glyphs = read_bdf(src, chars)
+    elif ext == ".py":
+        height, ascent, glyphs = read_gfx(src, chars)
+    else:
+        height, ascent, glyphs = read_ttf(src, size, chars)
+    if not glyphs:
+        raise SystemExit("%s: none of the characters are in the font" % src)
+    data = pack(height, ascent, glyphs)
+    with open(dst, "wb") as f:
+        f.write(data)
+    return len(glyphs), len(data)
+
+
+def main(argv):
+    p = argparse.ArgumentParser(description="convert a font to Inkplate's packed font format")
+    p.add_argument("--size", type=int, default=16, help="pixel size for TrueType fonts")
+    p.add_argument("--chars", default=DEFAULT_CHARS, help="characters to keep")
+    p.add_argument("src", help="BDF, TrueType/OpenType or GFX font module (.py)")
+    p.add_argument("dst")
+    args = p.parse_args(argv)
+    n, size = convert(args.src, args.dst, args.size, args.chars)
+    print("%s: %d glyphs, %d bytes" % (args.dst, n, size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,105 @@
+# Packed bitmap fonts for Inkplate.setFont, written by fontconv.py.
+#
+# A font file has a 12 byte header (HEADER: MAGIC, version, line height, ascent, flags, the
+# character drawn for missing ones and the number of glyphs), an index of INDEX entries
+# sorted by character (character, offset of the bitmap, x bearing, y offset, width, height
+# and advance) and the bitmaps, rows MSB first and padded to a byte like drawBitmap takes
+# them. The x bearing is the distance from the pen position to the left of the bitmap, the
+# y offset the distance from the top of the line to the top of the bitmap and the advance
+# how far the pen moves after the character.
+#
+# Only the header and the index are read when a Font is opened, glyph bitmaps are read from
+# the file when they are first drawn (and then kept by the display's GlyphCache). A font can
+# also be given as bytes, e.g. a constant in a frozen module.
+import struct
+
+MAGIC = b"IPFN"
+VERSION = 1
+HEADER = "<4sBBBBHH"
+HEADER_SIZE = 12
+INDEX = "<HIbbBBB"
+INDEX_SIZE = 11
+
+
+class Font:
+    def __init__(self, source):
+        self.path = None  # the file the font was read from, if any
+        if isinstance(source, str):
+            self.path = source
+            self._f = open(source, "rb")
+            self._data = None
+            hdr = self._f.read(HEADER_SIZE)
+        else:
+            self._f = None
+            self._data = memoryview(source)
+            hdr = bytes(self._data[:HEADER_SIZE])
+        if len(hdr) < HEADER_SIZE:
+            raise ValueError("not a font file")
+        magic, version, self.height, self.ascent, _, default, count = struct.unpack(HEADER, hdr)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a font file")
+        n = count * INDEX_SIZE
+        if self._f is not None:
+            self._index = self._f.read(n)
+        else:
+            self._index = bytes(self._data[HEADER_SIZE : HEADER_SIZE + n])
+        self._count = count
+        self._bitmaps = HEADER_SIZE + n
+        self._glyphs = {}  # character -> index entry, see glyph
+        self._default = self._find(default)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+
+    # _find returns the index entry of code point cp, or None if the font doesn't have it
+    def _find(self, cp):
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            entry = struct.unpack_from(INDEX, self._index, mid * INDEX_SIZE)
+            if entry[0] == cp:
+                return entry
+            if entry[0] < cp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    # glyph returns (code point, offset, x bearing, y offset, width, height, advance) of
+    # character ch, the default character if the font doesn't have ch or None if it doesn't
+    # have that either
+    def glyph(self, ch):
+        g = self._glyphs.get(ch)
+        if g is None:
+            g = self._find(ord(ch)) or self._default
+            self._glyphs[ch] = g
+        return g
+
+    # advance returns how far the pen moves for character ch
+    def advance(self, ch):
+        g = self.glyph(ch)
+        return g[6] if g else 0
+
+    # width returns the width of string s
+    def width(self, s):
+        w = 0
+        for ch in s:
+            g = self.glyph(ch)
+            if g:
+                w += g[6]
+        return w
+
+    # bitmap returns (data, width, height) of the bitmap of character ch
+    def bitmap(self, ch):
+        g = self.glyph(ch)
+        if not g:
+            return b"", 0, 0
+        w, h = g[4], g[5]
+        n = (w + 7) // 8 * h
+        start = self._bitmaps + g[1]
+        if self._f is not None:
+            self._f.seek(start)
+            return self._f.read(n), w, h
+        return bytes(self._data[start : start + n]), w, h
@@ -289,7 +289,8 @@ class GFX:
             last = y1
         else:
             last = y1 - 1
-        for y in range(y0, last + 1):
+        y = y0
+        while y <= last:
             a = x0 + sa // dy01
             b = x0 + sb // dy02
             sa += dx01
@@ -297,6 +298,7 @@ class GFX:
             if a > b:
                 a, b = b, a
             self.hline(a, y, b - a + 1, *args, **kwargs)
+            y += 1
         sa = dx12 * (y - y1)
         sb = dx02 * (y - y0)
         while y <= y2:
@@ -0,0 +1,628 @@
+# Streaming image file decoding for Inkplate.drawImageFile.
+#
+# Decoders read an image a batch of rows at a time, convert each row into 8-bit gray
+# (0=black .. 255=white) and hand it to a RowSink, which turns the row into levels of the
+# current display mode and writes it straight into the display's framebuffer. Only a few rows
+# are ever held in memory, so images of any size can be drawn next to the framebuffers.
+#
+# Supported formats:
+# - BMP: 1, 2, 4 and 8 bits per pixel with a palette, 16 (555 or 565), 24 and 32 bits per
+#   pixel, uncompressed, bottom-up or top-down
+# - PNG: 1, 2, 4 and 8-bit gray and palette images, not interlaced. The image data gets
+#   inflated with uzlib as it's read and unfiltered a row at a time, keeping only the
+#   previous row.
+# - JPEG: baseline, gray or YCbCr, optionally scaled down by 2, 4 or 8 while decoding or as a
+#   quick preview from the DC coefficients only (see jpegfile.py, which only gets imported
+#   for JPEG files).
+# - native: rows already packed in the framebuffer format of a display mode, written by
+#   imgconv.py. The file has a 10 byte header (NATIVE_HEADER: NATIVE_MAGIC, version, display
+#   mode, width, height) followed by the rows, each (width + ppb - 1) // ppb bytes long where
+#   ppb is the number of pixels per byte of the mode. When the display is in the same mode
+#   and isn't rotated the rows get read straight into the framebuffer (full width images) or
+#   blitted, otherwise they go through the gray pipeline like any other image.
+#
+# Gray gets reduced to the display's levels by truncation or by dithering, which works on the
+# rows as they stream through (see RowSink).
+import framebuf
+import io
+import micropython
+import struct
+
+D_ROWS = 600
+D_COLS = 800
+
+_BATCH = 4096  # bytes of rows to read from the file at once
+
+NATIVE_MAGIC = b"IPIM"
+NATIVE_VERSION = 1
+NATIVE_HEADER = "<4sBBHH"
+
+# dithering methods
+DITHER_NONE = 0
+DITHER_ORDERED = 1  # 8x8 Bayer matrix
+DITHER_FLOYD_STEINBERG = 2  # error diffusion, keeps one row of errors
+
+# 8x8 Bayer threshold matrix, values 0..63
+_BAYER = bytes(
+    (
+        0, 32, 8, 40, 2, 34, 10, 42,
+        48, 16, 56, 24, 50, 18, 58, 26,
+        12, 44, 4, 36, 14, 46, 6, 38,
+        60, 28, 52, 20, 62, 30, 54, 22,
+        3, 35, 11, 43, 1, 33, 9, 41,
+        51, 19, 59, 27, 49, 17, 57, 25,
+        15, 47, 7, 39, 13, 45, 5, 37,
+        63, 31, 55, 23, 61, 29, 53, 21,
+    )
+)  # fmt: skip
+
+# per display mode (Inkplate.INKPLATE_1BIT, _2BIT, _3BIT): framebuffer format and pixels per
+# byte
+_FORMATS = (framebuf.MONO_HMSB, framebuf.GS2_HMSB, framebuf.GS4_HMSB)
+_PPB = (8, 4, 2)
+
+
+# _translate looks up n bytes of src in table and writes them to dst
+@micropython.viper
+def _translate(src, dst, table, n: int):
+    s = ptr8(src)
+    d = ptr8(dst)
+    t = ptr8(table)
+    i = 0
+    while i < n:
+        d[i] = t[s[i]]
+        i += 1
+
+
+# _reverse reverses the first n bytes of buf in place
+@micropython.viper
+def _reverse(buf, n: int):
+    b = ptr8(buf)
+    i = 0
+    j = n - 1
+    while i < j:
+        t = b[i]
+        b[i] = b[j]
+        b[j] = t
+        i += 1
+        j -= 1
+
+
+# _pack packs n levels (one per byte) into out in the framebuffer format of the display mode
+@micropython.viper
+def _pack(levels, out, n: int, mode: int):
+    s = ptr8(levels)
+    d = ptr8(out)
+    i = 0
+    if mode == 0:  # MONO_HMSB: pixel x in bit x & 7
+        while i < n:
+            d[i >> 3] = 0
+            i += 8
+        i = 0
+        while i < n:
+            d[i >> 3] = d[i >> 3] | (s[i] << (i & 7))
+            i += 1
+    elif mode == 1:  # GS2_HMSB: pixel x in bits 2 * (x & 3)
+        while i < n:
+            d[i >> 2] = 0
+            i += 4
+        i = 0
+        while i < n:
+            d[i >> 2] = d[i >> 2] | (s[i] << ((i & 3) << 1))
+            i += 1
+    else:  # GS4_HMSB: even pixels in the high nibble
+        while i < n:
+            d[i >> 1] = 0
+            i += 2
+        i = 0
+        while i < n:
+            d[i >> 1] = d[i >> 1] | (s[i] << ((~i & 1) << 2))
+            i += 1
+
+
+# _unpack_fb unpacks n pixels of a row in the framebuffer format of the display mode, see _pack
+@micropython.viper
+def _unpack_fb(src, dst, n: int, mode: int):
+    s = ptr8(src)
+    d = ptr8(dst)
+    i = 0
+    while i < n:
+        if mode == 0:
+            d[i] = (s[i >> 3] >> (i & 7)) & 1
+        elif mode == 1:
+            d[i] = (s[i >> 2] >> ((i & 3) << 1)) & 3
+        else:
+            d[i] = (s[i >> 1] >> ((~i & 1) << 2)) & 0xF
+        i += 1
+
+
+# _unpack unpacks n palette indexes of the given number of bits (1, 2, 4 or 8), MSB first
+@micropython.viper
+def _unpack(src, dst, n: int, bits: int):
+    s = ptr8(src)
+    d = ptr8(dst)
+    mask = (1 << bits) - 1
+    i = 0
+    bit = 0
+    while i < n:
+        d[i] = (s[bit >> 3] >> (8 - bits - (bit & 7))) & mask
+        i += 1
+        bit += bits
+
+
+# _ordered quantizes a row of gray with the Bayer matrix row for line y. tables holds gray
+# scaled to 0..top * 32 at 0..255, the output value per level at 256..263, the Bayer matrix
+# with values 0..31 at 264..327 and the top level at 328.
+@micropython.viper
+def _ordered(gray, out, tables, y: int):
+    s = ptr8(gray)
+    d = ptr8(out)
+    t = ptr8(tables)
+    n = int(len(out))
+    top = int(t[328])
+    b = 264 + ((y & 7) << 3)
+    i = 0
+    while i < n:
+        v = (t[s[i]] + t[b + (i & 7)]) >> 5
+        if v > top:
+            v = top
+        d[i] = t[256 + v]
+        i += 1
+
+
+# _floyd_steinberg quantizes a row of gray, diffusing the quantization error to the right
+# and into the next row. errs holds the errors carried into the row, 16 bits per pixel biased
+# by 0x8000, and gets the ones for the next row. tables holds the closest level per gray at
+# 0..255, the gray of each level at 256..263 and the output value per level at 264..271.
+@micropython.viper
+def _floyd_steinberg(gray, out, errs_in, tables):
+    s = ptr8(gray)
+    d = ptr8(out)
+    errs = ptr16(errs_in)
+    t = ptr8(tables)
+    n = int(len(out))
+    right = 0  # error diffused to the right
+    below_left = 0  # next row error of pixel i - 1
+    below = 0  # next row error of pixel i
+    i = 0
+    while i < n:
+        v = int(s[i]) + int(errs[i]) - 0x8000 + right
+        if v < 0:
+            v = 0
+        elif v > 255:
+            v = 255
+        level = int(t[v])
+        d[i] = t[264 + level]
+        e = v - int(t[256 + level])
+        right = (e * 7) >> 4
+        if i > 0:
+            errs[i - 1] = below_left + ((e * 3) >> 4) + 0x8000
+        below_left = below + ((e * 5) >> 4)
+        below = e >> 4
+        i += 1
+    if n > 0:
+        errs[n - 1] = below_left + 0x8000
+
+
+# _unfilter reverses the PNG filter ftype on the n bytes of row cur, prev holds the previous
+# row (unfiltered) and pixels are at most a byte
+@micropython.viper
+def _unfilter(cur, prev, ftype: int, n: int):
+    c = ptr8(cur)
+    p = ptr8(prev)
+    i = 0
+    if ftype == 1:  # sub
+        i = 1
+        while i < n:
+            c[i] = (c[i] + c[i - 1]) & 0xFF
+            i += 1
+    elif ftype == 2:  # up
+        while i < n:
+            c[i] = (c[i] + p[i]) & 0xFF
+            i += 1
+    elif ftype == 3:  # average
+        left = 0
+        while i < n:
+            left = (c[i] + ((left + p[i]) >> 1)) & 0xFF
+            c[i] = left
+            i += 1
+    elif ftype == 4:  # paeth
+        left = 0
+        upleft = 0
+        while i < n:
+            up = int(p[i])
+            pa = up - upleft  # distance of the prediction to left
+            pb = left - upleft  # ... to up
+            pc = pa + pb  # ... to upleft
+            if pa < 0:
+                pa = -pa
+            if pb < 0:
+                pb = -pb
+            if pc < 0:
+                pc = -pc
+            if pa <= pb and pa <= pc:
+                pred = left
+            elif pb <= pc:
+                pred = up
+            else:
+                pred = upleft
+            left = (c[i] + pred) & 0xFF
+            c[i] = left
+            upleft = up
+            i += 1
+
+
+# _bgr_gray converts n pixels of bpp bytes each, stored blue, green, red, to gray
+@micropython.viper
+def _bgr_gray(src, dst, n: int, bpp: int):
+    s = ptr8(src)
+    d = ptr8(dst)
+    i = 0
+    ix = 0
+    while i < n:
+        d[i] = (19 * s[ix] + 183 * s[ix + 1] + 54 * s[ix + 2]) >> 8
+        i += 1
+        ix += bpp
+
+
+# _rgb16_gray converts n 16-bit pixels to gray, the pixels are RGB565 if g6 is set and RGB555
+# otherwise
+@micropython.viper
+def _rgb16_gray(src, dst, n: int, g6: int):
+    s = ptr8(src)
+    d = ptr8(dst)
+    i = 0
+    while i < n:
+        px = s[2 * i] | (s[2 * i + 1] << 8)
+        if g6:
+            r = (px >> 8) & 0xF8
+            g = (px >> 3) & 0xFC
+        else:
+            r = (px >> 7) & 0xF8
+            g = (px >> 2) & 0xF8
+        b = (px << 3) & 0xF8
+        d[i] = (54 * r + 183 * g + 19 * b) >> 8
+        i += 1
+
+
+# RowSink draws rows of gray pixels into the framebuffer of an Inkplate display: row j of a
+# w x h image at x, y ends up at y + j, taking the display mode and rotation into account.
+# Without dithering mono pixels are black below mid-gray and grayscale levels are the top 2 or
+# 3 bits of the gray. Ordered dithering adds a threshold from the Bayer matrix, Floyd-Steinberg
+# carries the errors of the previous row in a buffer of 2 bytes per pixel. Rows that are on
+# screen, unrotated, aligned to framebuffer bytes and a whole number of bytes long get copied
+# into the framebuffer, all others get blitted.
+class RowSink:
+    def __init__(self, display, x, y, w, h, invert=False, dither=DITHER_NONE):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self._height = display.height()
+        mode = display.displayMode
+        self._mode = mode
+        self._fb = display._framebuffer()
+        self._rotation = display.rotation
+        high = self._rotation & 1 and mode == 2
+        self._dither = dither
+        if dither == DITHER_NONE:
+            self._lut = RowSink._levels(mode, invert, high)
+        else:
+            self._tables = RowSink._dither_tables(mode, invert, high, dither)
+            if dither == DITHER_FLOYD_STEINBERG:
+                self._errs = bytearray(b"\x00\x80" * w)  # no errors yet
+        self._row = bytearray(w)  # levels of the current row
+        self._packed = None
+        self._direct = False
+        if self._rotation & 1:
+            # rows turn into columns: a 1 pixel wide framebuffer has a byte per pixel
+            self._rowfb = framebuf.FrameBuffer(self._row, 1, w, _FORMATS[mode])
+        else:
+            ppb = _PPB[mode]
+            self._packed = bytearray((w + ppb - 1) // ppb)
+            self._rowfb = framebuf.FrameBuffer(self._packed, w, 1, _FORMATS[mode])
+            px = x if self._rotation == 0 else D_COLS - x - w
+            if px >= 0 and px + w <= D_COLS and px % ppb == 0 and w % ppb == 0:
+                self._direct = True
+                self._mem = memoryview(self._fb._framebuf)
+        r = display._screen_rect(x, y, w, h)
+        if r is not None:
+            display.ipp.damage(*r)
+
+    # _levels returns the table mapping gray to the levels of a display mode, in the high
+    # nibble if high is set
+    @staticmethod
+    def _levels(mode, invert, high=False):
+        lut = bytearray(256)
+        for g in range(256):
+            v = 255 - g if invert else g
+            if mode == 0:
+                v = 1 if v < 128 else 0
+            elif mode == 1:
+                v >>= 6
+            else:
+                v >>= 5
+            lut[g] = v << 4 if high else v
+        return lut
+
+    # _dither_tables returns the tables for _ordered or _floyd_steinberg
+    @staticmethod
+    def _dither_tables(mode, invert, high, dither):
+        top = (1, 3, 7)[mode]  # highest level, levels go from black to white
+        out = bytearray(8)
+        for k in range(top + 1):
+            v = 1 - k if mode == 0 else k
+            out[k] = v << 4 if high else v
+        if dither == DITHER_ORDERED:
+            t = bytearray(329)
+            for g in range(256):
+                t[g] = (255 - g if invert else g) * top * 32 // 255
+            t[256:264] = out
+            t[264:328] = bytes(b >> 1 for b in _BAYER)
+            t[328] = top
+        else:
+            t = bytearray(272)
+            for g in range(256):
+                t[g] = ((255 - g if invert else g) * top + 127) // 255
+            for k in range(top + 1):
+                v = k * 255 // top
+                t[256 + k] = 255 - v if invert else v
+            t[264:272] = out
+        return t
+
+    # visible returns whether row j ends up on the screen
+    def visible(self, j):
+        return 0 <= self.y + j < self._height
+
+    # below returns whether row j and the ones after it are below the screen
+    def below(self, j):
+        return self.y + j >= self._height
+
+    # row draws row j, gray holds the w pixels of the row
+    def row(self, j, gray):
+        if not self.visible(j):
+            return
+        w = self.w
+        row = self._row
+        if self._dither == DITHER_NONE:
+            _translate(gray, row, self._lut, w)
+        elif self._dither == DITHER_ORDERED:
+            _ordered(gray, row, self._tables, j)
+        else:
+            _floyd_steinberg(gray, row, self._errs, self._tables)
+        self._put(self.y + j, row)
+
+    # _put writes a row of levels to line y of the screen
+    def _put(self, y, row):
+        w = self.w
+        rot = self._rotation
+        if rot == 0 or rot == 2:
+            if rot == 2:
+                _reverse(row, w)
+                y = D_ROWS - 1 - y
+                x = D_COLS - self.x - w
+            else:
+                x = self.x
+            _pack(row, self._packed, w, self._mode)
+            if self._direct:
+                n = len(self._packed)
+                ix = (y * D_COLS + x) // _PPB[self._mode]
+                self._mem[ix : ix + n] = self._packed
+            else:
+                self._fb.blit(self._rowfb, x, y)
+        elif rot == 1:
+            self._fb.blit(self._rowfb, D_COLS - 1 - y, self.x)
+        else:
+            _reverse(row, w)
+            self._fb.blit(self._rowfb, y, D_ROWS - self.x - w)
+
+
+# draw_image draws the image file at path with its top left corner at x, y, dither selects the
+# dithering method (DITHER_*). JPEG files get shrunk by scale (1, 2, 4 or 8) and with preview
+# set only drawn roughly, see jpegfile.py. It returns 1 if the image was drawn and 0 if the
+# file isn't in a supported format.
+def draw_image(display, x, y, path, invert=False, dither=DITHER_NONE, scale=1, preview=False):
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic[0:2] == b"\xff\xd8":
+            import jpegfile
+
+            return jpegfile.draw_jpeg(display, f, x, y, invert, dither, scale, preview)
+        if magic[0:2] == b"BM":
+            return draw_bmp(display, f, x, y, invert, dither)
+        if magic == b"\x89PNG":
+            return draw_png(display, f, x, y, invert, dither)
+        if magic == NATIVE_MAGIC:
+            return draw_native(display, f, x, y, invert, dither)
+    return 0
+
+
+# draw_native draws a native image file, see draw_image
+def draw_native(display, f, x, y, invert=False, dither=DITHER_NONE):
+    hdr = f.read(10)
+    if len(hdr) < 10:
+        return 0
+    magic, version, mode, w, h = struct.unpack(NATIVE_HEADER, hdr)
+    if magic != NATIVE_MAGIC or version != NATIVE_VERSION or mode > 2:
+        return 0
+    ppb = _PPB[mode]
+    stride = (w + ppb - 1) // ppb
+    batch = max(1, _BATCH // stride)
+
+    if mode != display.displayMode or display.rotation or invert or dither:
+        # different mode or rotated: convert the levels to gray and use a RowSink
+        gray = bytearray(256)
+        top = (1, 3, 7)[mode]
+        for v in range(16):
+            g = 255 * min(v, top) // top
+            gray[v] = 255 - g if mode == 0 else g
+        sink = RowSink(display, x, y, w, h, invert, dither)
+        buf = bytearray(stride)
+        row = bytearray(w)
+        for j in range(h):
+            f.readinto(buf)
+            if sink.visible(j):
+                _unpack_fb(buf, row, w, mode)
+                _translate(row, row, gray, w)
+                sink.row(j, row)
+        return 1
+
+    r = display._screen_rect(x, y, w, h)
+    if r is None:
+        return 1
+    display.ipp.damage(*r)
+    j0 = max(0, -y)  # first and last + 1 row on the screen
+    j1 = min(h, D_ROWS - y)
+    fb = display._framebuffer()
+    f.seek(10 + j0 * stride)
+    if x == 0 and w == D_COLS:
+        # the rows are laid out exactly like the framebuffer's: read them all in one go
+        f.readinto(memoryview(fb._framebuf)[(y + j0) * stride : (y + j1) * stride])
+        return 1
+    buf = bytearray(stride * batch)
+    mv = memoryview(buf)
+    j = j0
+    while j < j1:
+        k = min(batch, j1 - j)
+        f.readinto(mv[: stride * k])
+        fb.blit(framebuf.FrameBuffer(buf, w, k, _FORMATS[mode]), x, y + j)
+        j += k
+    return 1
+
+
+# draw_bmp draws a BMP file, see draw_image
+def draw_bmp(display, f, x, y, invert=False, dither=DITHER_NONE):
+    hdr = f.read(54)
+    if len(hdr) < 54 or hdr[0:2] != b"BM":
+        return 0
+    data_start, hdr_size, w, h, _, depth, comp = struct.unpack_from("<IIiiHHI", hdr, 10)
+    ncolors = struct.unpack_from("<I", hdr, 46)[0]
+    top_down = h < 0
+    h = -h if top_down else h
+    if w <= 0 or depth not in (1, 2, 4, 8, 16, 24, 32) or comp not in (0, 3):
+        return 0
+
+    # 16-bit pixels are RGB555 unless the bitfields say RGB565
+    g6 = 0
+    if depth == 16 and comp == 3:
+        f.seek(54)
+        g6 = int(struct.unpack("<I", f.read(4))[0] == 0xF800)
+
+    # palette index -> gray
+    palette = None
+    if depth <= 8:
+        palette = bytearray(256)
+        f.seek(14 + hdr_size)
+        p = f.read(4 * (ncolors or 1 << depth))
+        for i in range(len(p) // 4):
+            palette[i] = (19 * p[4 * i] + 183 * p[4 * i + 1] + 54 * p[4 * i + 2]) >> 8
+
+    sink = RowSink(display, x, y, w, h, invert, dither)
+    row_size = (depth * w + 31) // 32 * 4
+    batch = max(1, _BATCH // row_size)
+    buf = bytearray(row_size * batch)
+    mv = memoryview(buf)
+    gray = bytearray(w)
+    f.seek(data_start)
+    r = 0
+    while r < h:
+        k = min(batch, h - r)
+        f.readinto(mv[: row_size * k])
+        for b in range(k):
+            j = r if top_down else h - 1 - r
+            r += 1
+            if not sink.visible(j):
+                continue
+            src = mv[b * row_size : (b + 1) * row_size]
+            if depth == 24 or depth == 32:
+                _bgr_gray(src, gray, w, depth >> 3)
+            elif depth == 16:
+                _rgb16_gray(src, gray, w, g6)
+            else:
+                _unpack(src, gray, w, depth)
+                _translate(gray, gray, palette, w)
+            sink.row(j, gray)
+    return 1
+
+
+# _IDATStream reads the image data of a PNG file, which may be split into several IDAT chunks,
+# as one stream for uzlib.DecompIO
+class _IDATStream(io.IOBase):
+    def __init__(self, f, length):
+        self._f = f
+        self._left = length  # bytes left in the current chunk
+
+    def readinto(self, buf):
+        f = self._f
+        while self._left == 0:
+            f.read(4)  # CRC of the previous chunk
+            hdr = f.read(8)
+            if len(hdr) < 8 or hdr[4:8] != b"IDAT":
+                return 0
+            self._left = struct.unpack_from(">I", hdr)[0]
+        n = min(len(buf), self._left)
+        n = f.readinto(memoryview(buf)[:n])
+        self._left -= n
+        return n
+
+
+# draw_png draws a PNG file, see draw_image
+def draw_png(display, f, x, y, invert=False, dither=DITHER_NONE):
+    from uzlib import DecompIO
+
+    if f.read(8) != b"\x89PNG\r\n\x1a\n":
+        return 0
+    w = h = depth = 0
+    palette = None
+    while True:
+        hdr = f.read(8)
+        if len(hdr) < 8:
+            return 0
+        length = struct.unpack_from(">I", hdr)[0]
+        kind = hdr[4:8]
+        if kind == b"IHDR":
+            w, h, depth, ctype, _, _, interlace = struct.unpack(">IIBBBBB", f.read(13))
+            if ctype not in (0, 3) or depth > 8 or interlace:
+                return 0
+            # sample -> gray, for palette images once PLTE has been read
+            palette = bytearray(256)
+            top = (1 << depth) - 1
+            for v in range(top + 1):
+                palette[v] = v * 255 // top
+        elif kind == b"PLTE":
+            p = f.read(length)
+            for i in range(length // 3):
+                palette[i] = (54 * p[3 * i] + 183 * p[3 * i + 1] + 19 * p[3 * i + 2]) >> 8
+        elif kind == b"IDAT":
+            break
+        else:
+            f.seek(length, 1)
+        f.read(4)  # CRC
+    if palette is None:
+        return 0
+
+    sink = RowSink(display, x, y, w, h, invert, dither)
+    stride = (w * depth + 7) >> 3
+    z = DecompIO(_IDATStream(f, length), 15)
+    # two-row window: each holds the filter type followed by the row
+    cur = bytearray(stride + 1)
+    prev = bytearray(stride + 1)
+    gray = bytearray(w)
+    for j in range(h):
+        if sink.below(j):
+            break
+        mv = memoryview(cur)
+        n = 0
+        while n < stride + 1:
+            k = z.readinto(mv[n:])
+            if not k:
+                return 1  # truncated file
+            n += k
+        _unfilter(mv[1:], memoryview(prev)[1:], cur[0], stride)
+        if sink.visible(j):
+            _unpack(mv[1:], gray, w, depth)
+            _translate(gray, gray, palette, w)
+            sink.row(j, gray)
+        cur, prev = prev, cur
+    return 1
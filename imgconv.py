@@ -0,0 +1,134 @@
+# Converts images into the native format Inkplate.drawImageFile loads without any per-pixel
+# work (see imagefile.py). Runs on the host with CPython:
+#
+#   python3 imgconv.py img/hello_world.jpg hello_world.ipi
+#   python3 imgconv.py --mode 0 --dither fs photo.bmp photo.ipi
+#
+# The image is drawn with the driver's own decoders on the inkplate_sim simulator, so the
+# result is exactly what drawImageFile would produce on the board, and then the rows get
+# saved as packed by the framebuffer. BMP files, gray or palette PNG files and baseline JPEG
+# files (shrunk by 2, 4 or 8 to fit the screen) are read directly, other formats (e.g.
+# progressive JPEG) need Pillow, which also shrinks images to fit the screen.
+import argparse
+import os
+import struct
+import sys
+import tempfile
+
+import inkplate_sim
+
+inkplate_sim.install()
+
+import imagefile  # noqa: E402
+from inkplate import D_COLS, D_ROWS, Inkplate  # noqa: E402
+
+DITHERS = {
+    "none": imagefile.DITHER_NONE,
+    "ordered": imagefile.DITHER_ORDERED,
+    "fs": imagefile.DITHER_FLOYD_STEINBERG,
+}
+
+
+# _jpeg_size returns the width and height of a baseline JPEG file, or None if it's any other
+# kind of JPEG
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        m = f.read(4)
+        if len(m) < 4 or m[0] != 0xFF or m[1] == 0xDA:
+            return None
+        if m[1] in (0xC0, 0xC1):
+            h, w = struct.unpack(">xHH", f.read(5))
+            return w, h
+        if 0xC2 <= m[1] <= 0xCF and m[1] not in (0xC4, 0xC8, 0xCC):
+            return None
+        f.seek(struct.unpack_from(">H", m, 2)[0] - 2, 1)
+
+
+# _readable returns (path, width, height, scale) of a file imagefile can read for the image at
+# path, converting it to a BMP in a temporary file if necessary. JPEG files get shrunk by scale
+# when they're drawn.
+def _readable(path):
+    with open(path, "rb") as f:
+        head = f.read(29)
+        size = _jpeg_size(f) if head[0:2] == b"\xff\xd8" else None
+    if head[0:2] == b"BM":
+        w, h = struct.unpack_from("<ii", head, 18)
+        return path, w, abs(h), 1
+    if head[0:4] == b"\x89PNG" and head[25] in (0, 3) and head[24] <= 8 and not head[28]:
+        w, h = struct.unpack_from(">II", head, 16)
+        return path, w, h, 1
+    if size:
+        w, h = size
+        scale = 1
+        while scale < 8 and (w > D_COLS * scale or h > D_ROWS * scale):
+            scale *= 2
+        return path, (w + scale - 1) // scale, (h + scale - 1) // scale, scale
+    try:
+        from PIL import Image
+    except ImportError:
+        raise SystemExit("%s: converting this format needs Pillow (pip install pillow)" % path)
+    im = Image.open(path).convert("L")
+    im.thumbnail((D_COLS, D_ROWS))
+    fd, tmp = tempfile.mkstemp(suffix=".bmp")
+    with os.fdopen(fd, "wb") as f:
+        im.save(f, "BMP")
+    return tmp, im.width, im.height, 1
+
+
+# convert writes the image at src as a native image for a display mode to dst, the image gets
+# cropped to the screen
+def convert(src, dst, mode=Inkplate.INKPLATE_2BIT, dither=imagefile.DITHER_NONE, invert=False):
+    path, w, h, scale = _readable(src)
+    try:
+        display = Inkplate(mode)
+        display.begin()
+        display.clearDisplay()
+        if not display.drawImageFile(0, 0, path, invert, dither, scale):
+            raise SystemExit("%s: unsupported image" % src)
+    finally:
+        if path != src:
+            os.remove(path)
+    w = min(w, D_COLS)
+    h = min(h, D_ROWS)
+    ppb = (8, 4, 2)[mode]
+    stride = (w + ppb - 1) // ppb
+    fb = display._framebuffer()._framebuf
+    with open(dst, "wb") as f:
+        f.write(
+            struct.pack(
+                imagefile.NATIVE_HEADER,
+                imagefile.NATIVE_MAGIC,
+                imagefile.NATIVE_VERSION,
+                mode,
+                w,
+                h,
+            )
+        )
+        for j in range(h):
+            ix = j * (D_COLS // ppb)
+            f.write(fb[ix : ix + stride])
+    return w, h
+
+
+def main(argv):
+    p = argparse.ArgumentParser(description="convert an image to Inkplate's native format")
+    p.add_argument(
+        "--mode",
+        type=int,
+        default=Inkplate.INKPLATE_2BIT,
+        choices=(Inkplate.INKPLATE_1BIT, Inkplate.INKPLATE_2BIT, Inkplate.INKPLATE_3BIT),
+        help="display mode: 0=1-bit, 1=2-bit (default), 2=3-bit",
+    )
+    p.add_argument("--dither", choices=sorted(DITHERS), default="none")
+    p.add_argument("--invert", action="store_true")
+    p.add_argument("src")
+    p.add_argument("dst")
+    args = p.parse_args(argv)
+    w, h = convert(args.src, args.dst, args.mode, DITHERS[args.dither], args.invert)
+    print("%s: %dx%d, %d bytes" % (args.dst, w, h, os.path.getsize(args.dst)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
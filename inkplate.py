@@ -10,6 +10,16 @@ from micropython import const
 
 from gfx import GFX
 from gfx_standard_font_01 import text_dict as std_font
+from text import gfx_glyphs, measure
+from waveform import (
+    MODE_GS2,
+    MODE_GS3,
+    MODE_MONO,
+    MODE_PARTIAL,
+    MODE_PARTIAL_GS2,
+    WAVEFORM_FILE,
+    Waveforms,
+)
 
 TPS65186_addr = const(0x48)  # I2C address
 
@@ -35,9 +45,28 @@ EPD_SPH = const(0x00000002)  # in W1Tx1
 D_ROWS = const(600)
 D_COLS = const(800)
 
+# Clean profiles: the (pattern, repetitions) sequences written to the whole screen before a full
+# refresh to erase the previous image, see _Inkplate.clean for the patterns. "full" leaves the
+# least ghosting, "quick" takes a fifth of the frames and "none" draws over the old image.
+CLEAN_PROFILES = {
+    "full": ((0, 1), (1, 12), (2, 1), (0, 11), (2, 1), (1, 12), (2, 1), (0, 11)),
+    "quick": ((0, 1), (1, 4), (2, 1), (0, 4)),
+    "none": (),
+}
+
+# Encoding modes for InkplateMono.display, see InkplateMono.encode
+ENCODE_OFF = const(0)  # look up every nibble while sending, no extra memory
+ENCODE_ROW = const(1)  # encode rows into a staging buffer, reused while rows repeat
+ENCODE_FRAME = const(2)  # encode whole frames once and replay them for repeated phases
+
 # Inkplate provides access to the pins of the Inkplate 6 as well as to low-level display
 # functions.
 class _Inkplate:
+    waveforms = Waveforms()  # waveform tables, replaced by Inkplate.begin() if a file is found
+    _temperature = None  # panel temperature in degrees C, measured by power_on
+    clean_profile = "full"  # clean profile used by full refreshes, see CLEAN_PROFILES
+    stats = {}  # refresh timings, see record()
+
     @classmethod
     def init(cls, i2c):
         cls._i2c = i2c
@@ -86,7 +115,17 @@ class _Inkplate:
     # _tps65186_read reads an 8-bit value from a register
     @classmethod
     def _tps65186_read(cls, reg):
-        cls._i2c.readfrom_mem(TPS65186_addr, reg, 1)[0]
+        return cls._i2c.readfrom_mem(TPS65186_addr, reg, 1)[0]
+
+    # read_temperature has the TPS65186 measure the panel temperature (TMST1 register) and
+    # stores the result (TMST_VALUE register, signed degrees C) in _temperature
+    @classmethod
+    def read_temperature(cls):
+        cls._tps65186_write(0x0D, 0x80)
+        time.sleep_ms(2)
+        t = cls._tps65186_read(0x00)
+        cls._temperature = t - 256 if t > 127 else t
+        return cls._temperature
 
     # power_on turns the voltage regulator on and wakes up the display (GMODE and OE)
     @classmethod
@@ -101,9 +140,7 @@ class _Inkplate:
         # enable all rails
         cls._tps65186_write(0x01, 0x3F)  # ???
         time.sleep_ms(40)
-        cls._tps65186_write(0x0D, 0x80)  # ???
-        time.sleep_ms(2)
-        cls._temperature = cls._tps65186_read(1)
+        cls.read_temperature()
         # wake-up display
         cls.EPD_GMODE(1)
         cls.EPD_OE(1)
@@ -220,46 +257,72 @@ class _Inkplate:
             cls.vscan_start()
             cls.fill_screen(data)
 
+    # run_clean runs the clean sequence of a profile (None: the default one) and returns
+    # the number of frames it wrote
+    @classmethod
+    def run_clean(cls, profile=None):
+        n = 0
+        for patt, rep in CLEAN_PROFILES[profile or cls.clean_profile]:
+            cls.clean(patt, rep)
+            n += rep
+        return n
+
+    # record adds the timings of a refresh to stats. The key is "<mode>/<clean profile>", e.g.
+    # "mono/quick", or "partial", and each entry holds the number of refreshes, the frames
+    # and milliseconds of the last clean and draw, and the total milliseconds of all of them.
+    @classmethod
+    def record(cls, key, clean_frames, clean_ms, draw_frames, draw_ms):
+        s = cls.stats.get(key)
+        if s is None:
+            s = cls.stats[key] = {"count": 0, "clean_total_ms": 0, "draw_total_ms": 0}
+        s["count"] += 1
+        s["clean_frames"] = clean_frames
+        s["clean_ms"] = clean_ms
+        s["draw_frames"] = draw_frames
+        s["draw_ms"] = draw_ms
+        s["clean_total_ms"] += clean_ms
+        s["draw_total_ms"] += draw_ms
+
 
 class InkplateMono(framebuf.FrameBuffer):
-    def __init__(self):
+    _frame_words = None  # encoded frame for ENCODE_FRAME, shared until released
+
+    # encode selects how rows get turned into gpio words, ENCODE_FRAME needs 480KB and falls
+    # back to ENCODE_ROW if that can't be allocated
+    def __init__(self, encode=ENCODE_ROW):
         self._framebuf = bytearray(D_ROWS * D_COLS // 8)
         super().__init__(self._framebuf, D_COLS, D_ROWS, framebuf.MONO_HMSB)
-        ip = InkplateMono
-        ip._gen_luts()
-        ip._wave = [
-            ip.lut_blk,
-            ip.lut_blk,
-            ip.lut_blk,
-            ip.lut_blk,
-            ip.lut_blk,
-            ip.lut_bw,
-        ]
-
-    # gen_luts generates the look-up tables to convert a nibble (4 bits) of pixels to the
-    # 32-bits that need to be pushed into the gpio port.
-    # The LUTs used here were copied from the e-Radionica Inkplate-6-Arduino-library.
+        self.encode = encode
+        # staging buffer for one row: the gpio words followed by the framebuffer row they hold
+        self._row_words = bytearray(4 * (D_COLS >> 2) + (D_COLS >> 3))
+        InkplateMono._set_wave(_Inkplate.waveforms.select(MODE_MONO, _Inkplate._temperature))
+
+    _phases = None  # waveform table _wave was generated from
+
+    # _set_wave generates the look-up tables for a waveform table (see waveform.py), one per
+    # phase. Each LUT converts a nibble (4 bits) of pixels to the 32-bits that need to be
+    # pushed into the gpio port. Phases with the same codes share a LUT, which display()
+    # relies on to spot repeated phases.
     @classmethod
-    def _gen_luts(cls):
-        b16 = bytes(4 * 16)  # is there a better way to init an array with 16 words???
-        cls.lut_wht = array("L", b16)  # bits to ship to gpio to make pixels white
-        cls.lut_blk = array("L", b16)  # bits to ship to gpio to make pixels black
-        cls.lut_bw = array(
-            "L", b16
-        )  # bits to ship to gpio to make pixels black and white
-        for i in range(16):
-            wht = 0
-            blk = 0
-            bw = 0
-            # display uses 2 bits per pixel: 00=discharge, 01=black, 10=white, 11=skip
-            for bit in range(4):
-                wht = wht | ((2 if (i >> bit) & 1 == 0 else 3) << (2 * bit))
-                blk = blk | ((1 if (i >> bit) & 1 == 1 else 3) << (2 * bit))
-                bw = bw | ((1 if (i >> bit) & 1 == 1 else 2) << (2 * bit))
-            cls.lut_wht[i] = _Inkplate.byte2gpio[wht] | EPD_CL
-            cls.lut_blk[i] = _Inkplate.byte2gpio[blk] | EPD_CL
-            cls.lut_bw[i] = _Inkplate.byte2gpio[bw] | EPD_CL
-        # print("Black: %08x, White:%08x Data:%08x" % (cls.lut_bw[0xF], cls.lut_bw[0], EPD_DATA))
+    def _set_wave(cls, phases):
+        if phases is cls._phases:
+            return
+        luts = {}
+        wave = []
+        for codes in phases:
+            codes = tuple(codes)
+            if codes not in luts:
+                lut = array("L", bytes(4 * 16))
+                for i in range(16):
+                    # display uses 2 bits per pixel: 00=discharge, 01=black, 10=white, 11=skip
+                    v = 0
+                    for bit in range(4):
+                        v |= codes[(i >> bit) & 1] << (2 * bit)
+                    lut[i] = _Inkplate.byte2gpio[v] | EPD_CL
+                luts[codes] = lut
+            wave.append(luts[codes])
+        cls._wave = wave
+        cls._phases = phases
 
     # _send_row writes a row of data to the display
     @micropython.viper
@@ -295,45 +358,155 @@ class InkplateMono(framebuf.FrameBuffer):
             # w1tc0[0] = EPD_CL
             w1tc0[0] = off
 
-    # display_mono sends the monochrome buffer to the display, clearing it first
-    def display(self):
+    # _encode_row converts a row of the framebuffer into the 200 gpio words to send, in the
+    # order they get sent. The source bytes are kept after the words and the encoding is
+    # skipped if they didn't change since the last call, the caller has to make them differ
+    # to force an encoding (e.g. because the LUT changed).
+    # Returns 1 if the row was encoded, 0 if the words were reused.
+    @micropython.viper
+    @staticmethod
+    def _encode_row(lut_in, framebuf, row: int, words_in) -> int:
+        fb32 = ptr32(framebuf)
+        words = ptr32(words_in)
+        sx = int(D_COLS >> 2)  # index of the source bytes in words
+        ix = int(row * (D_COLS >> 5))
+        i = 0
+        while i < (D_COLS >> 5):
+            if fb32[ix + i] != words[sx + i]:
+                break
+            i += 1
+        if i == (D_COLS >> 5):
+            return 0
+        for i in range(D_COLS >> 5):
+            words[sx + i] = fb32[ix + i]
+        src = ptr8(words_in)
+        lut = ptr32(lut_in)
+        ix = int(D_COLS + (D_COLS >> 3) - 1)
+        wix = 0
+        while ix >= D_COLS:
+            data = int(src[ix])
+            words[wix] = lut[data >> 4]
+            words[wix + 1] = lut[data & 0xF]
+            wix += 2
+            ix -= 1
+        return 1
+
+    # _encode_frame converts the whole framebuffer into gpio words, row r starting at word
+    # r * 200
+    @micropython.viper
+    @staticmethod
+    def _encode_frame(lut_in, framebuf, words_in):
+        fb = ptr8(framebuf)
+        lut = ptr32(lut_in)
+        words = ptr32(words_in)
+        wix = 0
+        for row in range(D_ROWS):
+            ix = int(row * (D_COLS >> 3) + 99)
+            end = ix - (D_COLS >> 3)
+            while ix > end:
+                data = int(fb[ix])
+                words[wix] = lut[data >> 4]
+                words[wix + 1] = lut[data & 0xF]
+                wix += 2
+                ix -= 1
+
+    # _send_words writes a row of pre-encoded gpio words to the display, it sends exactly
+    # what _send_row would send for the same data
+    @micropython.viper
+    @staticmethod
+    def _send_words(words_in, wix: int):
+        # cache vars into locals
+        w1ts0 = ptr32(int(ESP32_GPIO + 4 * W1TS0))
+        w1tc0 = ptr32(int(ESP32_GPIO + 4 * W1TC0))
+        off = int(EPD_DATA | EPD_CL)  # mask with all data bits and clock bit
+        words = ptr32(words_in)
+        end = wix + (D_COLS >> 2)
+        # send first byte
+        w1tc0[0] = off
+        w1tc0[W1TC1 - W1TC0] = EPD_SPH
+        w1ts0[0] = words[wix]  # set data bits and assert clock
+        w1tc0[0] = off  # clear data bits as well ready for next byte
+        w1ts0[W1TS1 - W1TS0] = EPD_SPH
+        w1ts0[0] = words[wix + 1]
+        w1tc0[0] = off
+        wix += 2
+        # send the remaining bytes (792 pixels)
+        while wix < end:
+            w1ts0[0] = words[wix]
+            w1tc0[0] = off
+            wix += 1
+
+    # _frame_buffer returns the buffer for ENCODE_FRAME, allocating it on first use. If there
+    # isn't enough memory it switches to ENCODE_ROW and returns None.
+    def _frame_buffer(self):
+        if InkplateMono._frame_words is None:
+            try:
+                InkplateMono._frame_words = bytearray(4 * D_ROWS * (D_COLS >> 2))
+            except MemoryError:
+                self.encode = ENCODE_ROW
+        return InkplateMono._frame_words
+
+    # release frees the buffer of ENCODE_FRAME, it gets allocated again by the next display
+    # that uses it
+    @staticmethod
+    def release():
+        InkplateMono._frame_words = None
+
+    # display_mono sends the monochrome buffer to the display, clearing it first using a clean
+    # profile (None: _Inkplate.clean_profile)
+    def display(self, clean=None):
         ip = _Inkplate
         ip.power_on()
+        InkplateMono._set_wave(ip.waveforms.select(MODE_MONO, ip._temperature))
 
         # clean the display
+        clean = clean or ip.clean_profile
         t0 = time.ticks_ms()
-        ip.clean(0, 1)
-        ip.clean(1, 12)
-        ip.clean(2, 1)
-        ip.clean(0, 11)
-        ip.clean(2, 1)
-        ip.clean(1, 12)
-        ip.clean(2, 1)
-        ip.clean(0, 11)
+        nc = ip.run_clean(clean)
 
         # the display gets written N times
         t1 = time.ticks_ms()
         n = 0
         send_row = InkplateMono._send_row
+        send_words = InkplateMono._send_words
         vscan_write = ip.vscan_write
         fb = self._framebuf
-        for lut in self._wave:
+        frame = self._frame_buffer() if self.encode == ENCODE_FRAME else None
+        encoded = None  # LUT the frame buffer currently holds
+        wave = self._wave
+        for lut in wave:
             ip.vscan_start()
             # write all rows
             r = D_ROWS - 1
-            while r >= 0:
-                send_row(lut, fb, r)
-                vscan_write()
-                r -= 1
+            if frame is not None and (lut is encoded or lut in wave[n + 1 :]):
+                # phase gets repeated: encode the whole frame once and replay it
+                if lut is not encoded:
+                    InkplateMono._encode_frame(lut, fb, frame)
+                    encoded = lut
+                while r >= 0:
+                    send_words(frame, r * (D_COLS >> 2))
+                    vscan_write()
+                    r -= 1
+            elif self.encode == ENCODE_ROW:
+                encode_row = InkplateMono._encode_row
+                words = self._row_words
+                # new LUT, make the staging buffer stale
+                words[D_COLS] = fb[r * (D_COLS >> 3)] ^ 0xFF
+                while r >= 0:
+                    encode_row(lut, fb, r, words)
+                    send_words(words, 0)
+                    vscan_write()
+                    r -= 1
+            else:
+                while r >= 0:
+                    send_row(lut, fb, r)
+                    vscan_write()
+                    r -= 1
             n += 1
 
         t2 = time.ticks_ms()
-        tc = time.ticks_diff(t1, t0)
-        td = time.ticks_diff(t2, t1)
-        tt = time.ticks_diff(t2, t0)
-        print(
-            "Mono: clean %dms (%dms ea), draw %dms (%dms ea), total %dms"
-            % (tc, tc // (4 + 22 + 24), td, td // len(self._wave), tt)
+        ip.record(
+            "mono/" + clean, nc, time.ticks_diff(t1, t0), n, time.ticks_diff(t2, t1)
         )
 
         ip.clean(2, 2)
@@ -352,33 +525,31 @@ class InkplateMono(framebuf.FrameBuffer):
 class InkplateGS2(framebuf.FrameBuffer):
     _wave = None
 
+    _phases = None  # waveform table _wave was generated from
+
     def __init__(self):
         self._framebuf = bytearray(D_ROWS * D_COLS // 4)
         super().__init__(self._framebuf, D_COLS, D_ROWS, framebuf.GS2_HMSB)
-        if not InkplateGS2._wave:
-            InkplateGS2._gen_wave()
-
-    # _gen_wave generates the waveform table. The table consists of N phases or steps during
-    # each of which the entire display gets written. The array in each phase gets indexed with
-    # a nibble of data and contains the 32-bits that need to be pushed into the gpio port.
-    # The waveform used here was adapted from the e-Radionica Inkplate-6-Arduino-library
-    # by taking colors 0 (black), 3, 5, and 7 (white) from "waveform3Bit[8][7]".
+        InkplateGS2._gen_wave(_Inkplate.waveforms.select(MODE_GS2, _Inkplate._temperature))
+
+    # _gen_wave generates the waveform LUTs from a waveform table (see waveform.py). The table
+    # consists of N phases or steps during each of which the entire display gets written. The
+    # array in each phase gets indexed with a nibble of data and contains the bits that need to
+    # be pushed into the gpio port, to be mapped through byte2gpio.
     @classmethod
-    def _gen_wave(cls):
+    def _gen_wave(cls, phases):
+        if phases is cls._phases:
+            return
+
         # genlut generates the lookup table that maps a nibble (2 pixels, 4 bits) to a 32-bit
         # word to push into the GPIO port
+        # op order: blk, dk-grey, light-grey, white
+        # op value: 0=dischg, 1=black, 2=white, 3=skip
         def genlut(op):
             return bytes([op[j] | op[i] << 2 for i in range(4) for j in range(4)])
 
-        cls._wave = [
-            genlut([0, 0, 0, 0]),  # order: blk, dk-grey, light-grey, white
-            genlut([0, 0, 0, 0]),  # value: 0=dischg, 1=black, 2=white, 3=skip
-            genlut([0, 1, 1, 0]),
-            genlut([0, 1, 1, 0]),
-            genlut([1, 2, 1, 0]),
-            genlut([1, 1, 2, 0]),
-            genlut([1, 2, 2, 2]),
-        ]
+        cls._wave = [genlut(op) for op in phases]
+        cls._phases = phases
 
     # _send_row writes a row of data to the display
     @micropython.viper
@@ -411,21 +582,17 @@ class InkplateGS2(framebuf.FrameBuffer):
             # w1tc0[0] = EPD_CL
             w1tc0[0] = off
 
-    # display_mono sends the monochrome buffer to the display, clearing it first
-    def display(self):
+    # display sends the grayscale buffer to the display, clearing it first using a clean
+    # profile (None: _Inkplate.clean_profile)
+    def display(self, clean=None):
         ip = _Inkplate
         ip.power_on()
+        InkplateGS2._gen_wave(ip.waveforms.select(MODE_GS2, ip._temperature))
 
         # clean the display
+        clean = clean or ip.clean_profile
         t0 = time.ticks_ms()
-        ip.clean(0, 1)
-        ip.clean(1, 12)
-        ip.clean(2, 1)
-        ip.clean(0, 11)
-        ip.clean(2, 1)
-        ip.clean(1, 12)
-        ip.clean(2, 1)
-        ip.clean(0, 11)
+        nc = ip.run_clean(clean)
 
         # the display gets written N times
         t1 = time.ticks_ms()
@@ -444,12 +611,8 @@ class InkplateGS2(framebuf.FrameBuffer):
             n += 1
 
         t2 = time.ticks_ms()
-        tc = time.ticks_diff(t1, t0)
-        td = time.ticks_diff(t2, t1)
-        tt = time.ticks_diff(t2, t0)
-        print(
-            "GS2: clean %dms (%dms ea), draw %dms (%dms ea), total %dms"
-            % (tc, tc // (4 + 22 + 24), td, td // len(InkplateGS2._wave), tt)
+        ip.record(
+            "gs2/" + clean, nc, time.ticks_diff(t1, t0), n, time.ticks_diff(t2, t1)
         )
 
         ip.clean(2, 1)  # ??
@@ -464,81 +627,280 @@ class InkplateGS2(framebuf.FrameBuffer):
         #    fb[ix] = 0xFF
 
 
+# Inkplate display with 3 bits of gray scale (8 levels). The framebuffer uses 4 bits per pixel
+# (GS4_HMSB, the left pixel of a byte is in the high nibble) with levels 0=black .. 7=white,
+# larger values are shown as white.
+class InkplateGS3(framebuf.FrameBuffer):
+    _wave = None
+
+    _phases = None  # waveform table _wave was generated from
+
+    def __init__(self):
+        self._framebuf = bytearray(D_ROWS * D_COLS // 2)
+        super().__init__(self._framebuf, D_COLS, D_ROWS, framebuf.GS4_HMSB)
+        InkplateGS3._gen_wave(_Inkplate.waveforms.select(MODE_GS3, _Inkplate._temperature))
+
+    # _gen_wave generates the waveform LUTs from a waveform table (see waveform.py). Each
+    # framebuffer byte holds 2 pixels and a byte sent to the display holds 4, so the LUT of a
+    # phase has 512 entries: the first 256 map a framebuffer byte to the GPIO bits of the
+    # first two pixels of a display byte, the last 256 to those of the last two pixels plus
+    # the clock bit. byte2gpio maps each data bit on its own, so _send_row only has to OR an
+    # entry from each half together.
+    @classmethod
+    def _gen_wave(cls, phases):
+        if phases is cls._phases:
+            return
+        luts = {}
+        wave = []
+        for codes in phases:
+            codes = tuple(codes)
+            if codes not in luts:
+                lut = array("L", bytes(4 * 512))
+                b2g = _Inkplate.byte2gpio
+                for b in range(256):
+                    # op value: 0=dischg, 1=black, 2=white, 3=skip
+                    v = codes[min(b >> 4, 7)] | codes[min(b & 0xF, 7)] << 2
+                    lut[b] = b2g[v]
+                    lut[256 + b] = b2g[v << 4] | EPD_CL
+                luts[codes] = lut
+            wave.append(luts[codes])
+        cls._wave = wave
+        cls._phases = phases
+
+    # _send_row writes a row of data to the display
+    @micropython.viper
+    @staticmethod
+    def _send_row(lut_in, framebuf, row: int):
+        # cache vars into locals
+        w1ts0 = ptr32(int(ESP32_GPIO + 4 * W1TS0))
+        w1tc0 = ptr32(int(ESP32_GPIO + 4 * W1TC0))
+        off = int(EPD_DATA | EPD_CL)  # mask with all data bits and clock bit
+        fb = ptr8(framebuf)
+        ix = int(row * 400 + 398)  # index into framebuffer of the last 4 pixels
+        lut = ptr32(lut_in)
+        # send first byte
+        data = lut[fb[ix]] | lut[256 + int(fb[ix + 1])]
+        ix -= 2
+        w1tc0[0] = off
+        w1tc0[W1TC1 - W1TC0] = EPD_SPH
+        w1ts0[0] = data  # set data bits and clock
+        w1tc0[0] = off  # clear data bits as well ready for next byte
+        w1ts0[W1TS1 - W1TS0] = EPD_SPH
+        # send the remaining bytes (796 pixels)
+        for c in range(199):
+            data = lut[fb[ix]] | lut[256 + int(fb[ix + 1])]
+            ix -= 2
+            w1ts0[0] = data
+            w1tc0[0] = off
+
+    # display sends the grayscale buffer to the display, clearing it first using a clean
+    # profile (None: _Inkplate.clean_profile)
+    def display(self, clean=None):
+        ip = _Inkplate
+        ip.power_on()
+        InkplateGS3._gen_wave(ip.waveforms.select(MODE_GS3, ip._temperature))
+
+        # clean the display
+        clean = clean or ip.clean_profile
+        t0 = time.ticks_ms()
+        nc = ip.run_clean(clean)
+
+        # the display gets written N times
+        t1 = time.ticks_ms()
+        n = 0
+        send_row = InkplateGS3._send_row
+        vscan_write = ip.vscan_write
+        fb = self._framebuf
+        for lut in InkplateGS3._wave:
+            ip.vscan_start()
+            # write all rows
+            r = D_ROWS - 1
+            while r >= 0:
+                send_row(lut, fb, r)
+                vscan_write()
+                r -= 1
+            n += 1
+
+        t2 = time.ticks_ms()
+        ip.record(
+            "gs3/" + clean, nc, time.ticks_diff(t1, t0), n, time.ticks_diff(t2, t1)
+        )
+
+        ip.clean(2, 1)
+        ip.clean(3, 1)
+        ip.power_off()
+
+    def clear(self):
+        self.fill(7)
+
+
 # InkplatePartial managed partial updates. It starts by making a copy of the current framebuffer
 # and then when asked to draw it renders the differences between the copy and the new framebuffer
-# state. The constructor needs a reference to the current/main display object (InkplateMono).
-# Only InkplateMono is supported at the moment.
+# state. The constructor needs a reference to the current/main display object (InkplateMono),
+# InkplatePartialGS2 does the same for InkplateGS2.
+# InkplatePartial also keeps a damage rectangle in display coordinates: drawing code calls
+# damage() for the areas it touches so partial updates can limit themselves to the bounding box.
 class InkplatePartial:
+    _mode = MODE_PARTIAL  # waveform tables to use
+    _key = "partial"  # stats key, see _Inkplate.record
+
     def __init__(self, base):
         self._base = base
         self._framebuf = bytearray(len(base._framebuf))
-        InkplatePartial._gen_lut_mono()
+        self._changed = bytearray(D_ROWS)  # per-row change bitmap, see _diff_rows
+        self._gen_wave(_Inkplate.waveforms.select(self._mode, _Inkplate._temperature))
+        # the reference copy is blank until start() is called, so everything may have changed
+        self._x0, self._y0, self._x1, self._y1 = 0, 0, D_COLS - 1, D_ROWS - 1
 
-    # start makes a reference copy of the current framebuffer
+    # start makes a reference copy of the current framebuffer and clears the damage rectangle
     def start(self):
         self._framebuf[:] = self._base._framebuf[:]
+        self._x0, self._y0, self._x1, self._y1 = D_COLS, D_ROWS, -1, -1
 
-    # display the changes between our reference copy and the current framebuffer contents
+    # damage grows the damage rectangle to include the given rectangle (display coordinates)
+    def damage(self, x, y, w, h):
+        if w <= 0 or h <= 0:
+            return
+        if x < self._x0:
+            self._x0 = max(x, 0)
+        if y < self._y0:
+            self._y0 = max(y, 0)
+        if x + w - 1 > self._x1:
+            self._x1 = min(x + w - 1, D_COLS - 1)
+        if y + h - 1 > self._y1:
+            self._y1 = min(y + h - 1, D_ROWS - 1)
+
+    # bounds returns the damage rectangle as (x, y, w, h), or None if nothing was damaged
+    def bounds(self):
+        if self._x1 < self._x0 or self._y1 < self._y0:
+            return None
+        return self._x0, self._y0, self._x1 - self._x0 + 1, self._y1 - self._y0 + 1
+
+    # display the changes between our reference copy and the current framebuffer contents,
+    # only rows y..y+h-1 are compared and within those only rows that changed get sent
     def display(self, x=0, y=0, w=D_COLS, h=D_ROWS):
+        # only what's on the display can be compared, whatever the caller passed
+        if x < 0:
+            w += x
+            x = 0
+        if y < 0:
+            h += y
+            y = 0
+        w = min(w, D_COLS - x)
+        h = min(h, D_ROWS - y)
+        if w <= 0 or h <= 0:
+            return
+        nfb = self._base._framebuf  # new framebuffer
+        ofb = self._framebuf  # old framebuffer
+        changed = self._changed
+        changed[:] = bytes(D_ROWS)
+        changed[y : y + h] = b"\x01" * h
+        nrows = InkplatePartial._diff_rows(ofb, nfb, changed, len(nfb) // (4 * D_ROWS))
+        if nrows == 0:
+            return
+
+        # turn the change bitmap into (rows to skip, rows to send) spans in scan order
+        spans = []
+        r = D_ROWS - 1
+        while r >= 0:
+            s = r
+            while r >= 0 and not changed[r]:
+                r -= 1
+            if r < 0:
+                break  # skipping the remaining rows isn't necessary
+            skip = s - r
+            s = r
+            while r >= 0 and changed[r]:
+                r -= 1
+            spans.append((skip, s - r))
+
         ip = _Inkplate
         ip.power_on()
+        self._gen_wave(ip.waveforms.select(self._mode, ip._temperature))
 
         # the display gets written a couple of times
         t0 = time.ticks_ms()
         n = 0
-        send_row = InkplatePartial._send_row
+        send_row = self._send_row
         skip_rows = InkplatePartial._skip_rows
         vscan_write = ip.vscan_write
-        nfb = self._base._framebuf  # new framebuffer
-        ofb = self._framebuf  # old framebuffer
-        lut = InkplatePartial._lut_mono
-        h -= 1
-        for _ in range(5):
+        for lut in self._wave:
             ip.vscan_start()
             r = D_ROWS - 1
-            # skip rows that supposedly have no change
-            if r > y + h:
-                skip_rows(r - (y + h))
-                r = y + h
-            # write changed rows
-            while r >= y:
-                send_row(lut, ofb, nfb, r)
-                vscan_write()
-                r -= 1
-            # skip remaining rows (doesn't seem to be necessary)
-            # if r > 0:
-            #    skip_rows(r)
+            for skip, send in spans:
+                # skip rows that have no change
+                skip_rows(skip)
+                r -= skip
+                # write changed rows
+                while send > 0:
+                    send_row(lut, ofb, nfb, r)
+                    vscan_write()
+                    r -= 1
+                    send -= 1
             n += 1
 
         t1 = time.ticks_ms()
-        td = time.ticks_diff(t1, t0)
-        print(
-            "Partial: draw %dms (%dms/frame %dus/row) (y=%d..%d)"
-            % (td, td // n, td * 1000 // n // (D_ROWS - y), y, y + h + 1)
-        )
+        ip.record(self._key, 0, 0, n, time.ticks_diff(t1, t0))
 
         ip.clean(2, 2)
         ip.clean(3, 1)
         ip.power_off()
 
-    # gen_lut_mono generates a look-up tables to change the display from a nibble of old
-    # pixels (4 bits = 4 pixels) to a nibble of new pixels. The LUT contains the
-    # 32-bits that need to be pushed into the gpio port to effect the change.
+    # _diff_rows compares the rows r for which changed[r] is set, leaving it at 1 only where the
+    # old and new framebuffers differ, and returns the number of changed rows. Rows are
+    # row_words 32-bit words long.
+    @micropython.viper
+    @staticmethod
+    def _diff_rows(old_framebuf, new_framebuf, changed_in, row_words: int) -> int:
+        ofb = ptr32(old_framebuf)  # compare 4 bytes at a time
+        nfb = ptr32(new_framebuf)
+        changed = ptr8(changed_in)
+        n = 0
+        r = 0
+        while r < D_ROWS:
+            if changed[r]:
+                c = 0
+                ix = r * row_words
+                end = ix + row_words
+                while ix < end:
+                    if ofb[ix] != nfb[ix]:
+                        c = 1
+                        break
+                    ix += 1
+                changed[r] = c
+                n += c
+            r += 1
+        return n
+
+    _phases = None  # waveform table _wave was generated from
+
+    # _gen_wave generates a look-up table per phase of a waveform table (see waveform.py) to
+    # change the display from a nibble of old pixels (4 bits = 4 pixels) to a nibble of new
+    # pixels. The LUT contains the 32-bits that need to be pushed into the gpio port to effect
+    # the change: pixels that change get the phase's code for their new value, the others get
+    # skipped.
     @classmethod
-    def _gen_lut_mono(cls):
-        lut = cls._lut_mono = array("L", bytes(4 * 256))
-        for o in range(16):  # iterate through all old-pixels combos
-            for n in range(16):  # iterate through all new-pixels combos
-                bw = 0
-                for bit in range(4):
-                    # value to send to display: turns out that if we juxtapose the old and new
-                    # bits we get the right value except for the 00 combination...
-                    val = (((o >> bit) << 1) & 2) | ((n >> bit) & 1)
-                    if val == 0:
-                        val = 3
-                    bw = bw | (val << (2 * bit))
-                lut[o * 16 + n] = _Inkplate.byte2gpio[bw] | EPD_CL
-        # print("Black: %08x, White:%08x Data:%08x" % (cls.lut_bw[0xF], cls.lut_bw[0], EPD_DATA))
+    def _gen_wave(cls, phases):
+        if phases is cls._phases:
+            return
+        luts = {}
+        wave = []
+        for codes in phases:
+            codes = tuple(codes)
+            if codes not in luts:
+                lut = array("L", bytes(4 * 256))
+                for o in range(16):  # iterate through all old-pixels combos
+                    for n in range(16):  # iterate through all new-pixels combos
+                        bw = 0
+                        for bit in range(4):
+                            nb = (n >> bit) & 1
+                            val = codes[nb] if (o >> bit) & 1 != nb else 3
+                            bw = bw | (val << (2 * bit))
+                        lut[o * 16 + n] = _Inkplate.byte2gpio[bw] | EPD_CL
+                luts[codes] = lut
+            wave.append(luts[codes])
+        cls._wave = wave
+        cls._phases = phases
 
     # _skip_rows skips N rows
     @micropython.viper
@@ -623,13 +985,225 @@ class InkplatePartial:
                 w1tc0[0] = off
 
 
+# InkplatePartialGS2 does partial updates of the grayscale display (InkplateGS2). Pixels that
+# change get a waveform that depends on their old and new gray level, see MODE_PARTIAL_GS2 in
+# waveform.py, the others are left alone.
+class InkplatePartialGS2(InkplatePartial):
+    _mode = MODE_PARTIAL_GS2
+    _key = "partial_gs2"
+
+    _wave = None
+    _phases = None  # waveform table _wave was generated from
+
+    # _gen_wave generates a look-up table per phase of a waveform table. A framebuffer byte
+    # holds 4 pixels, the LUT is indexed with the old and new nibble of 2 of them: the first
+    # 256 entries contain the gpio bits for the first 2 pixels of a byte, the last 256 those
+    # for the last 2 pixels plus the clock bit.
+    @classmethod
+    def _gen_wave(cls, phases):
+        if phases is cls._phases:
+            return
+        luts = {}
+        wave = []
+        for codes in phases:
+            codes = tuple(codes)
+            if codes not in luts:
+                lut = array("L", bytes(4 * 512))
+                b2g = _Inkplate.byte2gpio
+                for o in range(16):  # iterate through all old-pixels combos
+                    for n in range(16):  # iterate through all new-pixels combos
+                        bw = 0
+                        for px in range(2):
+                            op = (o >> (2 * px)) & 3
+                            np = (n >> (2 * px)) & 3
+                            val = codes[op * 4 + np] if op != np else 3
+                            bw |= val << (2 * px)
+                        lut[o * 16 + n] = b2g[bw]
+                        lut[256 + o * 16 + n] = b2g[bw << 4] | EPD_CL
+                luts[codes] = lut
+            wave.append(luts[codes])
+        cls._wave = wave
+        cls._phases = phases
+
+    # _send_row writes a row of data to the display, bytes whose 4 pixels didn't change get
+    # sent as all-ones (skip)
+    @micropython.viper
+    @staticmethod
+    def _send_row(lut_in, old_framebuf, new_framebuf, row: int):
+        # cache vars into locals
+        w1ts0 = ptr32(int(ESP32_GPIO + 4 * W1TS0))
+        w1tc0 = ptr32(int(ESP32_GPIO + 4 * W1TC0))
+        off = int(EPD_DATA | EPD_CL)  # mask with all data bits and clock bit
+        ofb = ptr8(old_framebuf)
+        nfb = ptr8(new_framebuf)
+        ix = int(row * (D_COLS >> 2) + 199)  # index into framebuffer
+        lut = ptr32(lut_in)
+        # send first byte
+        odata = int(ofb[ix])
+        ndata = int(nfb[ix])
+        ix -= 1
+        data = off  # all-ones: no change to any of the pixels
+        if odata != ndata:
+            data = lut[((odata & 0xF) << 4) | (ndata & 0xF)] | lut[
+                256 + ((odata & 0xF0) | (ndata >> 4))
+            ]
+        w1tc0[0] = off
+        w1tc0[W1TC1 - W1TC0] = EPD_SPH
+        w1ts0[0] = data  # set data bits and clock
+        w1tc0[0] = off  # clear data bits as well ready for next byte
+        w1ts0[W1TS1 - W1TS0] = EPD_SPH
+        # send the remaining bytes (796 pixels)
+        for c in range(199):
+            odata = int(ofb[ix])
+            ndata = int(nfb[ix])
+            ix -= 1
+            if odata == ndata:
+                w1ts0[0] = off
+            else:
+                w1ts0[0] = lut[((odata & 0xF) << 4) | (ndata & 0xF)] | lut[
+                    256 + ((odata & 0xF0) | (ndata >> 4))
+                ]
+            w1tc0[0] = off
+
+
+# Bitmap holds a 1-bit bitmap (MSB first, rows padded to a byte, as drawBitmap takes it) and
+# converts it into the framebuffer format of a display mode, rotated for the display's
+# rotation, so that it can be drawn with a single FrameBuffer.blit. Conversions are cached
+# per rotation, mode and colors.
+class Bitmap:
+    _formats = (framebuf.MONO_HMSB, framebuf.GS2_HMSB, framebuf.GS4_HMSB)
+    _ppb = (8, 4, 2)  # pixels per byte per display mode
+
+    def __init__(self, data, w, h):
+        self.data = data
+        self.w = w
+        self.h = h
+        self._cache = {}
+
+    # get returns (framebuffer, key) to blit for the given rotation and display mode, the set
+    # bits get color c and the clear bits bg, or the key color if bg is None
+    def get(self, rotation, mode, c=1, bg=None):
+        k = (rotation, mode, c, bg)
+        entry = self._cache.get(k)
+        if entry is None:
+            entry = self._convert(rotation, mode, c, bg)
+            self._cache[k] = entry
+        return entry
+
+    def _convert(self, rotation, mode, c, bg):
+        w, h = self.w, self.h
+        fw, fh = (h, w) if rotation & 1 else (w, h)
+        ppb = Bitmap._ppb[mode]
+        fb = framebuf.FrameBuffer(
+            bytearray((fw + ppb - 1) // ppb * fh), fw, fh, Bitmap._formats[mode]
+        )
+        key = -1
+        if bg is None:
+            key = bg = 0 if c else 1
+        fb.fill(bg)
+        data = self.data
+        stride = (w + 7) // 8
+        for j in range(h):
+            for i in range(w):
+                if data[j * stride + (i >> 3)] & (0x80 >> (i & 7)):
+                    if rotation == 1:
+                        fb.pixel(h - 1 - j, i, c)
+                    elif rotation == 2:
+                        fb.pixel(w - 1 - i, h - 1 - j, c)
+                    elif rotation == 3:
+                        fb.pixel(j, w - 1 - i, c)
+                    else:
+                        fb.pixel(i, j, c)
+        return fb, key
+
+
+# GlyphCache holds the glyphs of GFX fonts (see gfx_standard_font_01.py) and packed Fonts
+# (see fontfile.py) that printText drew, scaled to the text size and converted like a Bitmap
+# for the color, display mode and rotation, so that every character is drawn with a single
+# blit. Once the glyphs take more than limit bytes the least recently used ones get dropped.
+class GlyphCache:
+    def __init__(self, limit=16384):
+        self.limit = limit
+        # (id(font), name, size, rotation, mode, c, bg) -> [fb, key, w, h, bytes, used, font]
+        self._glyphs = {}
+        self._bytes = 0
+        self._tick = 0
+
+    # get returns [framebuffer, key, width, height, ...] of the font entry name (a character
+    # for a Font), framebuffer is None for glyphs without pixels
+    def get(self, font, name, size, rotation, mode, c=1, bg=None):
+        k = (id(font), name, size, rotation, mode, c, bg)
+        self._tick += 1
+        entry = self._glyphs.get(k)
+        if entry is None or entry[6] is not font:
+            entry = self._render(font, name, size, rotation, mode, c, bg)
+            while self._glyphs and self._bytes + entry[4] > self.limit:
+                self._evict()
+            self._glyphs[k] = entry
+            self._bytes += entry[4]
+        entry[5] = self._tick
+        return entry
+
+    def _evict(self):
+        oldest = None
+        for k, entry in self._glyphs.items():
+            if oldest is None or entry[5] < self._glyphs[oldest][5]:
+                oldest = k
+        self._bytes -= self._glyphs.pop(oldest)[4]
+
+    # _render scales the bitmap of a glyph by size and converts it
+    def _render(self, font, name, size, rotation, mode, c, bg):
+        if isinstance(font, dict):
+            src, sw, sh = GlyphCache._gfx_bitmap(font[name])
+        else:
+            src, sw, sh = font.bitmap(name)
+        w = sw * size
+        h = sh * size
+        if w == 0 or h == 0:
+            return [None, -1, w, h, 0, 0, font]
+        data = src
+        if size > 1:
+            sstride = (sw + 7) // 8
+            stride = (w + 7) // 8
+            data = bytearray(stride * h)
+            for y in range(sh):
+                for x in range(sw):
+                    if src[y * sstride + (x >> 3)] & (0x80 >> (x & 7)):
+                        for j in range(y * size, (y + 1) * size):
+                            for i in range(x * size, (x + 1) * size):
+                                data[j * stride + (i >> 3)] |= 0x80 >> (i & 7)
+        fb, key = Bitmap(data, w, h)._convert(rotation, mode, c, bg)
+        return [fb, key, w, h, w * h // Bitmap._ppb[mode] + h, 0, font]
+
+    # _gfx_bitmap returns (data, width, height) of a GFX font glyph, which is stored as
+    # columns with the bottom pixel in bit 0
+    @staticmethod
+    def _gfx_bitmap(arr):
+        w = arr[0]
+        h = arr[1]
+        stride = (w + 7) // 8
+        data = bytearray(stride * h)
+        for x in range(w):
+            col = arr[2 + x]
+            for y in range(h):
+                if col & (1 << y):
+                    data[(h - 1 - y) * stride + (x >> 3)] |= 0x80 >> (x & 7)
+        return data, w, h
+
+
 class Inkplate:
     INKPLATE_1BIT = 0
     INKPLATE_2BIT = 1
+    INKPLATE_3BIT = 2
 
     BLACK = 1
     WHITE = 0
 
+    # dithering methods for drawImageFile, see imagefile.py
+    DITHER_NONE = 0
+    DITHER_ORDERED = 1
+    DITHER_FLOYD_STEINBERG = 2
+
     _width = D_COLS
     _height = D_ROWS
 
@@ -637,8 +1211,17 @@ class Inkplate:
     displayMode = 0
     textSize = 1
 
-    def __init__(self, mode):
+    ipg3 = None  # InkplateGS3, only allocated once 3-bit mode gets used
+    ippg = None  # InkplatePartialGS2, only allocated once 2-bit mode gets used
+    _commands = None  # recorded drawing commands, None when not recording (see startRecording)
+    _clip = (0, 0, D_COLS, D_ROWS)  # x0, y0, x1, y1 drawing is limited to, see pushClip
+    _clips = ()  # clips pushClip saved
+    _partials = 0  # partial updates since the last full refresh, kept in snapshots
+
+    # encode selects how the monochrome display encodes rows (ENCODE_*), see setEncode
+    def __init__(self, mode, encode=ENCODE_ROW):
         self.displayMode = mode
+        self._encode = encode
         try:
             os.mount(
                 sdcard.SDCard(
@@ -662,10 +1245,22 @@ class Inkplate:
 
     def begin(self):
         _Inkplate.init(I2C(0, scl=Pin(22), sda=Pin(21)))
+        # use waveform tables from the SD card or flash if there are any
+        for path in ("/sd/" + WAVEFORM_FILE, WAVEFORM_FILE):
+            try:
+                self.loadWaveforms(path)
+                break
+            except (OSError, ValueError):
+                pass
 
         self.ipg = InkplateGS2()
-        self.ipm = InkplateMono()
-        self.ipp = InkplatePartial(self.ipm)
+        self.ipm = InkplateMono(self._encode)
+        # ipp is the partial update engine of the current mode: ippm for 1-bit, ippg for 2-bit
+        self.ipp = self.ippm = InkplatePartial(self.ipm)
+        self._bitmaps = {}  # raw bitmap data drawn with drawBitmap by id, see Bitmap
+        self._glyphs = GlyphCache()  # glyphs drawn by printText
+        self._fonts = {}  # fontfile.Font by path, see setFont
+        self.selectDisplayMode(self.displayMode)
 
         self.GFX = GFX(
             D_COLS,
@@ -679,31 +1274,113 @@ class Inkplate:
         )
 
     def clearDisplay(self):
+        if self._commands is not None:
+            self._commands = []  # everything recorded so far would get cleared anyway
         self.ipg.clear()
         self.ipm.clear()
-
-    def display(self):
+        if self.ipg3 is not None:
+            self.ipg3.clear()
+        self.ippm.damage(0, 0, D_COLS, D_ROWS)
+        if self.ippg is not None:
+            self.ippg.damage(0, 0, D_COLS, D_ROWS)
+
+    # display refreshes the whole screen, clean selects the clean profile (see CLEAN_PROFILES),
+    # None uses the one set with setCleanProfile
+    def display(self, clean=None):
+        self.flushRecording()
+        self._partials = 0
         if self.displayMode == 0:
-            self.ipm.display()
+            self.ipm.display(clean)
         elif self.displayMode == 1:
-            self.ipg.display()
+            self.ipg.display(clean)
+        elif self.displayMode == 2:
+            self.ipg3.display(clean)
 
+    # partialUpdate sends the changes made since ipp.start() to the display, only scanning the
+    # rows covered by the damage rectangle. It does nothing in 3-bit mode.
     def partialUpdate(self):
-        if self.displayMode == 1:
+        self.flushRecording()
+        if self.displayMode == self.INKPLATE_3BIT:
+            return
+        bounds = self.ipp.bounds()
+        if bounds is None:
             return
-        self.ipp.display()
+        self.ipp.display(*bounds)
+        self._partials += 1
+
+    # saveSnapshot writes the framebuffer to a file, compressed, so that what the display shows
+    # is known after deep sleep (see loadSnapshot and snapshot.py). Call it right after a
+    # refresh. It returns the compressed size.
+    def saveSnapshot(self, path):
+        import snapshot
+
+        fb = self._framebuffer()._framebuf
+        return snapshot.save(path, fb, self.displayMode, self._partials)
+
+    # loadSnapshot restores a snapshot saved with saveSnapshot into the framebuffer and the
+    # partial update reference, so the next partialUpdate only sends what differs from what
+    # the display shows. It returns the number of partial updates made since the last full
+    # refresh (to do a full one once in a while against ghosting), or None if there was no
+    # snapshot for the current mode. 3-bit mode has no partial updates and returns None.
+    def loadSnapshot(self, path):
+        import snapshot
+
+        if self.displayMode == self.INKPLATE_3BIT:
+            return None
+        ref = self.ipp._framebuf
+        fb = self._framebuffer()._framebuf
+        partials = snapshot.load(path, ref, self.displayMode)
+        if partials is None:
+            ref[:] = fb
+            return None
+        fb[:] = ref
+        self.ipp.start()
+        self._partials = partials
+        return partials
+
+    def clean(self, profile="full"):
+        self.einkOn()
+        _Inkplate.run_clean(profile)
+        self.einkOff()
 
-    def clean(self):
+    # setEncode selects how 1-bit mode encodes rows while sending them: ENCODE_FRAME is the
+    # fastest but keeps a 480KB buffer, switching to ENCODE_ROW or ENCODE_OFF frees it again,
+    # e.g. before decoding images or opening TLS connections
+    def setEncode(self, encode):
+        self._encode = self.ipm.encode = encode
+        if encode != ENCODE_FRAME:
+            InkplateMono.release()
+
+    def getEncode(self):
+        return self.ipm.encode
+
+    # setCleanProfile sets the clean profile display() uses by default
+    def setCleanProfile(self, profile):
+        if profile not in CLEAN_PROFILES:
+            raise ValueError("unknown clean profile: %s" % profile)
+        _Inkplate.clean_profile = profile
+
+    def getCleanProfile(self):
+        return _Inkplate.clean_profile
+
+    # getStats returns the refresh timings per mode and clean profile, see _Inkplate.record
+    def getStats(self):
+        return _Inkplate.stats
+
+    def resetStats(self):
+        _Inkplate.stats = {}
+
+    # loadWaveforms replaces the waveform tables with the ones in a waveform file
+    def loadWaveforms(self, path):
+        _Inkplate.waveforms = Waveforms.load(path)
+
+    # readTemperature returns the panel temperature in degrees C
+    def readTemperature(self):
+        if _Inkplate._on:
+            return _Inkplate.read_temperature()
         self.einkOn()
-        _Inkplate.clean(0, 1)
-        _Inkplate.clean(1, 12)
-        _Inkplate.clean(2, 1)
-        _Inkplate.clean(0, 11)
-        _Inkplate.clean(2, 1)
-        _Inkplate.clean(1, 12)
-        _Inkplate.clean(2, 1)
-        _Inkplate.clean(0, 11)
         self.einkOff()
+        return _Inkplate._temperature
 
     def einkOn(self):
         _Inkplate.power_on()
@@ -717,8 +1394,151 @@ class Inkplate:
     def height(self):
         return self._height
 
+    # startRecording makes the drawing functions record what they draw instead of drawing it
+    # right away. The recording gets drawn by flushRecording, which display() and
+    # partialUpdate() call, leaving out what's off the screen or gets covered by a later
+    # fillRect and merging fills next to each other, so overdrawn pixels are never drawn.
+    def startRecording(self):
+        if self._commands is None:
+            self._commands = []
+
+    # stopRecording draws the recording and goes back to drawing right away
+    def stopRecording(self):
+        self.flushRecording()
+        self._commands = None
+
+    # flushRecording draws what was recorded so far and returns the number of drawing
+    # commands that were left after culling and merging
+    def flushRecording(self):
+        commands = self._commands
+        if not commands:
+            return 0
+        commands = self._cull(commands)
+        self._commands = None
+        try:
+            for cmd in commands:
+                cmd[0](self, *cmd[1])
+        finally:
+            self._commands = []
+        return len(commands)
+
+    # _record adds a drawing command to the recording if there is one and returns whether it
+    # did. fn(self, *args) draws it inside the rectangle x, y, w, h, fill is the color if it's a
+    # fillRect.
+    def _record(self, fn, args, x, y, w, h, fill=None):
+        if self._commands is None:
+            return False
+        self._commands.append((fn, args, x, y, w, h, fill))
+        return True
+
+    # _cull returns the recorded commands without those that are off the screen or covered by
+    # a later fill, with fills next to each other merged
+    def _cull(self, commands):
+        sw = self.width()
+        sh = self.height()
+        kept = []
+        fills = []  # rectangles of the later fills
+        for cmd in reversed(commands):
+            _, _, x, y, w, h, fill = cmd
+            if w <= 0 or h <= 0 or x >= sw or y >= sh or x + w <= 0 or y + h <= 0:
+                continue
+            covered = False
+            for fx, fy, fw, fh in fills:
+                if fx <= x and fy <= y and x + w <= fx + fw and y + h <= fy + fh:
+                    covered = True
+                    break
+            if covered:
+                continue
+            kept.append(cmd)
+            if fill is not None:
+                fills.append((x, y, w, h))
+        kept.reverse()
+        merged = []
+        for cmd in kept:
+            fill = cmd[6]
+            if fill is not None and merged and merged[-1][6] == fill:
+                _, _, x, y, w, h, _ = merged[-1]
+                _, _, x1, y1, w1, h1, _ = cmd
+                if y == y1 and h == h1 and x1 <= x + w and x <= x1 + w1:
+                    x, w = min(x, x1), max(x + w, x1 + w1) - min(x, x1)
+                elif x == x1 and w == w1 and y1 <= y + h and y <= y1 + h1:
+                    y, h = min(y, y1), max(y + h, y1 + h1) - min(y, y1)
+                else:
+                    merged.append(cmd)
+                    continue
+                merged[-1] = (Inkplate.fillRect, (x, y, w, h, fill), x, y, w, h, fill)
+                continue
+            merged.append(cmd)
+        return merged
+
+    # pushClip limits drawing to the rectangle x, y, w, h (within the current clip) until the
+    # matching popClip. The drawing functions check it once per line, rectangle, string or
+    # bitmap, only single pixels get checked one by one. Images drawn with drawImageFile are
+    # only clipped to the screen.
+    def pushClip(self, x, y, w, h):
+        self.flushRecording()
+        self._clips += (self._clip,)
+        x0, y0, x1, y1 = self._clip
+        self._clip = (max(x, x0), max(y, y0), min(x + w, x1), min(y + h, y1))
+
+    def popClip(self):
+        self.flushRecording()
+        if self._clips:
+            self._clip = self._clips[-1]
+            self._clips = self._clips[:-1]
+
+    # region returns a FrameBuffer over the rectangle x, y, w, h of the current framebuffer, so a
+    # widget can draw into it with the native FrameBuffer methods, in coordinates relative to
+    # x, y and limited to the rectangle by the FrameBuffer itself. It shares the memory of the
+    # framebuffer and gets counted as damaged for partial updates. The display can't be
+    # rotated and x has to be at the start of a framebuffer byte (a multiple of 8 pixels in
+    # 1-bit mode, 4 in 2-bit mode and 2 in 3-bit mode).
+    def region(self, x, y, w, h):
+        ppb = (8, 4, 2)[self.displayMode]
+        if self.rotation:
+            raise ValueError("regions need rotation 0")
+        if x % ppb or x < 0 or y < 0:
+            raise ValueError("region not aligned to framebuffer bytes")
+        self.flushRecording()
+        w = min(w, D_COLS - x)
+        h = min(h, D_ROWS - y)
+        if w <= 0 or h <= 0:
+            return None
+        self.ipp.damage(x, y, w, h)
+        return self._view(x, y, w, h)
+
+    # _view returns a FrameBuffer over x, y, w, h of the current framebuffer in display
+    # coordinates, x at the start of a byte
+    def _view(self, x, y, w, h):
+        ppb = (8, 4, 2)[self.displayMode]
+        row = D_COLS // ppb
+        start = y * row + x // ppb
+        end = (y + h - 1) * row + (x + w + ppb - 1) // ppb
+        buf = memoryview(self._framebuffer()._framebuf)[start:end]
+        return framebuf.FrameBuffer(buf, w, h, Bitmap._formats[self.displayMode], D_COLS)
+
+    # _blit draws FrameBuffer src covering rectangle p (display coordinates) limited to r, the
+    # part of p inside the clip. Unless r is all of p, src gets blitted into a view of r; the
+    # view starts at a byte, so the pixels left of r in that byte get put back afterwards.
+    def _blit(self, src, key, p, r):
+        fb = self._framebuffer()
+        px, py = p[0], p[1]
+        if r == p:
+            fb.blit(src, px, py, key)
+            return
+        x, y, w, h = r
+        x0 = x - x % (8, 4, 2)[self.displayMode]
+        keep = [fb.pixel(i, j) for j in range(y, y + h) for i in range(x0, x)]
+        self._view(x0, y, x + w - x0, h).blit(src, px - x0, py - y, key)
+        k = 0
+        for j in range(y, y + h):
+            for i in range(x0, x):
+                fb.pixel(i, j, keep[k])
+                k += 1
+
     # Arduino compatibility functions
     def setRotation(self, x):
+        self.flushRecording()
         self.rotation = x % 4
         if self.rotation == 0 or self.rotation == 2:
             self._width = D_COLS
@@ -726,11 +1546,16 @@ class Inkplate:
         elif self.rotation == 1 or self.rotation == 3:
             self._width = D_ROWS
             self._height = D_COLS
+        # clips are in the coordinates of a rotation
+        self._clip = (0, 0, self._width, self._height)
+        self._clips = ()
 
     def getRotation(self):
         return self.rotation
 
     def drawPixel(self, x, y, c):
+        if self._record(Inkplate.drawPixel, (x, y, c), x, y, 1, 1):
+            return
         self.startWrite()
         self.writePixel(x, y, c)
         self.endWrite()
@@ -739,7 +1564,8 @@ class Inkplate:
         pass
 
     def writePixel(self, x, y, c):
-        if x > self.width() - 1 or y > self.height() - 1 or x < 0 or y < 0:
+        clip = self._clip
+        if x < clip[0] or y < clip[1] or x >= clip[2] or y >= clip[3]:
             return
         if self.rotation == 1:
             x, y = y, x
@@ -750,22 +1576,96 @@ class Inkplate:
         elif self.rotation == 3:
             x, y = y, x
             y = self.width() - y - 1
-        (self.ipm.pixel if self.displayMode == self.INKPLATE_1BIT else self.ipg.pixel)(
-            x, y, c
-        )
+        # grow the damage rectangle, inlined because this is called for every pixel drawn
+        ipp = self.ipp
+        if x < ipp._x0:
+            ipp._x0 = x
+        if x > ipp._x1:
+            ipp._x1 = x
+        if y < ipp._y0:
+            ipp._y0 = y
+        if y > ipp._y1:
+            ipp._y1 = y
+        if self.displayMode == self.INKPLATE_1BIT:
+            self.ipm.pixel(x, y, c)
+        elif self.displayMode == self.INKPLATE_2BIT:
+            self.ipg.pixel(x, y, c)
+        else:
+            self.ipg3.pixel(x, y, c)
+
+    # _framebuffer returns the framebuffer of the current mode
+    def _framebuffer(self):
+        if self.displayMode == self.INKPLATE_1BIT:
+            return self.ipm
+        elif self.displayMode == self.INKPLATE_2BIT:
+            return self.ipg
+        return self.ipg3
+
+    # _map_rect clips a rectangle to the clip (the screen unless pushClip says otherwise) and
+    # maps it to display coordinates for the current rotation, it returns (x, y, w, h) or None
+    # if nothing is left
+    def _map_rect(self, x, y, w, h, clip=None):
+        x0, y0, x1, y1 = clip or self._clip
+        if x < x0:
+            w -= x0 - x
+            x = x0
+        if y < y0:
+            h -= y0 - y
+            y = y0
+        if x + w > x1:
+            w = x1 - x
+        if y + h > y1:
+            h = y1 - y
+        if w <= 0 or h <= 0:
+            return None
+        return self._rotate_rect(x, y, w, h)
+
+    # _screen_rect is _map_rect ignoring pushClip, for what only gets clipped to the screen
+    # like the rows of image files
+    def _screen_rect(self, x, y, w, h):
+        return self._map_rect(x, y, w, h, (0, 0, self._width, self._height))
+
+    # _rotate_rect maps a rectangle to display coordinates for the current rotation
+    def _rotate_rect(self, x, y, w, h):
+        if self.rotation == 1:
+            return D_COLS - y - h, x, h, w
+        elif self.rotation == 2:
+            return D_COLS - x - w, D_ROWS - y - h, w, h
+        elif self.rotation == 3:
+            return y, D_ROWS - x - w, h, w
+        return x, y, w, h
 
+    # writeFillRect, writeFastVLine and writeFastHLine draw whole rectangles using the native
+    # FrameBuffer methods, which is where most text and shape drawing ends up
     def writeFillRect(self, x, y, w, h, c):
-        for j in range(w):
-            for i in range(h):
-                self.writePixel(x + j, y + i, c)
+        r = self._map_rect(x, y, w, h)
+        if r is None:
+            return
+        x, y, w, h = r
+        self.ipp.damage(x, y, w, h)
+        self._framebuffer().fill_rect(x, y, w, h, c)
 
     def writeFastVLine(self, x, y, h, c):
-        for i in range(h):
-            self.writePixel(x, y + i, c)
+        r = self._map_rect(x, y, 1, h)
+        if r is None:
+            return
+        x, y, w, h = r
+        self.ipp.damage(x, y, w, h)
+        if w == 1:
+            self._framebuffer().vline(x, y, h, c)
+        else:
+            self._framebuffer().hline(x, y, w, c)
 
     def writeFastHLine(self, x, y, w, c):
-        for i in range(w):
-            self.writePixel(x + i, y, c)
+        r = self._map_rect(x, y, w, 1)
+        if r is None:
+            return
+        x, y, w, h = r
+        self.ipp.damage(x, y, w, h)
+        if h == 1:
+            self._framebuffer().hline(x, y, w, c)
+        else:
+            self._framebuffer().vline(x, y, h, c)
 
     def writeLine(self, x0, y0, x1, y1, c):
         self.GFX.line(x0, y0, x1, y1, c)
@@ -774,54 +1674,96 @@ class Inkplate:
         pass
 
     def drawFastVLine(self, x, y, h, c):
+        if self._record(Inkplate.drawFastVLine, (x, y, h, c), x, y, 1, h):
+            return
         self.startWrite()
         self.writeFastVLine(x, y, h, c)
         self.endWrite()
 
     def drawFastHLine(self, x, y, w, c):
+        if self._record(Inkplate.drawFastHLine, (x, y, w, c), x, y, w, 1):
+            return
         self.startWrite()
         self.writeFastHLine(x, y, w, c)
         self.endWrite()
 
     def fillRect(self, x, y, w, h, c):
+        if self._record(Inkplate.fillRect, (x, y, w, h, c), x, y, w, h, c):
+            return
         self.startWrite()
         self.writeFillRect(x, y, w, h, c)
         self.endWrite()
 
     def fillScreen(self, c):
-        self.fillRect(0, 0, self.width(), self.height())
+        self.fillRect(0, 0, self.width(), self.height(), c)
 
     def drawLine(self, x0, y0, x1, y1, c):
+        x, y = min(x0, x1), min(y0, y1)
+        w, h = abs(x1 - x0) + 1, abs(y1 - y0) + 1
+        if self._record(Inkplate.drawLine, (x0, y0, x1, y1, c), x, y, w, h):
+            return
         self.startWrite()
         self.writeLine(x0, y0, x1, y1, c)
         self.endWrite()
 
     def drawRect(self, x, y, w, h, c):
+        if self._record(Inkplate.drawRect, (x, y, w, h, c), x, y, w, h):
+            return
         self.GFX.rect(x, y, w, h, c)
 
     def drawCircle(self, x, y, r, c):
+        if self._record(Inkplate.drawCircle, (x, y, r, c), x - r, y - r, 2 * r + 1, 2 * r + 1):
+            return
         self.GFX.circle(x, y, r, c)
 
     def fillCircle(self, x, y, r, c):
+        if self._record(Inkplate.fillCircle, (x, y, r, c), x - r, y - r, 2 * r + 1, 2 * r + 1):
+            return
         self.GFX.fill_circle(x, y, r, c)
 
     def drawTriangle(self, x0, y0, x1, y1, x2, y2, c):
+        x, y = min(x0, x1, x2), min(y0, y1, y2)
+        w, h = max(x0, x1, x2) - x + 1, max(y0, y1, y2) - y + 1
+        if self._record(Inkplate.drawTriangle, (x0, y0, x1, y1, x2, y2, c), x, y, w, h):
+            return
         self.GFX.triangle(x0, y0, x1, y1, x2, y2, c)
 
     def fillTriangle(self, x0, y0, x1, y1, x2, y2, c):
+        x, y = min(x0, x1, x2), min(y0, y1, y2)
+        w, h = max(x0, x1, x2) - x + 1, max(y0, y1, y2) - y + 1
+        if self._record(Inkplate.fillTriangle, (x0, y0, x1, y1, x2, y2, c), x, y, w, h):
+            return
         self.GFX.fill_triangle(x0, y0, x1, y1, x2, y2, c)
 
     def drawRoundRect(self, x, y, q, h, r, c):
+        if self._record(Inkplate.drawRoundRect, (x, y, q, h, r, c), x, y, q, h):
+            return
         self.GFX.round_rect(x, y, q, h, r, c)
 
     def fillRoundRect(self, x, y, q, h, r, c):
+        if self._record(Inkplate.fillRoundRect, (x, y, q, h, r, c), x, y, q, h):
+            return
         self.GFX.fill_round_rect(x, y, q, h, r, c)
 
     def setDisplayMode(self, mode):
-        self.displayMode = mode
+        self.selectDisplayMode(mode)
 
+    # selectDisplayMode switches modes, allocating the 3-bit framebuffer or the 2-bit partial
+    # update engine when they're first needed (before begin() that is left to begin())
     def selectDisplayMode(self, mode):
+        self.flushRecording()
         self.displayMode = mode
+        if not hasattr(self, "ipm"):
+            return
+        if mode == self.INKPLATE_3BIT and self.ipg3 is None:
+            self.ipg3 = InkplateGS3()
+            self.ipg3.clear()
+        if mode == self.INKPLATE_2BIT:
+            if self.ippg is None:
+                self.ippg = InkplatePartialGS2(self.ipg)
+            self.ipp = self.ippg
+        else:
+            self.ipp = self.ippm
 
     def getDisplayMode(self):
         return self.displayMode
@@ -829,122 +1771,140 @@ class Inkplate:
     def setTextSize(self, s):
         self.textSize = s
 
+    # setFont selects the font printText uses: a GFX font dict (like the default
+    # gfx_standard_font_01.text_dict), a fontfile.Font or the path of a font file. A font file
+    # only gets opened the first time its path is given, so its cached glyphs and measurements
+    # stay valid.
     def setFont(self, f):
+        if isinstance(f, str):
+            font = self._fonts.get(f)
+            if font is None:
+                import fontfile
+
+                font = self._fonts[f] = fontfile.Font(f)
+            f = font
         self.GFX.font = f
 
+    # printText draws s with its top left corner at x, y in the current font, scaled by the
+    # text size. The glyphs get blitted from a GlyphCache.
     def printText(self, x, y, s):
-        self.GFX._very_slow_text(x, y, s, self.textSize, 1)
+        font = self.GFX.font
+        bg = None
+        if self.GFX.text_bkgnd_args:
+            bg = self.GFX.text_bkgnd_args[0]
+        if self._commands is not None:
+            w, h = measure(s, self.textSize, font)
+            self._record(Inkplate._print_text, (x, y, s, self.textSize, font, bg), x, y, w, h)
+            return
+        if isinstance(font, dict):
+            self._print_gfx(x, y, s, font, bg)
+        else:
+            self._print_font(x, y, s, font, bg)
 
-    def drawBitmap(self, x, y, data, w, h):
-        byteWidth = (w + 7) // 8
-        byte = 0
-        self.startWrite()
-        for j in range(h):
-            for i in range(w):
-                if i & 7:
-                    byte <<= 1
+    # _print_text draws recorded text with the text size and font it was recorded with
+    def _print_text(self, x, y, s, size, font, bg):
+        text_size = self.textSize
+        self.textSize = size
+        try:
+            if isinstance(font, dict):
+                self._print_gfx(x, y, s, font, bg)
+            else:
+                self._print_font(x, y, s, font, bg)
+        finally:
+            self.textSize = text_size
+
+    # _print_font draws text in a packed Font: glyphs sit at their bearing and y offset from
+    # the pen and the background covers the whole line
+    def _print_font(self, x, y, s, font, bg):
+        size = self.textSize
+        w, h = measure(s, size, font)
+        r = self._map_rect(x, y, w, h)
+        if r is None:
+            return
+        self.ipp.damage(*r)
+        fb = self._framebuffer()
+        # glyphs only need clipping one by one if the text doesn't fit into the clip
+        clipped = r != self._rotate_rect(x, y, w, h)
+        if bg is not None:
+            fb.fill_rect(r[0], r[1], r[2], r[3], bg)
+        for ch in s:
+            g = font.glyph(ch)
+            if g is None:
+                continue
+            glyph = self._glyphs.get(font, ch, size, self.rotation, self.displayMode, 1)
+            if glyph[0] is not None:
+                gx = x + g[2] * size
+                gy = y + g[3] * size
+                p = self._rotate_rect(gx, gy, glyph[2], glyph[3])
+                if not clipped:
+                    fb.blit(glyph[0], p[0], p[1], glyph[1])
                 else:
-                    byte = data[j * byteWidth + i // 8]
-                if byte & 0x80:
-                    self.writePixel(x + i, y + j, 1)
-        self.endWrite()
+                    gr = self._map_rect(gx, gy, glyph[2], glyph[3])
+                    if gr is not None:
+                        self._blit(glyph[0], glyph[1], p, gr)
+            x += g[6] * size
+
+    # _print_gfx draws text in a GFX font like GFX._very_slow_text, see text.gfx_glyphs
+    def _print_gfx(self, x, y, s, font, bg):
+        size = self.textSize
+        w, h = measure(s, size, font)
+        r = self._map_rect(x, y, w, h)
+        if r is None:
+            return
+        self.ipp.damage(*r)
+        fb = self._framebuffer()
+        clipped = r != self._rotate_rect(x, y, w, h)
+        for name, gap in gfx_glyphs(font, s):
+            glyph = self._glyphs.get(font, name, size, self.rotation, self.displayMode, 1, bg)
+            gw, gh = glyph[2], glyph[3]
+            if glyph[0] is not None:
+                p = self._rotate_rect(x, y, gw, gh)
+                if not clipped:
+                    fb.blit(glyph[0], p[0], p[1], glyph[1])
+                else:
+                    gr = self._map_rect(x, y, gw, gh)
+                    if gr is not None:
+                        self._blit(glyph[0], glyph[1], p, gr)
+            if bg is not None and gap:
+                # gap between the characters
+                if clipped:
+                    p = self._map_rect(x + gw, y, size, gh)
+                else:
+                    p = self._rotate_rect(x + gw, y, size, gh)
+                if p is not None:
+                    fb.fill_rect(p[0], p[1], p[2], p[3], bg)
+            x += gw + size
+
+    # drawBitmap draws a 1-bit bitmap (MSB first, rows padded to a byte) with color c for the
+    # set bits, the clear bits are left alone unless a background color bg is given. data is
+    # either the raw bytes or a Bitmap, raw bytes get wrapped in a Bitmap the first time they
+    # are drawn so their conversions are reused.
+    def drawBitmap(self, x, y, data, w, h, c=1, bg=None):
+        if self._record(Inkplate.drawBitmap, (x, y, data, w, h, c, bg), x, y, w, h):
+            return
+        if not isinstance(data, Bitmap):
+            bitmap = self._bitmaps.get(id(data))
+            if bitmap is None or bitmap.data is not data or (bitmap.w, bitmap.h) != (w, h):
+                if len(self._bitmaps) >= 16:
+                    self._bitmaps = {}
+                bitmap = Bitmap(data, w, h)
+                self._bitmaps[id(data)] = bitmap
+            data = bitmap
+        r = self._map_rect(x, y, data.w, data.h)
+        if r is None:
+            return
+        self.ipp.damage(*r)
+        fb, key = data.get(self.rotation, self.displayMode, c, bg)
+        self._blit(fb, key, self._rotate_rect(x, y, data.w, data.h), r)
 
-    def drawImageFile(self, x, y, path, invert=False):
-        with open(path, "rb") as f:
-            header14 = f.read(14)
-            if header14[0] != 0x42 or header14[1] != 0x4D:
-                return 0
-            header40 = f.read(40)
-
-            w = int(
-                (header40[7] << 24)
-                + (header40[6] << 16)
-                + (header40[5] << 8)
-                + header40[4]
-            )
-            h = int(
-                (header40[11] << 24)
-                + (header40[10] << 16)
-                + (header40[9] << 8)
-                + header40[8]
-            )
-            dataStart = int((header14[11] << 8) + header14[10])
-
-            depth = int((header40[15] << 8) + header40[14])
-            totalColors = int((header40[33] << 8) + header40[32])
-
-            rowSize = 4 * ((depth * w + 31) // 32)
-
-            if totalColors == 0:
-                totalColors = 1 << depth
-
-            palette = None
-
-            if depth <= 8:
-                palette = [0 for i in range(totalColors)]
-                p = f.read(totalColors * 4)
-                for i in range(totalColors):
-                    palette[i] = (
-                        54 * p[i * 4] + 183 * p[i * 4 + 1] + 19 * p[i * 4 + 2]
-                    ) >> 14
-            # print(palette)
-            f.seek(dataStart)
-            for j in range(h):
-                # print(100 * j // h, "% complete")
-                buffer = f.read(rowSize)
-                for i in range(w):
-                    val = 0
-                    if depth == 1:
-                        px = int(
-                            invert
-                            ^ (palette[0] < palette[1])
-                            ^ bool(buffer[i >> 3] & (1 << (7 - i & 7)))
-                        )
-                        val = palette[px]
-                    elif depth == 4:
-                        px = (buffer[i >> 1] & (0x0F if i & 1 == 1 else 0xF0)) >> (
-                            0 if i & 1 else 4
-                        )
-                        val = palette[px]
-                        if invert:
-                            val = 3 - val
-                    elif depth == 8:
-                        px = buffer[i]
-                        val = palette[px]
-                        if invert:
-                            val = 3 - val
-                    elif depth == 16:
-                        px = (buffer[(i << 1) | 1] << 8) | buffer[(i << 1)]
-
-                        r = (px & 0x7C00) >> 7
-                        g = (px & 0x3E0) >> 2
-                        b = (px & 0x1F) << 3
-
-                        val = (54 * r + 183 * g + 19 * b) >> 14
-
-                        if invert:
-                            val = 3 - val
-                    elif depth == 24:
-                        r = buffer[i * 3]
-                        g = buffer[i * 3 + 1]
-                        b = buffer[i * 3 + 2]
-
-                        val = (54 * r + 183 * g + 19 * b) >> 14
-
-                        if invert:
-                            val = 3 - val
-                    elif depth == 32:
-                        r = buffer[i * 4]
-                        g = buffer[i * 4 + 1]
-                        b = buffer[i * 4 + 2]
-
-                        val = (54 * r + 183 * g + 19 * b) >> 14
-
-                        if invert:
-                            val = 3 - val
-
-                    if self.getDisplayMode() == self.INKPLATE_1BIT:
-                        val >>= 1
-
-                    self.drawPixel(x + i, y + h - j, val)
+    # drawImageFile draws an image file (see imagefile.py for the formats) with its top left
+    # corner at x, y, dither selects the dithering method (DITHER_*). JPEG files can be shrunk
+    # by a scale of 2, 4 or 8 while decoding, or drawn as a quick blocky preview. It returns 1
+    # if the image was drawn and 0 if the format isn't supported.
+    def drawImageFile(self, x, y, path, invert=False, dither=DITHER_NONE, scale=1, preview=False):
+        import imagefile
+
+        # images stream straight into the framebuffer, so what was recorded goes first
+        self.flushRecording()
 
+        return imagefile.draw_image(self, x, y, path, invert, dither, scale, preview)
@@ -0,0 +1,863 @@
+# Host-side simulator for the Inkplate 6 display pipeline.
+#
+# inkplate_sim lets the unmodified inkplate.py (including its viper functions) run on CPython.
+# Calling install() registers stand-ins for the MicroPython modules the driver imports
+# (micropython, machine, framebuf, uarray, uzlib, utime) and for the viper pointer builtins. The
+# ptr32() pointers aimed at the ESP32 GPIO W1TS/W1TC registers are routed into a register
+# model that records every write; the I2C bus carries a simulated MCP23017 I/O expander and
+# TPS65186 power regulator; and a model of the ED060SC7 panel follows the CL/LE/CKV/SPH/SPV
+# signals to rebuild what ends up on the glass.
+#
+# Usage:
+#   import inkplate_sim
+#   board = inkplate_sim.install()
+#   from inkplate import Inkplate
+#   ...
+#   board.stats()        # counters since the last board.reset_stats()
+#   board.panel.image()  # monochrome panel contents, packed like InkplateMono's framebuffer
+#
+# Nothing in here is meant to be copied to the device.
+import array as _array
+import builtins
+import sys
+import time
+import types
+import zlib
+
+# GPIO register addresses, these mirror the constants in inkplate.py
+ESP32_GPIO = 0x3FF44000
+GPIO_OUT_W1TS = ESP32_GPIO + 4 * 2
+GPIO_OUT_W1TC = ESP32_GPIO + 4 * 3
+GPIO_OUT1_W1TS = ESP32_GPIO + 4 * 5
+GPIO_OUT1_W1TC = ESP32_GPIO + 4 * 6
+EPD_DATA = 0x0E8C0030
+EPD_CL = 0x00000001  # in OUT0
+EPD_LE = 0x00000004  # in OUT0
+EPD_CKV = 0x00000001  # in OUT1
+EPD_SPH = 0x00000002  # in OUT1
+
+# Panel geometry
+D_ROWS = 600
+D_COLS = 800
+D_GROUPS = D_COLS // 4  # the panel takes 4 pixels (one byte) per CL pulse
+# vscan_start clocks 3 gate lines that are not connected to visible rows
+GATE_OFFSET = 3
+
+# I2C addresses of the devices hanging off the Inkplate's I2C bus
+MCP23017_ADDR = 0x20
+TPS65186_ADDR = 0x48
+
+# names of the MCP23017 pins as wired on the Inkplate 6, used for the toggle counters
+MCP_PINS = (
+    "EPD_OE",
+    "EPD_GMODE",
+    "EPD_SPV",
+    "TPS_WAKEUP",
+    "TPS_PWRUP",
+    "TPS_VCOM",
+    "TPS_INT",
+    "TPS_PWR_GOOD",
+    "GPIO0_PUP",
+    "VBAT_EN",
+    "TOUCH1",
+    "TOUCH2",
+    "TOUCH3",
+    "MCP_13",
+    "MCP_14",
+    "MCP_15",
+)
+
+# bit masks to operate on the 2-bit pixel codes of a whole row packed into one int
+_M01 = int("01" * D_COLS, 2)
+_MROW = (1 << (2 * D_COLS)) - 1
+
+
+# gpio2byte inverts inkplate's byte2gpio mapping: gpio data bits -> panel data byte
+def _gen_gpio2byte():
+    m = {}
+    for b in range(256):
+        g = (b & 0x3) << 4 | (b & 0xC) << 16 | (b & 0x10) << 19 | (b & 0xE0) << 20
+        m[g] = b
+    return m
+
+
+# Panel models the ED060SC7 source and gate drivers. Data bytes clocked in with CL are
+# shifted into the column register, LE transfers the column register to the row selected by
+# the gate driver, CKV advances the gate driver and SPV (on the MCP23017) restarts it.
+#
+# Each pixel is driven with a 2-bit code: 00=discharge, 01=black, 10=white, 11=no-change.
+# The panel keeps the last black/white drive of every pixel, which is exactly the image for
+# monochrome and partial updates, and a bounded history of whole frames so grayscale
+# waveforms can be decoded afterwards (see decode()).
+class Panel:
+    HISTORY = 64  # number of frames kept in the history
+
+    def __init__(self):
+        self.state = [0] * D_ROWS  # last black/white drive per pixel, 2 bits per pixel
+        self.frames = []  # history of frames, each a list of D_ROWS drive ints (or None)
+        self._frame = None
+        self._col = bytearray(D_GROUPS)
+        self._ci = 0
+        self._gate = -1
+        self._spv = 1
+        self.rows_latched = 0
+        self.phases = 0
+        self.overruns = 0  # CL pulses beyond the end of the column register
+
+    # sph is called when SPH goes low (start of row): rewind the column register
+    def sph(self):
+        self._ci = 0
+
+    # clock shifts one data byte into the column register
+    def clock(self, data):
+        ci = self._ci
+        if ci < D_GROUPS:
+            self._col[ci] = data
+        else:
+            self.overruns += 1
+        self._ci = ci + 1
+
+    # ckv is called on the rising edge of CKV, it moves the gate driver along
+    def ckv(self):
+        if not self._spv:
+            # start pulse: a new frame (phase) begins
+            self._gate = 0
+            self._frame = [None] * D_ROWS
+            self.frames.append(self._frame)
+            if len(self.frames) > self.HISTORY:
+                del self.frames[0]
+            self.phases += 1
+        elif self._gate >= 0:
+            self._gate += 1
+
+    def spv(self, v):
+        self._spv = v
+
+    # latch applies the column register to the row currently selected by the gate driver
+    def latch(self):
+        row = D_ROWS - 1 - (self._gate - GATE_OFFSET)
+        if self._gate < GATE_OFFSET or row < 0 or self._frame is None:
+            return
+        self.rows_latched += 1
+        # the first byte clocked in ends up at the right edge of the row, within a byte the
+        # low bit pair is the leftmost pixel, so a big-endian conversion puts pixel x at
+        # bits 2x..2x+1
+        d = int.from_bytes(self._col, "big")
+        self._frame[row] = d
+        active = ((d >> 1) ^ d) & _M01  # pixels driven black or white
+        amask = active | (active << 1)
+        self.state[row] = (self.state[row] & ~amask & _MROW) | (d & amask)
+
+    # code returns the 2-bit drive code of pixel x,y in a frame of the history
+    def code(self, x, y, frame=-1):
+        d = self.frames[frame][y]
+        return 3 if d is None else (d >> (2 * x)) & 3
+
+    # image returns the panel contents as a MONO_HMSB buffer (1=black) comparable to the
+    # framebuffer of InkplateMono; pixels that were never driven read as white
+    def image(self):
+        out = bytearray(D_ROWS * D_COLS // 8)
+        ix = 0
+        for row in self.state:
+            black = row & ~(row >> 1) & _M01
+            for x8 in range(D_COLS // 8):
+                b = (black >> (16 * x8)) & 0xFFFF
+                if b:
+                    v = 0
+                    for bit in range(8):
+                        v |= ((b >> (2 * bit)) & 1) << bit
+                    out[ix] = v
+                ix += 1
+        return out
+
+    # decode matches the last len(codes[0]) frames against per-level drive sequences and
+    # returns a bytearray with one gray level per pixel (row-major), 0xFF where no level
+    # matches. codes[level] is the list of 2-bit codes sent to a pixel of that level in each
+    # phase, e.g. as found in InkplateGS2._wave. skip ignores that many of the most recent
+    # frames, e.g. the clean frames that follow the waveform in display().
+    def decode(self, codes, skip=0):
+        n = len(codes[0])
+        frames = self.frames[len(self.frames) - n - skip : len(self.frames) - skip]
+        if len(frames) < n:
+            raise ValueError("not enough frames in the history")
+        out = bytearray(b"\xff" * (D_ROWS * D_COLS))
+        for y in range(D_ROWS):
+            for level in range(len(codes)):
+                match = _M01
+                for p in range(n):
+                    d = frames[p][y]
+                    if d is None:
+                        d = _MROW
+                    want = codes[level][p] * _M01
+                    diff = d ^ want
+                    match &= ~(diff | (diff >> 1)) & _M01
+                    if not match:
+                        break
+                x = 0
+                while match:
+                    if match & 1:
+                        out[y * D_COLS + x] = level
+                    match >>= 2
+                    x += 1
+        return out
+
+    def reset_history(self):
+        self.frames = []
+        self._frame = None
+
+
+# GPIO models the ESP32 output registers for gpio 0..39 and forwards edges on the display
+# control lines to the panel. Writes via the W1TS/W1TC registers are counted per register,
+# writes through machine.Pin are counted separately as pin writes.
+class GPIO:
+    def __init__(self, panel):
+        self.panel = panel
+        self.out0 = 0
+        self.out1 = 0
+        self.writes = [0, 0, 0, 0]  # W1TS0, W1TC0, W1TS1, W1TC1
+        self.pin_writes = 0
+        self.cl_pulses = 0
+        self.le_pulses = 0
+        self.ckv_pulses = 0
+        self.sph_pulses = 0
+        self._gpio2byte = _gen_gpio2byte()
+
+    def w1ts0(self, v):
+        self.writes[0] += 1
+        out = self.out0
+        new = out | v
+        self.out0 = new
+        if v & ~out & EPD_CL:
+            self.cl_pulses += 1
+            self.panel.clock(self._gpio2byte[new & EPD_DATA])
+        if v & ~out & EPD_LE:
+            self.le_pulses += 1
+            self.panel.latch()
+
+    def w1tc0(self, v):
+        self.writes[1] += 1
+        self.out0 &= ~v
+
+    def w1ts1(self, v):
+        self.writes[2] += 1
+        out = self.out1
+        self.out1 = out | v
+        if v & ~out & EPD_CKV:
+            self.ckv_pulses += 1
+            self.panel.ckv()
+
+    def w1tc1(self, v):
+        self.writes[3] += 1
+        out = self.out1
+        self.out1 = out & ~v
+        if v & out & EPD_SPH:
+            self.sph_pulses += 1
+            self.panel.sph()
+
+    # set_pin is used by machine.Pin, it goes through the same edge detection but is counted
+    # as a pin write rather than a register write
+    def set_pin(self, num, v):
+        self.pin_writes += 1
+        if num < 32:
+            bit = 1 << num
+            if v:
+                self.w1ts0(bit)
+            else:
+                self.w1tc0(bit)
+            self.writes[0 if v else 1] -= 1
+        else:
+            bit = 1 << (num - 32)
+            if v:
+                self.w1ts1(bit)
+            else:
+                self.w1tc1(bit)
+            self.writes[2 if v else 3] -= 1
+
+    def get_pin(self, num):
+        if num < 32:
+            return (self.out0 >> num) & 1
+        return (self.out1 >> (num - 32)) & 1
+
+
+# _RegPtr is what ptr32() returns for the GPIO set/clear registers. The viper code only
+# indexes the W1TS0 and W1TC0 pointers with 0 and with the offset to the W1Tx1 register.
+class _RegPtr:
+    def __init__(self, gpio, addr):
+        self._addr = addr
+        handlers = {
+            GPIO_OUT_W1TS: gpio.w1ts0,
+            GPIO_OUT_W1TC: gpio.w1tc0,
+            GPIO_OUT1_W1TS: gpio.w1ts1,
+            GPIO_OUT1_W1TC: gpio.w1tc1,
+        }
+        self._handlers = {}
+        for a, h in handlers.items():
+            if (a - addr) % 4 == 0:
+                self._handlers[(a - addr) // 4] = h
+        self._gpio = gpio
+
+    def __setitem__(self, i, v):
+        try:
+            h = self._handlers[i]
+        except KeyError:
+            raise ValueError("write to unsimulated register 0x%08x" % (self._addr + 4 * i))
+        h(v & 0xFFFFFFFF)
+
+    def __getitem__(self, i):
+        a = self._addr + 4 * i
+        if a == ESP32_GPIO + 4:
+            return self._gpio.out0
+        if a == ESP32_GPIO + 4 * 4:
+            return self._gpio.out1
+        raise ValueError("read from unsimulated register 0x%08x" % a)
+
+
+# MCP23017Device is a register-level model of the I/O expander. Writes to GPIO/OLAT are
+# diffed to count the toggles of every pin and to forward SPV to the panel.
+class MCP23017Device:
+    IODIR = 0x00
+    GPPU = 0x0C
+    GPIO = 0x12
+    OLAT = 0x14
+
+    def __init__(self, board):
+        self.board = board
+        self.regs = bytearray(0x16)
+        self.regs[0] = self.regs[1] = 0xFF
+        self.inputs = 0x0080  # TPS_PWR_GOOD reads high, touch pads read low
+        self.toggles = [0] * 16
+        self.writes = 0
+        self.reads = 0
+
+    def _olat(self):
+        return self.regs[self.OLAT] | self.regs[self.OLAT + 1] << 8
+
+    def write(self, reg, data):
+        self.writes += 1
+        old = self._olat()
+        for i, v in enumerate(data):
+            r = reg + i
+            if r >= len(self.regs):
+                break
+            if r in (self.GPIO, self.GPIO + 1):
+                r += self.OLAT - self.GPIO  # writes to GPIO land in OLAT
+            self.regs[r] = v
+        new = self._olat()
+        changed = old ^ new
+        for pin in range(16):
+            if changed >> pin & 1:
+                self.toggles[pin] += 1
+                self.board.mcp_pin(MCP_PINS[pin], (new >> pin) & 1)
+
+    def read(self, reg, n):
+        self.reads += 1
+        out = bytearray(n)
+        for i in range(n):
+            r = reg + i
+            if r in (self.GPIO, self.GPIO + 1):
+                bank = r - self.GPIO
+                iodir = self.regs[self.IODIR + bank]
+                v = (self.regs[self.OLAT + bank] & ~iodir) | ((self.inputs >> (8 * bank)) & iodir)
+                out[i] = v & 0xFF
+            elif r < len(self.regs):
+                out[i] = self.regs[r]
+        return bytes(out)
+
+
+# TPS65186Device models the e-paper PMIC: register writes are recorded and a write of 0x80
+# to TMST1 (0x0D) loads the simulated temperature into TMST_VALUE (0x00).
+class TPS65186Device:
+    TMST_VALUE = 0x00
+    TMST1 = 0x0D
+
+    def __init__(self, board):
+        self.board = board
+        self.regs = bytearray(0x11)
+        self.temperature = 22  # degrees C, change to test temperature dependent code
+        self.log = []  # (op, reg, bytes) of every transaction
+
+    def write(self, reg, data):
+        self.log.append(("w", reg, bytes(data)))
+        for i, v in enumerate(data):
+            if reg + i < len(self.regs):
+                self.regs[reg + i] = v
+        if reg == self.TMST1 and data[0] & 0x80:
+            self.regs[self.TMST_VALUE] = self.temperature & 0xFF
+
+    def read(self, reg, n):
+        out = bytes(self.regs[reg : reg + n])
+        self.log.append(("r", reg, out))
+        return out
+
+
+# Board ties the register model, panel and I2C devices together and reports statistics.
+class Board:
+    def __init__(self):
+        self.panel = Panel()
+        self.gpio = GPIO(self.panel)
+        self.mcp23017 = MCP23017Device(self)
+        self.tps65186 = TPS65186Device(self)
+        self.i2c_devices = {MCP23017_ADDR: self.mcp23017, TPS65186_ADDR: self.tps65186}
+        self.sleep_us = 0  # total time requested through sleep_ms/sleep_us
+        self.deepsleep_ms = None  # set when machine.deepsleep() is called
+
+    def mcp_pin(self, name, v):
+        if name == "EPD_SPV":
+            self.panel.spv(v)
+
+    # stats returns a dict with all counters
+    def stats(self):
+        g = self.gpio
+        p = self.panel
+        s = {
+            "w1ts0": g.writes[0],
+            "w1tc0": g.writes[1],
+            "w1ts1": g.writes[2],
+            "w1tc1": g.writes[3],
+            "reg_writes": sum(g.writes),
+            "pin_writes": g.pin_writes,
+            "cl_pulses": g.cl_pulses,
+            "le_pulses": g.le_pulses,
+            "ckv_pulses": g.ckv_pulses,
+            "rows_latched": p.rows_latched,
+            "phases": p.phases,
+            "mcp_writes": self.mcp23017.writes,
+            "mcp_toggles": sum(self.mcp23017.toggles),
+            "tps_transactions": len(self.tps65186.log),
+            "sleep_us": self.sleep_us,
+        }
+        for pin, n in enumerate(self.mcp23017.toggles):
+            if n:
+                s["toggle_" + MCP_PINS[pin]] = n
+        return s
+
+    def reset_stats(self):
+        g = self.gpio
+        g.writes = [0, 0, 0, 0]
+        g.pin_writes = g.cl_pulses = g.le_pulses = g.ckv_pulses = g.sph_pulses = 0
+        self.panel.rows_latched = self.panel.phases = self.panel.overruns = 0
+        self.panel.reset_history()
+        self.mcp23017.toggles = [0] * 16
+        self.mcp23017.writes = self.mcp23017.reads = 0
+        self.tps65186.log = []
+        self.sleep_us = 0
+
+
+board = None
+
+# ===== Stand-ins for MicroPython modules
+
+
+def _identity(f):
+    return f
+
+
+# _viper checks what the firmware's code emitter would reject when compiling the module, so
+# it doesn't only show up on the board: MicroPython 1.12 viper functions take at most 4
+# arguments.
+def _viper(f):
+    code = getattr(f, "__func__", f).__code__
+    if code.co_argcount > 4:
+        raise SyntaxError(
+            "%s: viper functions don't support more than 4 arguments" % code.co_name
+        )
+    return f
+
+
+def _make_micropython():
+    m = types.ModuleType("micropython")
+    m.const = _identity
+    m.viper = _viper
+    m.native = _identity
+    m.mem_info = lambda *a: None
+    m.alloc_emergency_exception_buf = lambda n: None
+    return m
+
+
+# ptr8/ptr16/ptr32 give viper-style access to buffers. Pointers to the GPIO registers turn
+# into register views, pointers to buffers just index the buffer.
+def _ptr(obj):
+    if isinstance(obj, int):
+        if ESP32_GPIO <= obj < ESP32_GPIO + 0x100:
+            return _RegPtr(board.gpio, obj)
+        raise ValueError("pointer to unsimulated memory 0x%08x" % obj)
+    return obj
+
+
+def _ptr16(obj):
+    if isinstance(obj, int):
+        return _ptr(obj)
+    return memoryview(obj).cast("B").cast("H")
+
+
+def _ptr32(obj):
+    if isinstance(obj, (int, _array.array)):
+        return _ptr(obj)
+    return memoryview(obj).cast("B").cast("I")
+
+
+def _make_machine():
+    m = types.ModuleType("machine")
+
+    class Pin:
+        IN = 1
+        OUT = 3
+        OPEN_DRAIN = 7
+        PULL_UP = 2
+        PULL_DOWN = 1
+
+        def __init__(self, num, mode=-1, pull=-1, value=None):
+            self.num = num
+            self.init(mode, pull, value=value)
+
+        def init(self, mode=-1, pull=-1, value=None):
+            if value is not None:
+                self.value(value)
+
+        def value(self, v=None):
+            if v is None:
+                return board.gpio.get_pin(self.num)
+            board.gpio.set_pin(self.num, 1 if v else 0)
+
+        __call__ = value
+
+        def on(self):
+            self.value(1)
+
+        def off(self):
+            self.value(0)
+
+    class I2C:
+        def __init__(self, id=-1, scl=None, sda=None, freq=400000):
+            pass
+
+        def _dev(self, addr):
+            try:
+                return board.i2c_devices[addr]
+            except KeyError:
+                raise OSError(19)  # ENODEV, what the ESP32 port raises on a NACK
+
+        def writeto_mem(self, addr, reg, buf):
+            self._dev(addr).write(reg, bytes(buf))
+
+        def readfrom_mem(self, addr, reg, n):
+            return self._dev(addr).read(reg, n)
+
+        def readfrom_mem_into(self, addr, reg, buf):
+            buf[:] = self._dev(addr).read(reg, len(buf))
+
+        def scan(self):
+            return sorted(board.i2c_devices)
+
+    class SPI:
+        def __init__(self, *args, **kwargs):
+            raise OSError("SPI is not simulated")
+
+    def deepsleep(ms=0):
+        board.deepsleep_ms = ms
+        raise SystemExit("machine.deepsleep(%d)" % ms)
+
+    m.Pin = Pin
+    m.I2C = I2C
+    m.SPI = SPI
+    m.deepsleep = deepsleep
+    m.reset_cause = lambda: 0
+    m.DEEPSLEEP_RESET = 4
+    m.PWRON_RESET = 1
+    m.freq = lambda *a: 240000000
+    return m
+
+
+# array.extend on MicroPython only takes objects with the buffer protocol, not any iterable
+class _Array(_array.array):
+    def extend(self, other):
+        memoryview(other)
+        super().extend(other)
+
+
+# array("L") is 32 bits on the ESP32 but usually 64 bits on CPython, map it to "I"
+def _make_uarray():
+    m = types.ModuleType("uarray")
+
+    def array(typecode, init=()):
+        typecode = {"L": "I", "l": "i"}.get(typecode, typecode)
+        if isinstance(init, (bytes, bytearray)):
+            a = _Array(typecode)
+            a.frombytes(init)
+            return a
+        return _Array(typecode, init)
+
+    m.array = array
+    return m
+
+
+# uzlib.DecompIO on top of zlib.decompressobj, wbits has the same meaning in both. The source
+# stream only needs a readinto method.
+def _make_uzlib():
+    m = types.ModuleType("uzlib")
+
+    class DecompIO:
+        def __init__(self, stream, wbits=0):
+            self._stream = stream
+            self._z = zlib.decompressobj(wbits)
+            self._out = b""
+            self._chunk = bytearray(512)
+
+        def read(self, n=-1):
+            while (n < 0 or len(self._out) < n) and not self._z.eof:
+                k = self._stream.readinto(self._chunk)
+                if not k:
+                    break
+                self._out += self._z.decompress(bytes(self._chunk[:k]))
+            if n < 0:
+                n = len(self._out)
+            data, self._out = self._out[:n], self._out[n:]
+            return data
+
+        def readinto(self, buf):
+            data = self.read(len(buf))
+            buf[: len(data)] = data
+            return len(data)
+
+    m.DecompIO = DecompIO
+    m.decompress = lambda data, wbits=0, bufsize=0: zlib.decompress(data, wbits)
+    return m
+
+
+def _sleep_ms(ms):
+    board.sleep_us += ms * 1000
+
+
+def _sleep_us(us):
+    board.sleep_us += us
+
+
+def _ticks_ms():
+    return int(time.perf_counter() * 1000)
+
+
+def _ticks_us():
+    return int(time.perf_counter() * 1000000)
+
+
+def _ticks_diff(a, b):
+    return a - b
+
+
+def _ticks_add(a, b):
+    return a + b
+
+
+# ===== framebuf: a straightforward pure-python version of MicroPython's framebuf module
+
+
+MONO_VLSB = 0
+RGB565 = 1
+GS4_HMSB = 2
+MONO_HLSB = 3
+MONO_HMSB = 4
+GS2_HMSB = 5
+GS8 = 6
+
+
+class FrameBuffer:
+    def __init__(self, buf, width, height, format, stride=None):
+        self._buf = buf
+        self.width = width
+        self.height = height
+        self.format = format
+        if stride is None:
+            stride = width
+        if format in (MONO_HLSB, MONO_HMSB):
+            stride = (stride + 7) & ~7
+        elif format == GS2_HMSB:
+            stride = (stride + 3) & ~3
+        elif format == GS4_HMSB:
+            stride = (stride + 1) & ~1
+        self.stride = stride
+        try:
+            self._set, self._get = {
+                MONO_VLSB: (self._set_vlsb, self._get_vlsb),
+                RGB565: (self._set_rgb565, self._get_rgb565),
+                GS4_HMSB: (self._set_gs4, self._get_gs4),
+                MONO_HLSB: (self._set_hlsb, self._get_hlsb),
+                MONO_HMSB: (self._set_hmsb, self._get_hmsb),
+                GS2_HMSB: (self._set_gs2, self._get_gs2),
+                GS8: (self._set_gs8, self._get_gs8),
+            }[format]
+        except KeyError:
+            raise ValueError("invalid format")
+
+    def _set_vlsb(self, x, y, c):
+        i = (y >> 3) * self.stride + x
+        b = 1 << (y & 7)
+        self._buf[i] = (self._buf[i] | b) if c & 1 else (self._buf[i] & ~b)
+
+    def _get_vlsb(self, x, y):
+        return (self._buf[(y >> 3) * self.stride + x] >> (y & 7)) & 1
+
+    def _set_hlsb(self, x, y, c):
+        i = (x + y * self.stride) >> 3
+        b = 0x80 >> (x & 7)
+        self._buf[i] = (self._buf[i] | b) if c & 1 else (self._buf[i] & ~b)
+
+    def _get_hlsb(self, x, y):
+        return (self._buf[(x + y * self.stride) >> 3] >> (7 - (x & 7))) & 1
+
+    def _set_hmsb(self, x, y, c):
+        i = (x + y * self.stride) >> 3
+        b = 1 << (x & 7)
+        self._buf[i] = (self._buf[i] | b) if c & 1 else (self._buf[i] & ~b)
+
+    def _get_hmsb(self, x, y):
+        return (self._buf[(x + y * self.stride) >> 3] >> (x & 7)) & 1
+
+    def _set_gs2(self, x, y, c):
+        i = (x + y * self.stride) >> 2
+        s = (x & 3) << 1
+        self._buf[i] = (self._buf[i] & ~(3 << s)) | ((c & 3) << s)
+
+    def _get_gs2(self, x, y):
+        return (self._buf[(x + y * self.stride) >> 2] >> ((x & 3) << 1)) & 3
+
+    def _set_gs4(self, x, y, c):
+        i = (x + y * self.stride) >> 1
+        if x & 1:
+            self._buf[i] = (c & 0x0F) | (self._buf[i] & 0xF0)
+        else:
+            self._buf[i] = ((c & 0x0F) << 4) | (self._buf[i] & 0x0F)
+
+    def _get_gs4(self, x, y):
+        b = self._buf[(x + y * self.stride) >> 1]
+        return b & 0x0F if x & 1 else b >> 4
+
+    def _set_gs8(self, x, y, c):
+        self._buf[x + y * self.stride] = c & 0xFF
+
+    def _get_gs8(self, x, y):
+        return self._buf[x + y * self.stride]
+
+    def _set_rgb565(self, x, y, c):
+        i = 2 * (x + y * self.stride)
+        self._buf[i] = c & 0xFF
+        self._buf[i + 1] = (c >> 8) & 0xFF
+
+    def _get_rgb565(self, x, y):
+        i = 2 * (x + y * self.stride)
+        return self._buf[i] | self._buf[i + 1] << 8
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        if c is None:
+            return self._get(x, y)
+        self._set(x, y, c)
+
+    def fill_rect(self, x, y, w, h, c):
+        if w < 1 or h < 1 or x + w <= 0 or y + h <= 0 or y >= self.height or x >= self.width:
+            return
+        xend = min(self.width, x + w)
+        yend = min(self.height, y + h)
+        x = max(x, 0)
+        y = max(y, 0)
+        s = self._set
+        for yy in range(y, yend):
+            for xx in range(x, xend):
+                s(xx, yy, c)
+
+    def fill(self, c):
+        # fast path for the full-width formats used by the Inkplate
+        if self.format == MONO_HMSB and self.stride == self.width:
+            self._buf[:] = (b"\xff" if c & 1 else b"\x00") * len(self._buf)
+        elif self.format == GS2_HMSB and self.stride == self.width:
+            self._buf[:] = bytes([(c & 3) * 0x55]) * len(self._buf)
+        elif self.format == GS4_HMSB and self.stride == self.width:
+            self._buf[:] = bytes([(c & 15) * 0x11]) * len(self._buf)
+        else:
+            self.fill_rect(0, 0, self.width, self.height, c)
+
+    def hline(self, x, y, w, c):
+        self.fill_rect(x, y, w, 1, c)
+
+    def vline(self, x, y, h, c):
+        self.fill_rect(x, y, 1, h, c)
+
+    def rect(self, x, y, w, h, c):
+        self.fill_rect(x, y, w, 1, c)
+        self.fill_rect(x, y + h - 1, w, 1, c)
+        self.fill_rect(x, y, 1, h, c)
+        self.fill_rect(x + w - 1, y, 1, h, c)
+
+    def line(self, x0, y0, x1, y1, c):
+        dx = abs(x1 - x0)
+        dy = -abs(y1 - y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        err = dx + dy
+        while True:
+            self.pixel(x0, y0, c)
+            if x0 == x1 and y0 == y1:
+                break
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x0 += sx
+            if e2 <= dx:
+                err += dx
+                y0 += sy
+
+    def blit(self, fbuf, x, y, key=-1):
+        for yy in range(fbuf.height):
+            ty = y + yy
+            if ty < 0 or ty >= self.height:
+                continue
+            for xx in range(fbuf.width):
+                tx = x + xx
+                if tx < 0 or tx >= self.width:
+                    continue
+                c = fbuf._get(xx, yy)
+                if c != key:
+                    self._set(tx, ty, c)
+
+    def scroll(self, xstep, ystep):
+        src = FrameBuffer(bytearray(self._buf), self.width, self.height, self.format, self.stride)
+        self.blit(src, xstep, ystep)
+
+
+def _make_framebuf():
+    m = types.ModuleType("framebuf")
+    m.FrameBuffer = FrameBuffer
+    m.FrameBuffer1 = FrameBuffer
+    m.MONO_VLSB = m.MVLSB = MONO_VLSB
+    m.RGB565 = RGB565
+    m.GS4_HMSB = GS4_HMSB
+    m.MONO_HLSB = MONO_HLSB
+    m.MONO_HMSB = MONO_HMSB
+    m.GS2_HMSB = GS2_HMSB
+    m.GS8 = GS8
+    return m
+
+
+# install registers the simulator, it must be called before inkplate is imported. It returns
+# the Board, calling it again returns the same Board.
+def install():
+    global board
+    if board is not None:
+        return board
+    board = Board()
+    sys.modules["micropython"] = _make_micropython()
+    sys.modules["machine"] = _make_machine()
+    sys.modules["framebuf"] = _make_framebuf()
+    sys.modules["uarray"] = _make_uarray()
+    sys.modules["uzlib"] = _make_uzlib()
+    time.sleep_ms = _sleep_ms
+    time.sleep_us = _sleep_us
+    time.ticks_ms = _ticks_ms
+    time.ticks_us = _ticks_us
+    time.ticks_diff = _ticks_diff
+    time.ticks_add = _ticks_add
+    sys.modules["utime"] = time
+    builtins.ptr8 = _ptr
+    builtins.ptr16 = _ptr16
+    builtins.ptr32 = _ptr32
+    return board
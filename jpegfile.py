@@ -0,0 +1,453 @@
+# Baseline JPEG decoding for Inkplate.drawImageFile, see imagefile.py.
+#
+# Only the luminance (Y) of an image is needed for a gray display, so the chroma blocks get
+# entropy decoded to skip over them but are never transformed. The image is decoded a row of
+# MCUs (minimum coded units, 8 or 16 lines of blocks) at a time into a band buffer, and the
+# band's rows are handed to a RowSink like the rows of any other image. Memory use is the
+# band (image width x 16 bytes at most), a 4KB input buffer and about 10KB of tables.
+#
+# scale shrinks the image by 2, 4 or 8 while decoding: the IDCT only computes 8 / scale
+# pixels per block direction from the lowest frequencies (a reduced IDCT), which is both
+# faster and better looking than dropping pixels. At a scale of 8 only the DC coefficient of
+# each block is used. preview decodes just the DC coefficients as well but draws every block
+# as a flat square at the requested scale, which shows the whole image a lot faster than a
+# full decode and can be followed by one.
+#
+# Only baseline JPEG is supported: sequential Huffman coded files (SOF0, or SOF1 with 8-bit
+# samples), gray or YCbCr with any subsampling and restart intervals. Progressive and
+# arithmetic coded files are rejected, convert them to baseline on the host first, e.g. with
+# jpegtran.
+import math
+import micropython
+import struct
+from uarray import array
+
+from imagefile import _BATCH, DITHER_NONE, RowSink
+
+_REFILL = _BATCH // 2  # refill the input buffer when less than this is left before an MCU
+
+# layout of the tables used by _decode_mcu, all 16-bit
+_ZIGZAG = 0  # natural order index of each zigzag coefficient
+_BLOCKS = 64  # per block of an MCU: DC table, AC table, quantization table, comp << 8 | slot
+_QUANT = 104  # 4 quantization tables of 64 entries in zigzag order
+_HUFF = 360  # 4 Huffman tables (DC 0, DC 1, AC 0, AC 1), see _huffman
+_HUFF_SIZE = 820
+_TABLES = _HUFF + 4 * _HUFF_SIZE
+
+_NO_SLOT = 0xFF  # block isn't stored
+
+# state of _decode_mcu: input position and end, bit buffer and count, marker seen, blocks per
+# MCU, DC only, then the DC predictions of up to 4 components
+_POS = 0
+_END = 1
+_BITS = 2
+_COUNT = 3
+_MARKER = 4
+_NBLOCKS = 5
+_DC_ONLY = 6
+_PRED = 8
+
+_ZIGZAG_ORDER = bytes(
+    (
+        0, 1, 8, 16, 9, 2, 3, 10,
+        17, 24, 32, 25, 18, 11, 4, 5,
+        12, 19, 26, 33, 40, 48, 41, 34,
+        27, 20, 13, 6, 7, 14, 21, 28,
+        35, 42, 49, 56, 57, 50, 43, 36,
+        29, 22, 15, 23, 30, 37, 44, 51,
+        58, 59, 52, 45, 38, 31, 39, 46,
+        53, 60, 61, 54, 47, 55, 62, 63,
+    )
+)  # fmt: skip
+
+
+# _decode_mcu entropy decodes the blocks of an MCU from data (see _TABLES and the state in st
+# for the layout) and stores the dequantized coefficients of the blocks with a slot in coefs,
+# 64 per slot in natural order. With DC only set just the DC coefficient gets stored. Past a
+# marker or the end of the data it reads zeros. It returns 1 if the data is corrupt.
+@micropython.viper
+def _decode_mcu(st_in, data, tables, coefs):
+    st = ptr32(st_in)
+    d = ptr8(data)
+    t = ptr16(tables)
+    c = ptr16(coefs)
+    pos = st[0]
+    end = st[1]
+    bits = st[2]
+    cnt = st[3]
+    marker = st[4]
+    nblocks = st[5]
+    dc_only = st[6]
+    b = 0
+    while b < nblocks:
+        desc = 64 + (b << 2)
+        q = int(t[desc + 2])
+        comp = int(t[desc + 3]) >> 8
+        slot = int(t[desc + 3]) & 0xFF
+        base = slot << 6
+        if slot != 0xFF and not dc_only:
+            i = 0
+            while i < 64:
+                c[base + i] = 0
+                i += 1
+        k = 0
+        while k < 64:
+            # at least 17 bits for the longest code
+            while cnt <= 16:
+                v = 0
+                if not marker and pos < end:
+                    v = int(d[pos])
+                    if v != 0xFF:
+                        pos += 1
+                    elif pos + 1 < end and d[pos + 1] == 0:
+                        pos += 2  # stuffed zero byte
+                    else:
+                        marker = 1
+                        v = 0
+                bits = ((bits << 8) | v) & 0xFFFFFF
+                cnt += 8
+            h = int(t[desc + 1])
+            if k == 0:
+                h = int(t[desc])
+            e = int(t[h + ((bits >> (cnt - 9)) & 0x1FF)])
+            if e:
+                cnt -= e >> 8
+                sym = e & 0xFF
+            else:
+                n = 10
+                code = 0
+                while n <= 16:
+                    code = (bits >> (cnt - n)) & ((1 << n) - 1)
+                    if code < int(t[h + 512 + n]):
+                        break
+                    n += 1
+                if n > 16:
+                    return 1
+                cnt -= n
+                sym = int(t[h + 563 + int(t[h + 546 + n]) + code - int(t[h + 529 + n])])
+            # and enough for the value that follows
+            while cnt <= 16:
+                v = 0
+                if not marker and pos < end:
+                    v = int(d[pos])
+                    if v != 0xFF:
+                        pos += 1
+                    elif pos + 1 < end and d[pos + 1] == 0:
+                        pos += 2
+                    else:
+                        marker = 1
+                        v = 0
+                bits = ((bits << 8) | v) & 0xFFFFFF
+                cnt += 8
+            s = sym & 15
+            if k > 0:
+                if s == 0:
+                    if sym != 0xF0:
+                        break  # end of block
+                    k += 16
+                    continue
+                k += sym >> 4
+                if k > 63:
+                    return 1
+            v = 0
+            if s:
+                v = (bits >> (cnt - s)) & ((1 << s) - 1)
+                cnt -= s
+                if v < (1 << (s - 1)):
+                    v -= (1 << s) - 1
+            if k == 0:
+                v += int(st[8 + comp])
+                st[8 + comp] = v
+            if slot != 0xFF and (k == 0 or not dc_only):
+                v *= int(t[q + k])
+                if v > 32767:
+                    v = 32767
+                elif v < -32768:
+                    v = -32768
+                c[base + int(t[k])] = v & 0xFFFF
+            k += 1
+        b += 1
+    st[0] = pos
+    st[2] = bits
+    st[3] = cnt
+    st[4] = marker
+    return 0
+
+
+# _idct transforms the 64 coefficients of a block into n x n pixels at ix of out, using the
+# lowest n x n frequencies. mat holds the n-point IDCT matrix (see _idct_matrix) at 0..63,
+# room for the intermediate values at 64..127, n at 128 and the row stride of out at 129.
+@micropython.viper
+def _idct(coefs, out, mat, ix: int):
+    c = ptr16(coefs)
+    o = ptr8(out)
+    m = ptr16(mat)
+    n = int(m[128])
+    stride = int(m[129])
+    # columns, keeping 4 fractional bits
+    u = 0
+    while u < n:
+        y = 0
+        while y < n:
+            s = 0
+            v = 0
+            while v < n:
+                f = int(c[(v << 3) + u])
+                if f:
+                    s += ((f ^ 0x8000) - 0x8000) * ((int(m[(y << 3) + v]) ^ 0x8000) - 0x8000)
+                v += 1
+            s = (s + 128) >> 8
+            if s > 32767:
+                s = 32767
+            elif s < -32768:
+                s = -32768
+            m[64 + (y << 3) + u] = s & 0xFFFF
+            y += 1
+        u += 1
+    # rows, level shifted and clamped
+    y = 0
+    while y < n:
+        x = 0
+        while x < n:
+            s = 0
+            u = 0
+            while u < n:
+                f = int(m[64 + (y << 3) + u])
+                if f:
+                    s += ((f ^ 0x8000) - 0x8000) * ((int(m[(x << 3) + u]) ^ 0x8000) - 0x8000)
+                u += 1
+            s = ((s + 32768) >> 16) + 128
+            if s < 0:
+                s = 0
+            elif s > 255:
+                s = 255
+            o[ix + x] = s
+            x += 1
+        ix += stride
+        y += 1
+
+
+# _expand repeats each pixel of src r times to fill n pixels of dst
+@micropython.viper
+def _expand(src, dst, n: int, r: int):
+    s = ptr8(src)
+    d = ptr8(dst)
+    i = 0
+    k = 0
+    left = r
+    while i < n:
+        d[i] = s[k]
+        i += 1
+        left -= 1
+        if left == 0:
+            left = r
+            k += 1
+
+
+# _idct_matrix returns the matrix for an n-point IDCT of the lowest frequencies of an 8-point
+# DCT, scaled so that its outputs are the averages of 8 / n pixels
+def _idct_matrix(n, stride):
+    mat = array("H", bytes(2 * 130))
+    for y in range(n):
+        for v in range(n):
+            m = 0.5 * math.cos((2 * y + 1) * v * math.pi / (2 * n))
+            if v == 0:
+                m /= math.sqrt(2)
+            mat[y * 8 + v] = int(round(m * 4096)) & 0xFFFF
+    mat[128] = n
+    mat[129] = stride
+    return mat
+
+
+# _huffman fills the Huffman table at h of tables from the code counts per length (16 bytes)
+# and the symbols. The table has a lookup of codes up to 9 bits (length << 8 | symbol, 0 for
+# longer codes) at 0..511, and per length the largest code + 1 (0 if there are none) at
+# 512..528, the first code at 529..545 and the index of its symbol at 546..562, followed by
+# the symbols at 563.
+def _huffman(tables, h, counts, symbols):
+    for i in range(512):
+        tables[h + i] = 0
+    code = 0
+    k = 0
+    for n in range(1, 17):
+        tables[h + 529 + n] = code
+        tables[h + 546 + n] = k
+        for _ in range(counts[n - 1]):
+            if n <= 9:
+                e = (n << 8) | symbols[k]
+                first = code << (9 - n)
+                for i in range(first, first + (1 << (9 - n))):
+                    tables[h + i] = e
+            code += 1
+            k += 1
+        tables[h + 512 + n] = code if counts[n - 1] else 0
+        code <<= 1
+    for i in range(len(symbols)):
+        tables[h + 563 + i] = symbols[i]
+
+
+# draw_jpeg draws a baseline JPEG file, see draw_image. scale is 1, 2, 4 or 8 and preview
+# draws only the DC coefficients, see the top of this file.
+def draw_jpeg(display, f, x, y, invert=False, dither=DITHER_NONE, scale=1, preview=False):
+    if scale not in (1, 2, 4, 8):
+        raise ValueError("scale must be 1, 2, 4 or 8")
+    if f.read(2) != b"\xff\xd8":
+        return 0
+    tables = array("H", bytes(2 * _TABLES))
+    for k in range(64):
+        tables[_ZIGZAG + k] = _ZIGZAG_ORDER[k]
+    w = h = 0
+    comps = None  # per frame component: id, H, V, quantization table
+    restart = 0
+    while True:
+        m = f.read(2)
+        if len(m) < 2 or m[0] != 0xFF:
+            return 0
+        kind = m[1]
+        if kind == 0xFF:
+            f.seek(-1, 1)  # fill byte
+            continue
+        if kind == 0x01 or 0xD0 <= kind <= 0xD8:
+            continue
+        if kind == 0xD9:
+            return 0
+        seg = f.read(struct.unpack(">H", f.read(2))[0] - 2)
+        if kind == 0xC0 or kind == 0xC1:
+            depth, h, w, n = struct.unpack_from(">BHHB", seg)
+            if depth != 8 or n not in (1, 3) or not w or not h:
+                return 0
+            comps = [
+                (seg[6 + 3 * i], seg[7 + 3 * i] >> 4, seg[7 + 3 * i] & 15, seg[8 + 3 * i] & 3)
+                for i in range(n)
+            ]
+        elif 0xC2 <= kind <= 0xCF and kind not in (0xC4, 0xC8, 0xCC):
+            return 0  # progressive, lossless or arithmetic coded
+        elif kind == 0xC4:
+            i = 0
+            while i < len(seg):
+                tc, th = seg[i] >> 4, seg[i] & 15
+                counts = seg[i + 1 : i + 17]
+                nsym = sum(counts)
+                if tc > 1 or th > 1:
+                    return 0
+                slot = _HUFF + (tc * 2 + th) * _HUFF_SIZE
+                _huffman(tables, slot, counts, seg[i + 17 : i + 17 + nsym])
+                i += 17 + nsym
+        elif kind == 0xDB:
+            i = 0
+            while i < len(seg):
+                pq, tq = seg[i] >> 4, seg[i] & 3
+                q = _QUANT + 64 * tq
+                for k in range(64):
+                    if pq:
+                        tables[q + k] = (seg[i + 1 + 2 * k] << 8) | seg[i + 2 + 2 * k]
+                    else:
+                        tables[q + k] = seg[i + 1 + k]
+                i += 65 + 64 * pq
+        elif kind == 0xDD:
+            restart = struct.unpack(">H", seg)[0]
+        elif kind == 0xDA:
+            break
+    if comps is None:
+        return 0
+
+    # blocks of an MCU, only the ones of the first component (Y) get stored. A scan with one
+    # component has one block per MCU, which then covers a block of that component.
+    hmax = max(c[1] for c in comps)
+    vmax = max(c[2] for c in comps)
+    ns = seg[0]
+    nblocks = 0
+    bh = bv = 0  # Y blocks per MCU
+    for i in range(ns):
+        cid, td, ta = seg[1 + 2 * i], seg[2 + 2 * i] >> 4, seg[2 + 2 * i] & 15
+        ci = [c[0] for c in comps].index(cid)
+        _, ch, cv, tq = comps[ci]
+        if ns == 1:
+            ch = cv = 1
+        if ci == 0:
+            if ns > 1 and (ch != hmax or cv != vmax):
+                return 0  # Y subsampled
+            bh, bv = ch, cv
+        for k in range(ch * cv):
+            if nblocks == 10 or td > 1 or ta > 1:
+                return 0
+            desc = _BLOCKS + 4 * nblocks
+            tables[desc] = _HUFF + td * _HUFF_SIZE
+            tables[desc + 1] = _HUFF + (2 + ta) * _HUFF_SIZE
+            tables[desc + 2] = _QUANT + 64 * tq
+            tables[desc + 3] = (i << 8) | (k if ci == 0 else _NO_SLOT)
+            nblocks += 1
+    if not bh:
+        return 0  # the first scan doesn't have Y
+    if ns == 1:
+        mcux = (w * comps[0][1] // hmax + 7) // 8
+        mcuy = (h * comps[0][2] // vmax + 7) // 8
+    else:
+        mcux = (w + 8 * hmax - 1) // (8 * hmax)
+        mcuy = (h + 8 * vmax - 1) // (8 * vmax)
+
+    n = 1 if preview else 8 // scale  # pixels per block direction in the band
+    r = 8 // scale // n  # output pixels per band pixel
+    stride = mcux * bh * n
+    band = bytearray(stride * bv * n)
+    rows_mv = memoryview(band)
+    mat = _idct_matrix(n, stride)
+    wout = (w + scale - 1) // scale
+    hout = (h + scale - 1) // scale
+    expanded = bytearray(wout) if r > 1 else None
+    sink = RowSink(display, x, y, wout, hout, invert, dither)
+
+    st = array("i", bytes(4 * 12))
+    st[_NBLOCKS] = nblocks
+    st[_DC_ONLY] = int(n == 1)
+    coefs = array("h", bytes(2 * 64 * bh * bv))
+    slots = [memoryview(coefs)[64 * k : 64 * (k + 1)] for k in range(bh * bv)]
+    data = bytearray(_BATCH)
+    mv = memoryview(data)
+    eof = False
+    rows = bv * n * r  # output rows per MCU row
+    mcu = 0
+    for my in range(mcuy):
+        j = my * rows
+        if sink.below(j):
+            break
+        show = sink.visible(j) or sink.visible(min(j + rows, hout) - 1)
+        for mx in range(mcux):
+            pos = st[_POS]
+            end = st[_END]
+            if not eof and end - pos < _REFILL:
+                data[: end - pos] = data[pos:end]
+                end -= pos
+                pos = 0
+                k = f.readinto(mv[end:])
+                eof = not k
+                end += k
+            if restart and mcu and mcu % restart == 0:
+                # skip to the RSTn marker, the bits left before it are padding
+                while pos + 1 < end and not (data[pos] == 0xFF and 0xD0 <= data[pos + 1] <= 0xD7):
+                    pos += 1
+                pos += 2
+                for k in range(_BITS, _MARKER + 1):
+                    st[k] = 0
+                for k in range(_PRED, _PRED + 4):
+                    st[k] = 0
+            st[_POS] = pos
+            st[_END] = end
+            if _decode_mcu(st, data, tables, coefs):
+                return 1
+            mcu += 1
+            if show:
+                for k in range(bh * bv):
+                    _idct(slots[k], band, mat, (mx * bh + k % bh) * n + k // bh * n * stride)
+        if not show:
+            continue
+        for k in range(bv * n):
+            row = rows_mv[k * stride : (k + 1) * stride]
+            if r > 1:
+                _expand(row, expanded, wout, r)
+                row = expanded
+            for i in range(r):
+                if j < hout:
+                    sink.row(j, row)
+                j += 1
+    return 1
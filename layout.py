@@ -1,4 +1,8 @@
-from text import _WIDTHS, Text
+from text import Text, measure, wrap
+
+# Bumped whenever the same tree gets laid out or drawn differently, so display lists compiled
+# by an older version (see App._notify) aren't replayed anymore.
+VERSION = 1
 
 # Text alignments
 
@@ -43,15 +47,87 @@ class Node:
         self.layout_width -= 2 * self.padding
         self.layout_height -= 2 * self.padding
 
+        # The measured size and the box (x, y, width, height) the node was
+        # arranged at. They're kept until the node or a descendant changes.
+        self.dirty = True
+        self._size = None
+        self._box = None
+
+    def invalidate(self):
+        '''
+        Mark the node and its ancestors to be measured and arranged again.
+        Call this after changing a node.
+        '''
+        node = self
+        while node is not None:
+            node._size = None
+            node.dirty = True
+            node = node.parent
+
     def measure(self):
         '''
         Return the measured dimensions.
         '''
+        if self._size is None:
+            self._size = self._measure()
+        return self._size
+
+    def _measure(self):
         return None, None
 
-    def draw(self, display, x, y):
+    def arrange(self, x, y):
+        '''
+        Compute where the node and its descendants go when the node is at
+        x, y. Subtrees that didn't change and stay in place are skipped.
+        '''
+        box = self._box
+        if self.dirty or box is None or box[0] != x or box[1] != y:
+            w, h = self.measure()
+            self._box = (x, y, w, h)
+            self._arrange(x, y)
+            self.dirty = False
+
+    def _arrange(self, x, y):
         pass
 
+    def paint(self, display):
+        '''
+        Draw the node where it was arranged.
+        '''
+        pass
+
+    def collect(self, items):
+        '''
+        Append (box, key, node) to items for everything paint draws, box
+        being (x, y, width, height) and key what gets drawn there. See Screen.
+        '''
+        pass
+
+    def clip_rect(self):
+        '''
+        Return the rectangle (x, y, width, height) the ancestors that clip
+        limit the node's drawing to, or None.
+        '''
+        rect = None
+        node = self.parent
+        while node is not None:
+            if getattr(node, 'clip', False) and node._box:
+                x, y, w, h = node._box
+                if rect:
+                    x1 = min(x + w, rect[0] + rect[2])
+                    y1 = min(y + h, rect[1] + rect[3])
+                    x = max(x, rect[0])
+                    y = max(y, rect[1])
+                    w = max(0, x1 - x)
+                    h = max(0, y1 - y)
+                rect = (x, y, w, h)
+            node = node.parent
+        return rect
+
+    def draw(self, display, x, y):
+        self.arrange(x, y)
+        self.paint(display)
+
 
 class Column(Node):
     '''
@@ -66,7 +142,8 @@ class Column(Node):
         wrap_content=True,
         align=ALIGN_LEFT,
         padding=0,
-        outline=False
+        outline=False,
+        clip=False
     ):
         super().__init__(
             parent=parent,
@@ -77,29 +154,60 @@ class Column(Node):
             padding=padding
         )
         self.outline = outline
+        # Keep the children from drawing outside of the box
+        self.clip = clip
         self.children = list()
+        self._outlines = list()
 
     def add_node(self, node):
         if isinstance(node, Node):
+            node.parent = self
             self.children.append(node)
+            self.invalidate()
 
     def add_spacer(self, height, outline=False):
         node = Spacer(self, height, outline=outline)
         self.add_node(node)
 
-    def add_text_content(self, content, text_size=3, padding=5, align=ALIGN_LEFT):
+    def add_text_content(
+            self,
+            content,
+            text_size=3,
+            padding=5,
+            align=ALIGN_LEFT,
+            font=None):
         node = TextNode.overflow(
             TextNode(
                 parent=self,
                 content=content,
                 text_size=text_size,
                 padding=padding,
-                align=align
+                align=align,
+                font=font
             ),
             self.layout_width
         )
         self.add_node(node)
 
+    def add_wrapped_text(
+            self,
+            content,
+            text_size=3,
+            padding=5,
+            align=ALIGN_LEFT,
+            max_lines=0,
+            font=None):
+        node = WrappedTextNode(
+            parent=self,
+            content=content,
+            text_size=text_size,
+            padding=padding,
+            align=align,
+            max_lines=max_lines,
+            font=font
+        )
+        self.add_node(node)
+
     def add_image(
         self,
         image,
@@ -118,7 +226,7 @@ class Column(Node):
         )
         self.add_node(node)
 
-    def measure(self):
+    def _measure(self):
         width = 0
         height = 0
         if not self.wrap_content:
@@ -133,8 +241,7 @@ class Column(Node):
 
         return width, height
 
-    def draw(self, display, x, y):
-        # Measure once
+    def _arrange(self, x, y):
         measurements = list()
         for child in self.children:
             measurements.append(child.measure())
@@ -158,20 +265,39 @@ class Column(Node):
             d_x += self.padding
         d_y = y + self.padding
 
+        self._outlines = list()
         idx = 0
         for child in self.children:
             w, h = measurements[idx]
             outline = getattr(child, 'outline', False)
-            if outline:
-                display.drawRect(d_x, d_y, w, h, display.BLACK)
-            child.draw(display, d_x, d_y)
+            self._outlines.append((d_x, d_y, w, h) if outline else None)
+            child.arrange(d_x, d_y)
             d_y += h + self.padding
             idx += 1
 
+    def paint(self, display):
+        if self.clip:
+            x, y, w, h = self._box
+            display.pushClip(x, y, w, h)
+        for child, outline in zip(self.children, self._outlines):
+            if outline:
+                x, y, w, h = outline
+                display.drawRect(x, y, w, h, display.BLACK)
+            child.paint(display)
+        if self.clip:
+            display.popClip()
+
+    def collect(self, items):
+        for child, outline in zip(self.children, self._outlines):
+            if outline:
+                items.append((outline, 'outline', None))
+            child.collect(items)
+
 
 class TextNode(Node):
     '''
-    A Text Node.
+    A Text Node. font is a GFX font dict or a fontfile.Font, the standard
+    font if None.
     '''
 
     def __init__(
@@ -180,7 +306,8 @@ class TextNode(Node):
             content,
             text_size=3,
             padding=5,
-            align=ALIGN_LEFT):
+            align=ALIGN_LEFT,
+            font=None):
 
         super().__init__(parent=parent, padding=padding, align=align)
         self.content = content
@@ -188,13 +315,24 @@ class TextNode(Node):
         self.text = Text(
             self.content,
             text_size=self.text_size,
-            padding=self.padding
+            padding=self.padding,
+            font=font
         )
 
-    def measure(self):
+    def set_content(self, content):
+        self.content = content
+        self.text = Text(
+            self.content,
+            text_size=self.text_size,
+            padding=self.padding,
+            font=self.text.font
+        )
+        self.invalidate()
+
+    def _measure(self):
         return self.text.measured_width(), self.text.measured_height()
 
-    def draw(self, display, x, y):
+    def _arrange(self, x, y):
         d_x = x
         d_y = y + self.padding
         if self.align == ALIGN_CENTER or self.align == ALIGN_RIGHT:
@@ -207,33 +345,149 @@ class TextNode(Node):
                 d_x = x + (self.layout_width - width)
         else:
             d_x = x + self.padding
+        self._at = (d_x, d_y)
+
+    def paint(self, display):
         display.setTextSize(self.text_size)
+        display.setFont(self.text.font)
         display.printText(
-            d_x,
-            d_y,
+            self._at[0],
+            self._at[1],
             self.text.content
         )
 
+    def collect(self, items):
+        font = self.text.font
+        w, h = measure(self.text.content, self.text_size, font)
+        box = (self._at[0], self._at[1], w, h)
+        items.append((box, (self.text.content, self.text_size, id(font)), self))
+
     @classmethod
     def overflow(cls, node, target_width):
         '''
-        This can use a lot of improvement.
+        Return node, or a copy of it with the content cut short and ending in
+        "..." if it's wider than target_width. The cut is the longest prefix
+        that fits, found with a binary search over the exact text widths.
         '''
 
         mw = node.text.measured_width()
         if mw < target_width:
             return node
 
-        index = (target_width // _WIDTHS[node.text_size]) - 4
-        ellipsized = node.text.content[:index]
+        text = node.text
+        available = target_width - 2 * node.padding
+        lo = 0
+        hi = len(text.content)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            w, _ = measure(
+                '%s...' % text.content[:mid], text.text_size, text.font)
+            if w < available:
+                lo = mid
+            else:
+                hi = mid - 1
         return TextNode(
-            content='%s...' % ellipsized,
+            content='%s...' % text.content[:lo],
             parent=node.parent,
             text_size=node.text_size,
-            padding=node.padding
+            padding=node.padding,
+            align=node.align,
+            font=text.font
         )
 
 
+class WrappedTextNode(Node):
+    '''
+    A Text Node that breaks its content into lines at spaces and newlines to
+    fit its layout width. With max_lines the last line gets cut short and
+    ends in "..." if there's more text. The breaks come from text.wrap, which
+    caches them, so measuring the node again is cheap.
+    '''
+
+    def __init__(
+            self,
+            parent,
+            content,
+            text_size=3,
+            padding=5,
+            align=ALIGN_LEFT,
+            max_lines=0,
+            font=None):
+
+        super().__init__(parent=parent, padding=padding, align=align)
+        self.content = content
+        self.max_lines = max_lines
+        self.text = Text(
+            self.content,
+            text_size=text_size,
+            padding=self.padding,
+            font=font
+        )
+        self.text_size = self.text.text_size
+
+    def set_content(self, content):
+        self.content = content
+        self.text = Text(
+            self.content,
+            text_size=self.text_size,
+            padding=self.padding,
+            font=self.text.font
+        )
+        self.invalidate()
+
+    def lines(self):
+        return wrap(
+            self.content,
+            self.layout_width,
+            self.text_size,
+            self.text.font,
+            self.max_lines
+        )
+
+    def line_height(self):
+        # One pixel of the font between lines
+        h = 0
+        for line in self.lines():
+            _, l_h = measure(line, self.text_size, self.text.font)
+            h = l_h if h < l_h else h
+        return h + self.text_size
+
+    def _measure(self):
+        width = 0
+        for line in self.lines():
+            w, _ = measure(line, self.text_size, self.text.font)
+            width = w if width < w else width
+        height = len(self.lines()) * self.line_height() - self.text_size
+        return width + 2 * self.padding, height + 2 * self.padding
+
+    def _arrange(self, x, y):
+        line_height = self.line_height()
+        self._at = list()
+        d_y = y + self.padding
+        for line in self.lines():
+            d_x = x + self.padding
+            if self.align == ALIGN_CENTER or self.align == ALIGN_RIGHT:
+                w, _ = measure(line, self.text_size, self.text.font)
+                if self.align == ALIGN_CENTER:
+                    d_x += int((self.layout_width - w) / 2)
+                else:
+                    d_x += self.layout_width - w
+            self._at.append((d_x, d_y, line))
+            d_y += line_height
+
+    def paint(self, display):
+        display.setTextSize(self.text_size)
+        display.setFont(self.text.font)
+        for d_x, d_y, line in self._at:
+            display.printText(d_x, d_y, line)
+
+    def collect(self, items):
+        font = self.text.font
+        for d_x, d_y, line in self._at:
+            w, h = measure(line, self.text_size, font)
+            items.append(((d_x, d_y, w, h), (line, self.text_size, id(font)), self))
+
+
 class Row(Node):
     '''
     A Row. (Flow layout in horizontal direction)
@@ -247,7 +501,8 @@ class Row(Node):
             wrap_content=True,
             align=ALIGN_LEFT,
             padding=0,
-            outline=False):
+            outline=False,
+            clip=False):
 
         super().__init__(
             parent=parent,
@@ -258,9 +513,12 @@ class Row(Node):
             padding=padding
         )
         self.outline = outline
+        # Keep the children from drawing outside of the box
+        self.clip = clip
         self.children = list()
+        self._outlines = list()
 
-    def measure(self):
+    def _measure(self):
         width = 0
         height = 0
         if not self.wrap_content:
@@ -277,19 +535,22 @@ class Row(Node):
 
     def add_node(self, node):
         if isinstance(node, Node):
+            node.parent = self
             self.children.append(node)
+            self.invalidate()
 
     def add_spacer(self, height, outline=False):
         node = Spacer(self, height, padding=self.padding, outline=outline)
         self.add_node(node)
 
-    def add_text_content(self, content, text_size=3, align=ALIGN_LEFT):
+    def add_text_content(self, content, text_size=3, align=ALIGN_LEFT, font=None):
         node = TextNode.overflow(
             TextNode(
                 parent=self,
                 content=content,
                 text_size=text_size,
-                align=align
+                align=align,
+                font=font
             ),
             self.layout_width
         )
@@ -313,8 +574,7 @@ class Row(Node):
         )
         self.add_node(node)
 
-    def draw(self, display, x, y):
-        # Measure once
+    def _arrange(self, x, y):
         measurements = list()
         for child in self.children:
             measurements.append(child.measure())
@@ -338,19 +598,37 @@ class Row(Node):
         else:
             d_x += self.padding
         d_y = y + self.padding
+        self._outlines = list()
         idx = 0
         for child in self.children:
             w, h = measurements[idx]
             outline = getattr(child, 'outline', False)
-            if outline:
-                display.drawRect(d_x, d_y, w, h, display.BLACK)
+            self._outlines.append((d_x, d_y, w, h) if outline else None)
             if child.align == ALIGN_CENTER or child.align == ALIGN_RIGHT:
                 # Alignments are always with respect to parent
                 d_x = x
-            child.draw(display, d_x, d_y)
+            child.arrange(d_x, d_y)
             d_x += w + self.padding
             idx += 1
 
+    def paint(self, display):
+        if self.clip:
+            x, y, w, h = self._box
+            display.pushClip(x, y, w, h)
+        for child, outline in zip(self.children, self._outlines):
+            if outline:
+                x, y, w, h = outline
+                display.drawRect(x, y, w, h, display.BLACK)
+            child.paint(display)
+        if self.clip:
+            display.popClip()
+
+    def collect(self, items):
+        for child, outline in zip(self.children, self._outlines):
+            if outline:
+                items.append((outline, 'outline', None))
+            child.collect(items)
+
 
 class Spacer(Node):
     '''
@@ -364,13 +642,9 @@ class Spacer(Node):
         self.height = height
         self.outline = outline
 
-    def measure(self):
+    def _measure(self):
         return self.width, self.height
 
-    def draw(self, display, x, y):
-        # Does nothing
-        pass
-
 
 class ImageNode(Node):
     '''
@@ -397,7 +671,7 @@ class ImageNode(Node):
         self.width = width
         self.height = height
 
-    def measure(self):
+    def _measure(self):
         if self.wrap_content:
             return self.layout_width, self.layout_height
         else:
@@ -405,7 +679,7 @@ class ImageNode(Node):
             h = self.height + self.padding
             return w, h
 
-    def draw(self, display, x, y):
+    def _arrange(self, x, y):
         d_x = x
         d_y = y + self.padding
         if self.align == ALIGN_CENTER or self.align == ALIGN_RIGHT:
@@ -418,10 +692,134 @@ class ImageNode(Node):
                 d_x += (self.layout_width - w)
         else:
             d_x += self.padding
+        self._at = (d_x, d_y)
+
+    def paint(self, display):
         display.drawBitmap(
-            d_x,
-            d_y,
+            self._at[0],
+            self._at[1],
             self.image,
             self.width,
             self.height
         )
+
+    def collect(self, items):
+        box = (self._at[0], self._at[1], self.width, self.height)
+        items.append((box, (id(self.image), self.width, self.height), self))
+
+
+# White of each display mode (Inkplate.INKPLATE_1BIT, _2BIT, _3BIT)
+_WHITE = (0, 3, 7)
+
+
+def _overlaps(a, b):
+    return (a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and
+            a[1] < b[1] + b[3] and b[1] < a[1] + a[3])
+
+
+def _contains(a, b):
+    return (a[0] <= b[0] and b[0] + b[2] <= a[0] + a[2] and
+            a[1] <= b[1] and b[1] + b[3] <= a[1] + a[3])
+
+
+def _merge(boxes):
+    # Drop boxes that are the same as or inside another one
+    out = list()
+    for box in boxes:
+        if any(_contains(o, box) for o in out):
+            continue
+        out = [o for o in out if not _contains(box, o)]
+        out.append(box)
+    return out
+
+
+class Screen:
+    '''
+    Retained drawing of layout trees on a display. It remembers the box and
+    content of everything it drew, so drawing a new or changed tree only
+    erases and draws again the boxes that differ, and the display can be
+    refreshed with a partial update of just those.
+    '''
+
+    def __init__(self, display):
+        self.display = display
+        self._items = None  # (box, key, node) drawn last, see Node.collect
+        self._resumed = False
+
+    def reset(self):
+        '''
+        Make the next update draw and refresh everything.
+        '''
+        self._items = None
+
+    def resume(self):
+        '''
+        Make the next update refresh with a partial update although it draws
+        everything, because the display still shows what its partial update
+        reference holds (see Inkplate.loadSnapshot).
+        '''
+        self._items = None
+        self._resumed = True
+
+    def draw(self, root, x=0, y=0):
+        '''
+        Draw the tree root into the framebuffer and return the damaged
+        rectangles, which the display's damage rectangle covers as well.
+        '''
+        display = self.display
+        root.arrange(x, y)
+        items = list()
+        root.collect(items)
+        if self._items is None:
+            display.clearDisplay()
+            root.paint(display)
+            self._items = items
+            return [(0, 0, display.width(), display.height())]
+
+        old = set((box, key) for box, key, _ in self._items)
+        new = set((box, key) for box, key, _ in items)
+        damage = [box for box, key, _ in self._items if (box, key) not in new]
+        damage += [box for box, key, _ in items if (box, key) not in old]
+        damage = _merge(damage)
+        white = _WHITE[display.displayMode]
+        for box in damage:
+            display.fillRect(box[0], box[1], box[2], box[3], white)
+        # Draw everything that got (partly) erased again
+        painted = set()
+        for box, _, node in items:
+            if id(node) in painted:
+                continue
+            for d in damage:
+                if _overlaps(box, d):
+                    if node is None:
+                        display.drawRect(
+                            box[0], box[1], box[2], box[3], display.BLACK)
+                    else:
+                        clip = None
+                        if hasattr(node, 'clip_rect'):
+                            clip = node.clip_rect()
+                        if clip:
+                            display.pushClip(clip[0], clip[1], clip[2], clip[3])
+                        node.paint(display)
+                        if clip:
+                            display.popClip()
+                        painted.add(id(node))
+                    break
+        self._items = items
+        return damage
+
+    def update(self, root, clean=None):
+        '''
+        Draw the tree root and refresh the display, fully the first time
+        (with the clean profile clean, unless resumed) and after that with a
+        partial update of the damaged area. Returns the damaged rectangles.
+        '''
+        full = self._items is None and not self._resumed
+        self._resumed = False
+        damage = self.draw(root)
+        if full:
+            self.display.display(clean=clean)
+        elif damage:
+            self.display.partialUpdate()
+        self.display.ipp.start()
+        return damage
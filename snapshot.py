@@ -0,0 +1,114 @@
+# Framebuffer snapshots for Inkplate.saveSnapshot and loadSnapshot.
+#
+# A snapshot keeps what the panel shows across deep sleep: the framebuffer as last sent to the
+# display, compressed, so that after waking up the partial update engine knows what's on the
+# panel and the next refresh can be a partial update that only sends the rows that really
+# changed, instead of a full clean and redraw.
+#
+# A snapshot file has a 12 byte header (HEADER: MAGIC, version, display mode, the number of
+# partial updates since the last full refresh, framebuffer size) followed by the PackBits
+# style run-length encoded framebuffer: a control byte c < 128 is followed by c + 1 literal
+# bytes, c >= 128 by a byte that gets repeated c - 125 times. Framebuffers of text and lines
+# are mostly long runs of white, which shrinks them to a few kilobytes.
+import micropython
+import struct
+
+MAGIC = b"IPFB"
+VERSION = 1
+HEADER = "<4sBBHI"
+HEADER_SIZE = 12
+
+
+# _pack run-length encodes the n bytes of src into dst, which has to be n + n // 128 + 1 bytes
+# long, and returns the length of the result
+@micropython.viper
+def _pack(src, n: int, dst) -> int:
+    s = ptr8(src)
+    d = ptr8(dst)
+    i = 0
+    o = 0
+    while i < n:
+        v = s[i]
+        j = i + 1
+        while j < n and j - i < 130 and s[j] == v:
+            j += 1
+        if j - i >= 3:
+            d[o] = j - i + 125
+            d[o + 1] = v
+            o += 2
+            i = j
+            continue
+        # literals up to the next run of 3
+        start = i
+        ctl = o
+        o += 1
+        while i < n and i - start < 128:
+            if i + 2 < n and s[i] == s[i + 1] and s[i] == s[i + 2]:
+                break
+            d[o] = s[i]
+            o += 1
+            i += 1
+        d[ctl] = i - start - 1
+    return o
+
+
+# _unpack decodes the n bytes of src written by _pack into dst, at most m bytes, and returns
+# the number of bytes decoded
+@micropython.viper
+def _unpack(src, n: int, dst, m: int) -> int:
+    s = ptr8(src)
+    d = ptr8(dst)
+    i = 0
+    o = 0
+    while i < n and o < m:
+        c = s[i]
+        i += 1
+        if c < 128:
+            k = c + 1
+            while k > 0 and i < n and o < m:
+                d[o] = s[i]
+                o += 1
+                i += 1
+                k -= 1
+        elif i < n:
+            k = c - 125
+            v = s[i]
+            i += 1
+            while k > 0 and o < m:
+                d[o] = v
+                o += 1
+                k -= 1
+    return o
+
+
+# save writes framebuffer fb (bytes) of display mode to the file at path, partials is the
+# number of partial updates since the last full refresh
+def save(path, fb, mode, partials):
+    n = len(fb)
+    out = bytearray(n + n // 128 + 1)
+    size = _pack(fb, n, out)
+    with open(path, "wb") as f:
+        f.write(struct.pack(HEADER, MAGIC, VERSION, mode, min(partials, 0xFFFF), n))
+        f.write(memoryview(out)[:size])
+    return size
+
+
+# load reads the snapshot at path into framebuffer fb (a bytearray) of display mode and returns
+# the number of partial updates since the last full refresh, or None if there's no snapshot
+# of that mode and size
+def load(path, fb, mode):
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    with f:
+        hdr = f.read(HEADER_SIZE)
+        if len(hdr) < HEADER_SIZE:
+            return None
+        magic, version, m, partials, n = struct.unpack(HEADER, hdr)
+        if magic != MAGIC or version != VERSION or m != mode or n != len(fb):
+            return None
+        data = f.read()
+    if _unpack(data, len(data), fb, n) != n:
+        return None
+    return partials
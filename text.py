@@ -1,46 +1,157 @@
-_WIDTHS = {
-    1:  8,
-    2:  10,
-    3:  18,
-    4:  25,
-    5:  30,
-    6:  35,
-    7:  45,
-    8:  50,
-    9:  55,
-    10: 55,
-}
-
-_HEIGHTS = {
-    1:  10,
-    2:  15,
-    3:  25,
-    4:  30,
-    5:  40,
-    6:  50,
-    7:  50,
-    8:  60,
-    9:  70,
-    10: 80,
-}
+from gfx_standard_font_01 import text_dict as std_font
+
+# exact text metrics, as printText draws the text: (string, size, id(font)) ->
+# (width, height, font), see measure. Layout measures the same strings over and over, so
+# this is mostly dictionary hits; it gets emptied once it holds _MEASURED_MAX strings.
+_MEASURED = {}
+_MEASURED_MAX = 256
+
+# line breaks: (string, width, size, id(font), max_lines) -> (lines, font), see wrap
+_WRAPPED = {}
+_WRAPPED_MAX = 32
+
+
+def gfx_glyphs(font, s):
+    '''
+    Return the entries of GFX font dict font that printText draws for s, as
+    (name, gap) pairs. Like GFX._very_slow_text, entries with longer names can be
+    used by putting "__" around them; single characters get a gap of background
+    after them and fall back to uppercase and then to "?CHAR?".
+    '''
+    glyphs = []
+    for chunk in s.split('__'):
+        if chunk in font:
+            glyphs.append((chunk, False))
+            continue
+        for ch in chunk:
+            if ch not in font:
+                ch = ch.upper() if ch.upper() in font else '?CHAR?'
+            glyphs.append((ch, True))
+    return glyphs
+
+
+def measure(s, size, font=None):
+    '''
+    Return the (width, height) of s drawn with printText at a text size in font,
+    a GFX font dict or a fontfile.Font (the standard font if None). The width is
+    how far the pen moves.
+    '''
+    if font is None:
+        font = std_font
+    key = (s, size, id(font))
+    m = _MEASURED.get(key)
+    if m is None or m[2] is not font:
+        if isinstance(font, dict):
+            w = h = 0
+            for name, _ in gfx_glyphs(font, s):
+                w += size * font[name][0] + size
+                h = max(h, size * font[name][1])
+        else:
+            w = size * font.width(s)
+            h = size * font.height
+        if len(_MEASURED) >= _MEASURED_MAX:
+            _MEASURED.clear()
+        m = (w, h, font)
+        _MEASURED[key] = m
+    return m[0], m[1]
+
+
+def _prefix(s, width, size, font, suffix=''):
+    '''
+    Return the length of the longest prefix of s that fits into width with
+    suffix appended, using a binary search over the measured widths.
+    '''
+    lo = 0
+    hi = len(s)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        w, _ = measure(s[:mid] + suffix, size, font)
+        if w <= width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def ellipsize(s, width, size, font=None):
+    '''
+    Return s if it fits into width, or else the longest prefix of s that fits
+    with "..." appended.
+    '''
+    if measure(s, size, font)[0] <= width:
+        return s
+    return '%s...' % s[:_prefix(s, width, size, font, '...')].rstrip()
+
+
+def wrap(s, width, size, font=None, max_lines=0):
+    '''
+    Return the lines s gets broken into at spaces and newlines so that each
+    fits into width, words that are wider than that get broken up. With
+    max_lines the last line is cut short with an ellipsis if there's more
+    text. The breaks are cached per string, width, size and font.
+    '''
+    if font is None:
+        font = std_font
+    key = (s, width, size, id(font), max_lines)
+    entry = _WRAPPED.get(key)
+    if entry is None or entry[1] is not font:
+        if len(_WRAPPED) >= _WRAPPED_MAX:
+            _WRAPPED.clear()
+        entry = (_wrap(s, width, size, font, max_lines), font)
+        _WRAPPED[key] = entry
+    return entry[0]
+
+
+def _wrap(s, width, size, font, max_lines):
+    space, _ = measure(' ', size, font)
+    lines = []
+    for paragraph in s.split('\n'):
+        line = ''
+        line_w = 0
+        for word in paragraph.split(' '):
+            if not word:
+                continue
+            word_w, _ = measure(word, size, font)
+            if line and line_w + space + word_w <= width:
+                line += ' ' + word
+                line_w += space + word_w
+                continue
+            if line:
+                lines.append(line)
+            while word_w > width and len(word) > 1:
+                n = max(1, _prefix(word, width, size, font))
+                lines.append(word[:n])
+                word = word[n:]
+                word_w, _ = measure(word, size, font)
+            line = word
+            line_w = word_w
+        lines.append(line)
+    if max_lines and len(lines) > max_lines:
+        rest = ' '.join(lines[max_lines - 1:])
+        lines = lines[:max_lines - 1]
+        lines.append(ellipsize(rest, width, size, font))
+    return lines
 
 
 class Text:
     '''
-    A class that helps with text rendering. 
+    A class that helps with text rendering.
     Allows justifying text because it knows how to measure itself.
     '''
 
-    def __init__(self, content, text_size=2, padding=5):
-        self.content = content.upper()
+    def __init__(self, content, text_size=2, padding=5, font=None):
+        self.content = content
         self.length = len(content)
         text_size = 1 if (text_size < 1) else text_size
         text_size = 10 if (text_size > 10) else text_size
         self.text_size = text_size
         self.padding = padding
+        self.font = std_font if font is None else font
 
     def measured_width(self):
-        return self.length * _WIDTHS[self.text_size] + 2 * self.padding
+        w, _ = measure(self.content, self.text_size, self.font)
+        return w + 2 * self.padding
 
     def measured_height(self):
-        return _HEIGHTS[self.text_size] + 2 * self.padding
+        _, h = measure(self.content, self.text_size, self.font)
+        return h + 2 * self.padding
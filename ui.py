@@ -2,7 +2,7 @@ import time
 
 from images import CALENDAR_40_40
 from inkplate import Inkplate
-from layout import ALIGN_CENTER, ALIGN_LEFT, ALIGN_RIGHT, Column, Row
+from layout import ALIGN_CENTER, ALIGN_LEFT, ALIGN_RIGHT, Column, Row, Screen
 
 '''
 python pyboard.py --device /dev/ttyUSB0 -f cp layout.py text.py images.py :
@@ -22,6 +22,7 @@ class UI:
         self.display.begin()
         self.width = self.display.width()
         self.height = self.display.height()
+        self.screen = Screen(self.display)
         self._columnar_interface()
 
     def _build_textual_interface(self):
@@ -168,9 +169,7 @@ class UI:
         self.root.add_node(content_root)
 
     def draw(self):
-        self.display.clearDisplay()
-        self.root.draw(self.display, 0, 0)
-        self.display.display()
+        self.screen.update(self.root)
 
 
 if __name__ == '__main__':
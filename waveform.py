@@ -0,0 +1,195 @@
+# Waveform tables for the Inkplate 6 display.
+#
+# A waveform is a list of phases; during each phase the entire display gets written once and
+# every pixel receives a 2-bit code: 0=discharge, 1=black, 2=white, 3=skip. A phase lists the
+# code for each level, indexed by the pixel value in the framebuffer:
+# - MODE_MONO: 0=white, 1=black (InkplateMono)
+# - MODE_GS2: 0=black .. 3=white (InkplateGS2)
+# - MODE_GS3: 0=black .. 7=white (InkplateGS3)
+# - MODE_PARTIAL: the code sent to pixels that change to 0=white or 1=black, pixels that
+#   don't change get skipped (InkplatePartial)
+# - MODE_PARTIAL_GS2: the code sent to pixels that change from gray level old to new, indexed
+#   by old * 4 + new (0=black .. 3=white), pixels that don't change get skipped
+#   (InkplatePartialGS2)
+#
+# E-paper particles move slower in the cold, so tables can be given per temperature band and
+# the driver picks one using the temperature the TPS65186 measures when the panel powers up.
+# The built-in tables cover all temperatures, see BANDS for bands to try.
+#
+# Tables can be loaded from a compact binary file (see Waveforms.load), the format is:
+#   b"IPWF", version (1 byte), number of tables (1 byte), then per table:
+#   mode, min temp, max temp (signed, degrees C, inclusive), levels, phases (1 byte each),
+#   followed by phases * ((levels + 3) // 4) bytes holding the codes, the code of level k
+#   of a phase being in bits 2*(k%4) of byte k//4. A file doesn't need tables for every mode,
+#   the built-in ones are used for the modes it leaves out.
+# Running this file on the host writes the built-in tables, to be used as a starting point,
+# or with --bands the built-in tables with the mono and partial ones replaced by BANDS:
+#   python3 waveform.py [--bands] waveforms.bin
+MODE_MONO = 0
+MODE_GS2 = 1
+MODE_PARTIAL = 2
+MODE_GS3 = 3
+MODE_PARTIAL_GS2 = 4
+
+# temperature assumed when none has been measured yet
+ROOM_TEMPERATURE = 22
+
+# file Inkplate.begin() looks for on the SD card and then on flash
+WAVEFORM_FILE = "waveforms.bin"
+
+_MAGIC = b"IPWF"
+_VERSION = 1
+
+# number of levels a phase has per mode
+_LEVELS = (2, 4, 2, 8, 16)
+
+_GS2 = [
+    (0, 0, 0, 0),
+    (0, 0, 0, 0),
+    (0, 1, 1, 0),
+    (0, 1, 1, 0),
+    (1, 2, 1, 0),
+    (1, 1, 2, 0),
+    (1, 2, 2, 2),
+]
+
+
+# _gs2_transitions builds a MODE_PARTIAL_GS2 table from a MODE_GS2 one: pixels that change
+# first get driven white once for every level they are darker than white, which stands in
+# for the clean a full refresh does, and then get the GS2 waveform of their new level
+def _gs2_transitions(phases):
+    erase = [
+        tuple(2 if k >> 2 < 3 - e else 3 for k in range(16)) for e in range(3)
+    ]
+    return erase + [tuple(phase[k & 3] for k in range(16)) for phase in phases]
+
+
+# built-in tables: (mode, min temp, max temp, phases)
+# These are the waveforms the driver always used, for every temperature. The mono and partial
+# ones were copied from the e-Radionica Inkplate-6-Arduino-library, the grayscale one was
+# adapted from its "waveform3Bit[8][7]" by taking colors 0 (black), 3, 5, and 7 (white), the
+# 3-bit one is that table in full.
+DEFAULT = [
+    (MODE_MONO, -40, 85, [(3, 1)] * 5 + [(2, 1)]),
+    (MODE_GS2, -40, 85, _GS2),
+    (
+        MODE_GS3,
+        -40,
+        85,
+        [
+            (0, 0, 0, 0, 1, 0, 0, 0),
+            (0, 0, 1, 0, 1, 0, 1, 0),
+            (0, 1, 1, 1, 1, 1, 1, 0),
+            (0, 1, 2, 1, 2, 1, 2, 0),
+            (1, 1, 1, 2, 2, 1, 1, 0),
+            (1, 2, 2, 1, 1, 2, 2, 0),
+            (1, 1, 1, 2, 2, 2, 2, 2),
+        ],
+    ),
+    (MODE_PARTIAL, -40, 85, [(2, 1)] * 5),
+    (MODE_PARTIAL_GS2, -40, 85, _gs2_transitions(_GS2)),
+]
+
+# Temperature bands for the mono and partial waveforms: the built-in tables for 15..29C and
+# more black phases in the cold, fewer in the heat. They haven't been measured on a panel, so
+# they are only used when written to a waveform file (python3 waveform.py --bands) to try
+# them out.
+BANDS = [
+    (MODE_MONO, -40, 14, [(3, 1)] * 7 + [(2, 1)]),
+    (MODE_MONO, 15, 29, [(3, 1)] * 5 + [(2, 1)]),
+    (MODE_MONO, 30, 85, [(3, 1)] * 3 + [(2, 1)]),
+    (MODE_PARTIAL, -40, 14, [(2, 1)] * 7),
+    (MODE_PARTIAL, 15, 29, [(2, 1)] * 5),
+    (MODE_PARTIAL, 30, 85, [(2, 1)] * 4),
+]
+
+
+class Waveforms:
+    def __init__(self, tables=None):
+        self.tables = list(DEFAULT if tables is None else tables)
+
+    # select returns the phases for mode at the given temperature: the table whose band
+    # contains the temperature or else the one with the closest band
+    def select(self, mode, temperature=None):
+        if temperature is None:
+            temperature = ROOM_TEMPERATURE
+        best = None
+        best_dist = 0
+        for m, tmin, tmax, phases in self.tables:
+            if m != mode:
+                continue
+            if temperature < tmin:
+                dist = tmin - temperature
+            elif temperature > tmax:
+                dist = temperature - tmax
+            else:
+                return phases
+            if best is None or dist < best_dist:
+                best = phases
+                best_dist = dist
+        if best is None:
+            raise ValueError("no waveform for mode %d" % mode)
+        return best
+
+    # load reads tables from a waveform file, raising OSError if it can't be read and
+    # ValueError if it isn't a valid waveform file. Modes the file has no tables for keep the
+    # ones in DEFAULT.
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < 6 or data[0:4] != _MAGIC or data[4] != _VERSION:
+            raise ValueError("not a waveform file: %s" % path)
+        tables = []
+        ix = 6
+        for _ in range(data[5]):
+            if ix + 5 > len(data):
+                raise ValueError("truncated waveform file: %s" % path)
+            mode = data[ix]
+            tmin = data[ix + 1] - 256 if data[ix + 1] > 127 else data[ix + 1]
+            tmax = data[ix + 2] - 256 if data[ix + 2] > 127 else data[ix + 2]
+            levels = data[ix + 3]
+            nphases = data[ix + 4]
+            ix += 5
+            if mode >= len(_LEVELS) or levels != _LEVELS[mode] or nphases == 0:
+                raise ValueError("bad waveform table in %s" % path)
+            nbytes = (levels + 3) // 4
+            if ix + nphases * nbytes > len(data):
+                raise ValueError("truncated waveform file: %s" % path)
+            phases = []
+            for _ in range(nphases):
+                phases.append(
+                    tuple((data[ix + (k >> 2)] >> (2 * (k & 3))) & 3 for k in range(levels))
+                )
+                ix += nbytes
+            tables.append((mode, tmin, tmax, phases))
+        modes = set(t[0] for t in tables)
+        return cls(tables + [t for t in DEFAULT if t[0] not in modes])
+
+    # save writes the tables to a waveform file
+    def save(self, path):
+        out = bytearray(_MAGIC)
+        out.append(_VERSION)
+        out.append(len(self.tables))
+        for mode, tmin, tmax, phases in self.tables:
+            levels = len(phases[0])
+            out.extend(bytes((mode, tmin & 0xFF, tmax & 0xFF, levels, len(phases))))
+            for phase in phases:
+                packed = bytearray((levels + 3) // 4)
+                for k in range(levels):
+                    packed[k >> 2] |= (phase[k] & 3) << (2 * (k & 3))
+                out.extend(packed)
+        with open(path, "wb") as f:
+            f.write(out)
+
+
+if __name__ == "__main__":
+    import sys
+
+    args = sys.argv[1:]
+    tables = DEFAULT
+    if "--bands" in args:
+        args.remove("--bands")
+        modes = set(t[0] for t in BANDS)
+        tables = BANDS + [t for t in DEFAULT if t[0] not in modes]
+    Waveforms(tables).save(args[0] if args else WAVEFORM_FILE)